@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark for the ctxpack CLI.
+
+Measures the wall time of `ctxpack --help` and of packing a ten-file project
+in fresh interpreter processes, and fails when the median exceeds the target.
+
+Usage:
+    python bench_startup.py [--runs N]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SCRIPT = Path(__file__).resolve().parent / "context_packer.py"
+
+# Targets in seconds (median of all runs, including interpreter startup)
+HELP_TARGET = 0.15
+PACK_TARGET = 0.30
+
+
+def time_command(args, runs):
+    """Run a command `runs` times and return the median wall time."""
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(args, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def make_ten_file_project(root: Path) -> Path:
+    """Create a small ten-file project to pack."""
+    project = root / "bench_project"
+    (project / "src").mkdir(parents=True)
+    (project / "README.md").write_text("# Bench\n")
+    (project / "package.json").write_text('{"name": "bench"}\n')
+    for i in range(8):
+        (project / "src" / f"module_{i}.py").write_text(f"def f{i}():\n    return {i}\n" * 20)
+    return project
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ctxpack startup time")
+    parser.add_argument("--runs", type=int, default=10, help="runs per scenario (default: 10)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        project = make_ten_file_project(Path(tmpdir))
+        output = Path(tmpdir) / "bench.md"
+
+        help_cmd = [sys.executable, str(SCRIPT), "--help"]
+        pack_cmd = [sys.executable, str(SCRIPT), str(project), "-o", str(output)]
+        results = [
+            ("ctxpack --help", time_command(help_cmd, args.runs), HELP_TARGET),
+            ("ctxpack <10 files>", time_command(pack_cmd, args.runs), PACK_TARGET),
+        ]
+
+    failed = False
+    for name, median, target in results:
+        ok = median <= target
+        failed = failed or not ok
+        print(f"{'✓' if ok else '✗'} {name}: {median * 1000:.1f}ms (target {target * 1000:.0f}ms)")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
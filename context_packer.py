@@ -4,449 +4,3322 @@ Context Packer - 将项目文件夹打包成单个markdown文件，便于AI分
 """
 
 import argparse
+import copy
 import fnmatch
-import mimetypes
+import io
 import os
+import re
+import sys
+import threading
+import time
+from array import array
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Set
+from typing import Any, AsyncIterator, Dict, Iterator, List, NamedTuple, Sequence, Set, Tuple
 
+# 默认忽略规则（模块级只读表，实例化时无需重新构建）
+DEFAULT_IGNORE_PATTERNS = frozenset(
+    {
+        # 版本控制
+        ".git",
+        ".svn",
+        ".hg",
+        # 依赖管理
+        "node_modules",
+        "venv",
+        "env",
+        "__pycache__",
+        ".pytest_cache",
+        "vendor",
+        "target",
+        "build",
+        "dist",
+        ".next",
+        ".nuxt",
+        # IDE和编辑器
+        ".vscode",
+        ".idea",
+        "*.swp",
+        "*.swo",
+        "*~",
+        # 操作系统
+        ".DS_Store",
+        "Thumbs.db",
+        "desktop.ini",
+        # 日志和缓存
+        "*.log",
+        "*.tmp",
+        ".cache",
+        ".temp",
+        # 编译产物
+        "*.pyc",
+        "*.pyo",
+        "*.class",
+        "*.o",
+        "*.so",
+        "*.dll",
+        # 大文件类型
+        "*.zip",
+        "*.tar.gz",
+        "*.rar",
+        "*.7z",
+        "*.pdf",
+        "*.mp4",
+        "*.avi",
+        "*.mov",
+        "*.mp3",
+        "*.wav",
+        "*.jpg",
+        "*.jpeg",
+        "*.png",
+        "*.gif",
+        "*.bmp",
+        "*.svg",
+        # 配置文件
+        ".env",
+        ".env.local",
+        ".env.production",
+        # 避免自循环
+        "project_context.md",
+        "*_context.md",
+    }
+)
+
+# 已知的文本文件后缀
+TEXT_EXTENSIONS = frozenset(
+    {
+        ".py",
+        ".js",
+        ".ts",
+        ".jsx",
+        ".tsx",
+        ".vue",
+        ".svelte",
+        ".html",
+        ".htm",
+        ".css",
+        ".scss",
+        ".sass",
+        ".less",
+        ".json",
+        ".xml",
+        ".yaml",
+        ".yml",
+        ".toml",
+        ".ini",
+        ".md",
+        ".mdx",
+        ".txt",
+        ".rst",
+        ".tex",
+        ".c",
+        ".cpp",
+        ".h",
+        ".hpp",
+        ".java",
+        ".cs",
+        ".php",
+        ".rb",
+        ".go",
+        ".rs",
+        ".swift",
+        ".kt",
+        ".scala",
+        ".sh",
+        ".bash",
+        ".zsh",
+        ".fish",
+        ".ps1",
+        ".bat",
+        ".sql",
+        ".r",
+        ".m",
+        ".pl",
+        ".lua",
+        ".dart",
+        ".Dockerfile",
+        ".gitignore",
+        ".gitattributes",
+        ".editorconfig",
+        ".prettierrc",
+        ".eslintrc",
+    }
+)
+
+# 扩展名 -> 代码块语言标记
+LANGUAGE_MAP = {
+    ".py": "python",
+    ".js": "javascript",
+    ".ts": "typescript",
+    ".jsx": "jsx",
+    ".tsx": "tsx",
+    ".html": "html",
+    ".css": "css",
+    ".scss": "scss",
+    ".json": "json",
+    ".yaml": "yaml",
+    ".yml": "yaml",
+    ".xml": "xml",
+    ".sh": "bash",
+    ".sql": "sql",
+    ".md": "markdown",
+    ".mdx": "mdx",
+}
+
+# 无后缀但应视为文本的文件名
+TEXT_FILENAMES = frozenset({"Makefile", "Dockerfile", "LICENSE", "README"})
+
+# 依赖锁文件：内容由包管理器生成，对理解项目几乎没有帮助
+LOCKFILE_NAMES = frozenset(
+    {
+        "package-lock.json",
+        "npm-shrinkwrap.json",
+        "yarn.lock",
+        "pnpm-lock.yaml",
+        "bun.lock",
+        "poetry.lock",
+        "pipfile.lock",
+        "pdm.lock",
+        "uv.lock",
+        "cargo.lock",
+        "composer.lock",
+        "gemfile.lock",
+        "podfile.lock",
+        "packages.lock.json",
+        "mix.lock",
+        "flake.lock",
+        "go.sum",
+    }
+)
+
+# 压缩代码与代码生成器输出的常见文件名后缀
+GENERATED_SUFFIXES = (
+    ".min.js",
+    ".min.mjs",
+    ".min.css",
+    ".bundle.js",
+    "_pb2.py",
+    "_pb2_grpc.py",
+    ".pb.go",
+    ".pb.cc",
+    ".pb.h",
+    ".g.dart",
+    ".freezed.dart",
+    ".designer.cs",
+)
+
+
+class _LazyRegex:
+    """首次使用时才编译的正则，接口与编译后的 Pattern 相同
+
+    模块级的规则表大多只在特定功能中用到，延迟编译让导入和 --help 不为它们付出开销。
+    """
+
+    def __init__(self, pattern, flags: int = 0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def __getattr__(self, name: str):
+        # 只有实例上还没有的属性才会走到这里；取到的方法缓存为实例属性，之后直接命中
+        if name.startswith("__"):
+            raise AttributeError(name)
+        value = getattr(re.compile(self.pattern, self.flags), name)
+        setattr(self, name, value)
+        return value
+
+
+GENERATED_PREFIX_SIZE = 8192  # 生成文件检测只读取开头这么多字节
+GENERATED_LINE_LENGTH = 1000  # 开头部分平均行长超过该值视为压缩代码
+GENERATED_HEADER_LINES = 20  # 生成标记只在文件开头连续的注释行（最多这么多行）中查找
+_HEADER_COMMENT_PREFIXES = (b"//", b"#", b"/*", b"*", b"<!--", b"--", b";", b"%")
+_GENERATED_MARKER_RE = _LazyRegex(
+    rb"@generated|DO NOT EDIT|Generated by the protocol buffer compiler|<auto-generated"
+)
+
+
+def _header_comment(prefix: bytes) -> bytes:
+    """文件开头连续的注释行（允许空行），遇到第一行代码或正文即停止"""
+    if prefix.startswith(b"\xef\xbb\xbf"):
+        prefix = prefix[3:]
+    header = []
+    for line in prefix.split(b"\n", GENERATED_HEADER_LINES)[:GENERATED_HEADER_LINES]:
+        stripped = line.strip()
+        if stripped and not stripped.startswith(_HEADER_COMMENT_PREFIXES):
+            break
+        header.append(line)
+    return b"\n".join(header)
+
+
+def generated_reason(name: str, prefix: bytes = None) -> str:
+    """判断文件是否为锁文件、压缩代码或自动生成的代码，返回原因（否则返回空字符串）
+
+    prefix 为文件开头的字节；为 None 时只按文件名判断。
+    """
+    lower = name.lower()
+    if lower in LOCKFILE_NAMES:
+        return "lockfile"
+    if lower.endswith(GENERATED_SUFFIXES):
+        return "minified" if ".min." in lower or ".bundle." in lower else "codegen"
+    if not prefix:
+        return ""
+    # 标记须出现在开头的注释中（如 Go 的 "// Code generated ... DO NOT EDIT."），
+    # 代码或正文里提到这些字样不算
+    if _GENERATED_MARKER_RE.search(_header_comment(prefix)):
+        return "marker"
+    if len(prefix) >= 1024 and len(prefix) / (prefix.count(b"\n") + 1) > GENERATED_LINE_LENGTH:
+        return "minified"
+    return ""
+
+
+class _NullTimer:
+    """统计关闭时使用的空计时器"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _StageTimer:
+    """记录单个阶段耗时的上下文管理器"""
+
+    __slots__ = ("stats", "name", "start")
+
+    def __init__(self, stats: "PackStats", name: str):
+        self.stats = stats
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class PackStats:
+    """打包过程的分阶段计时与计数器，关闭时几乎没有开销"""
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.timings: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {}
+        self.counters: Dict[str, int] = {}
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()  # 工作线程也会更新统计
+
+    def stage(self, name: str):
+        """返回阶段计时器（阶段耗时包含嵌套阶段）"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _StageTimer(self, name)
+
+    def add_time(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def incr(self, name: str, amount: int = 1) -> None:
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + amount
+
+    def to_dict(self) -> Dict[str, Any]:
+        """导出统计报告"""
+        return {
+            "duration": round(time.perf_counter() - self.started, 6),
+            "stages": {
+                name: {"seconds": round(seconds, 6), "calls": self.calls[name]}
+                for name, seconds in sorted(self.timings.items())
+            },
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+
+# 编码检测
+_BOMS = (
+    (b"\xff\xfe\x00\x00", "utf-32"),
+    (b"\x00\x00\xfe\xff", "utf-32"),
+    (b"\xef\xbb\xbf", "utf-8-sig"),
+    (b"\xff\xfe", "utf-16"),
+    (b"\xfe\xff", "utf-16"),
+)
+ENCODING_SAMPLE_SIZE = 64 * 1024  # 统计回退只检查开头这么多字节
+# 按行切片时换行符字节不会出现在多字节字符内部的编码
+_LINE_SAFE_ENCODINGS = frozenset({"utf-8", "gb18030", "cp1252", "latin-1"})
+_HIGH_BYTES = bytes(range(0x80, 0x100))
+_GB_PAIR = _LazyRegex(rb"[\xa1-\xfe][\xa1-\xfe]")
+
+
+def _decodes_prefix(sample: bytes, encoding: str) -> bool:
+    """sample 可能在多字节字符中间被截断，因此用增量解码器且不要求结束"""
+    import codecs
+
+    try:
+        codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def detect_encoding(data: bytes, truncated: bool = False) -> str:
+    """检测文件编码：BOM → UTF-8 校验快速路径 → 在有界样本上的统计回退
+
+    truncated 表示 data 只是文件开头的一段，末尾可能截断在多字节字符中间。
+    """
+    for bom, encoding in _BOMS:
+        if data.startswith(bom):
+            return encoding
+
+    if truncated:
+        if _decodes_prefix(data, "utf-8"):
+            return "utf-8"
+    else:
+        try:
+            data.decode("utf-8")
+            return "utf-8"
+        except UnicodeDecodeError:
+            pass
+
+    sample = data[:ENCODING_SAMPLE_SIZE]
+
+    # 无 BOM 的 UTF-16：以 ASCII 为主的文本在奇数或偶数位置上大量出现 NUL
+    half = len(sample) // 2
+    if half >= 2:
+        even_nul = sample[0::2].count(0)
+        odd_nul = sample[1::2].count(0)
+        if odd_nul > half * 0.3 and even_nul < half * 0.05:
+            return "utf-16-le"
+        if even_nul > half * 0.3 and odd_nul < half * 0.05:
+            return "utf-16-be"
+
+    # GBK/GB18030 的汉字是成对出现的高位字节，而 Latin-1 文本中的高位字节大多孤立出现
+    high = len(sample) - len(sample.translate(None, _HIGH_BYTES))
+    if high:
+        paired = 2 * len(_GB_PAIR.findall(sample))
+        if paired >= high * 0.6 and _decodes_prefix(sample, "gb18030"):
+            return "gb18030"
+
+    if _decodes_prefix(sample, "cp1252"):
+        return "cp1252"
+    return "latin-1"
+
+
+def _normalize_newlines(data: bytes) -> bytes:
+    if b"\r" in data:
+        data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    return data
+
+
+class PackCancelled(Exception):
+    """打包被取消（例如异步调用方取消或超时）"""
+
+
+class FileText(NamedTuple):
+    """解码后的文件内容"""
+
+    text: str
+    encoding: str
+    digest: str  # 原始字节的 blake2b 摘要
+
+
+def truncate_lines(content: str, max_lines: int = 500) -> str:
+    """保留首尾各一半行数，截断过长的文本"""
+    lines = content.split("\n")
+    if len(lines) <= max_lines:
+        return content
+
+    truncated_lines = (
+        lines[: max_lines // 2]
+        + [f"\n... (省略 {len(lines) - max_lines} 行) ...\n"]
+        + lines[-max_lines // 2 :]
+    )
+    return "\n".join(truncated_lines)
+
+
+def decode_text(data: bytes, encoding: str, max_lines: int = 500, max_chars: int = 10000) -> str:
+    """无损解码并截断过长内容；兼容 ASCII 的编码只解码需要保留的首尾行"""
+    if encoding == "utf-8-sig":
+        data, encoding = data[3:], "utf-8"
+
+    if encoding not in _LINE_SAFE_ENCODINGS:
+        text = data.decode(encoding).replace("\r\n", "\n").replace("\r", "\n")
+        if len(text) > max_chars:
+            return truncate_lines(text, max_lines)
+        return text
+
+    data = _normalize_newlines(data)
+    line_count = data.count(b"\n") + 1
+    # 字符数不超过 max_chars 时不截断；每个字符最多 4 字节，短文件直接完整解码后判断
+    if line_count <= max_lines or len(data) <= max_chars * 4:
+        text = data.decode(encoding)
+        if len(text) > max_chars:
+            return truncate_lines(text, max_lines)
+        return text
+
+    head_end = -1
+    for _ in range(max_lines // 2):
+        head_end = data.find(b"\n", head_end + 1)
+    tail_start = len(data)
+    for _ in range(-(-max_lines // 2)):
+        tail_start = data.rfind(b"\n", 0, tail_start)
+    head = data[:head_end].decode(encoding)
+    tail = data[tail_start + 1 :].decode(encoding)
+    return f"{head}\n\n... (省略 {line_count - max_lines} 行) ...\n\n{tail}"
+
+
+class _IgnoreMatcher:
+    """预编译的忽略规则：字面量走集合查找，通配符合并成一个正则并在首次匹配时才编译"""
+
+    __slots__ = ("literals", "globs", "_regex")
+
+    def __init__(self, patterns):
+        normcase = os.path.normcase
+        self.literals = set()
+        self.globs = []
+        for pattern in patterns:
+            if any(ch in pattern for ch in "*?["):
+                self.globs.append(normcase(pattern))
+            else:
+                self.literals.add(normcase(pattern))
+        self._regex = None
+
+    def _compile(self):
+        if self.globs:
+            combined = "|".join(f"(?:{fnmatch.translate(p)})" for p in self.globs)
+            self._regex = re.compile(combined).match
+        else:
+            self._regex = lambda _text: None
+
+    def match(self, name: str, full_path: str) -> bool:
+        """与 fnmatch 逐条匹配 name 与完整路径的结果一致"""
+        name = os.path.normcase(name)
+        full_path = os.path.normcase(full_path)
+        if name in self.literals or full_path in self.literals:
+            return True
+        if self._regex is None:
+            self._compile()
+        return self._regex(name) is not None or self._regex(full_path) is not None
+
+
+# 文件状态码（FileCatalog.status 列中存储的是下标）
+STATUS_NAMES = (
+    "unknown",
+    "included_high",  # 高优先级，已包含
+    "included_medium",  # 中优先级，已包含
+    "included_low",  # 低优先级，已包含
+    "skipped_ignored",  # 被忽略
+    "skipped_binary",  # 二进制文件
+    "skipped_large",  # 文件过大
+    "skipped_limit",  # 超出数量/大小限制
+    "skipped_generated",  # 锁文件、压缩或自动生成的代码
+)
+STATUS_CODES = {name: code for code, name in enumerate(STATUS_NAMES)}
+INCLUDED_CODES = frozenset(
+    code for code, name in enumerate(STATUS_NAMES) if name.startswith("included")
+)
+
+# 摘要树中每个目录最多单独显示的折叠子目录数，超出部分并入“其余”行
+TREE_SUMMARY_DIRS = 10
+TREE_CHUNK_LINES = 512  # 流式输出文件树时每块的行数
+
+# 条目标志位（FileCatalog.flags 列）
+FLAG_DIR = 1  # 目录（含指向目录的软链接）
+FLAG_SYMLINK = 2  # 软链接
+FLAG_CYCLE = 4  # 指向祖先目录的软链接，不展开
+FLAG_ALIAS = 8  # 目录已在别处展开，target 列指向展开它的条目
+FLAG_BROKEN = 16  # 失效的软链接
+
+
+def format_size(size: int) -> str:
+    """把字节数格式化为便于阅读的大小"""
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+
+def _dir_key(st: os.stat_result, path: str):
+    """目录身份标识：(st_dev, st_ino)；文件系统不提供 inode 时退回真实路径"""
+    if st.st_ino:
+        return (st.st_dev, st.st_ino)
+    return os.path.realpath(path)
+
+
+# FileCatalog 中每个条目一个值的数值列
+CATALOG_COLUMNS = (
+    "name",
+    "parent",
+    "flags",
+    "size",
+    "mtime",
+    "status",
+    "priority",
+    "score",
+    "child_start",
+    "child_count",
+    "target",
+)
+SPILLED_PREFIX_CACHE = 4096  # 目录移到磁盘后最多缓存的目录路径前缀数
+SPILL_CHUNK = 1024  # 目录移到磁盘后，每列在内存中最多缓冲这么多个新条目再追加到文件
+
+
+class _ColumnFile:
+    """遍历期间移到临时文件的数值列：新条目先缓冲在内存尾部，攒满后追加到文件
+
+    已写出的条目仍可按下标读写（遍历时只会改动少量目录条目），遍历结束后 map() 把整列
+    映射为与 array 用法相同的 memoryview。
+    """
+
+    __slots__ = ("typecode", "itemsize", "file", "flushed", "tail")
+
+    def __init__(self, typecode: str, values=()):
+        import tempfile
+
+        self.typecode = typecode
+        self.tail = array(typecode)
+        self.itemsize = self.tail.itemsize
+        self.file = tempfile.TemporaryFile()
+        if isinstance(values, array):
+            values.tofile(self.file)  # 按块写出，不复制整列
+            self.flushed = len(values)
+        else:
+            self.flushed = 0
+            for value in values:
+                self.append(value)
+
+    def __len__(self) -> int:
+        return self.flushed + len(self.tail)
+
+    def append(self, value) -> None:
+        tail = self.tail
+        tail.append(value)
+        if len(tail) >= SPILL_CHUNK:
+            self.file.seek(0, os.SEEK_END)
+            tail.tofile(self.file)
+            self.flushed += len(tail)
+            del tail[:]
+
+    def __getitem__(self, index: int):
+        if index < 0:
+            index += len(self)
+        if index >= self.flushed:
+            return self.tail[index - self.flushed]
+        self.file.seek(index * self.itemsize)
+        return array(self.typecode, self.file.read(self.itemsize))[0]
+
+    def __setitem__(self, index: int, value) -> None:
+        if index < 0:
+            index += len(self)
+        if index >= self.flushed:
+            self.tail[index - self.flushed] = value
+        else:
+            self.file.seek(index * self.itemsize)
+            self.file.write(array(self.typecode, [value]).tobytes())
+
+    def size_on_disk(self) -> int:
+        return len(self) * self.itemsize
+
+    def map(self):
+        """写出剩余条目并把整列映射为 memoryview（空列返回 array）"""
+        import mmap
+
+        self.file.seek(0, os.SEEK_END)
+        self.tail.tofile(self.file)
+        self.flushed += len(self.tail)
+        self.tail = array(self.typecode)
+        self.file.flush()
+        length = self.flushed * self.itemsize
+        try:
+            if not length:
+                return array(self.typecode)
+            return memoryview(mmap.mmap(self.file.fileno(), length)).cast(self.typecode)
+        finally:
+            self.file.close()
+
+
+class _SpilledSegments:
+    """映射到磁盘的名称表：按片段 id 从字节块中解码"""
+
+    __slots__ = ("blob", "offsets")
+
+    def __init__(self, blob: memoryview, offsets: memoryview):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return str(self.blob[start:end], "utf-8", "surrogateescape")
+
+
+class _DirKeys:
+    """遍历期间已展开目录的身份表：目录身份 -> 展开该目录的条目下标
+
+    平时是内存中的 dict；目录移到磁盘时一并移入 SQLite 的私有临时数据库（页缓存有上限，
+    其余在磁盘上，关闭即删除），之后逐条按主键查询，内存占用不再随目录数增长。
+    """
+
+    __slots__ = ("keys", "db")
 
-class ContextPacker:
     def __init__(self):
-        self.follow_symlinks = True  # 是否跟随软链接
-        self.visited_paths = set()  # 防止循环引用
-        self.default_ignore_patterns = {
-            # 版本控制
-            ".git",
-            ".svn",
-            ".hg",
-            # 依赖管理
-            "node_modules",
-            "venv",
-            "env",
-            "__pycache__",
-            ".pytest_cache",
-            "vendor",
-            "target",
-            "build",
-            "dist",
-            ".next",
-            ".nuxt",
-            # IDE和编辑器
-            ".vscode",
-            ".idea",
-            "*.swp",
-            "*.swo",
-            "*~",
-            # 操作系统
-            ".DS_Store",
-            "Thumbs.db",
-            "desktop.ini",
-            # 日志和缓存
-            "*.log",
-            "*.tmp",
-            ".cache",
-            ".temp",
-            # 编译产物
-            "*.pyc",
-            "*.pyo",
-            "*.class",
-            "*.o",
-            "*.so",
-            "*.dll",
-            # 大文件类型
-            "*.zip",
-            "*.tar.gz",
-            "*.rar",
-            "*.7z",
-            "*.pdf",
-            "*.mp4",
-            "*.avi",
-            "*.mov",
-            "*.mp3",
-            "*.wav",
-            "*.jpg",
-            "*.jpeg",
-            "*.png",
-            "*.gif",
-            "*.bmp",
-            "*.svg",
-            # 配置文件
-            ".env",
-            ".env.local",
-            ".env.production",
-            # 避免自循环
-            "project_context.md",
-            "*_context.md",
+        self.keys: Dict[Any, int] = {}
+        self.db = None
+
+    def __len__(self) -> int:
+        return len(self.keys)  # 只计内存中的条目
+
+    @staticmethod
+    def _text(key) -> str:
+        # (st_dev, st_ino) 写成 "设备:inode"，真实路径加前缀，二者不会相同
+        if isinstance(key, tuple):
+            return f"{key[0]}:{key[1]}"
+        return f"/{key}"
+
+    def get(self, key):
+        if self.db is None:
+            return self.keys.get(key)
+        row = self.db.execute("SELECT entry FROM dirs WHERE key = ?", (self._text(key),)).fetchone()
+        return None if row is None else row[0]
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __setitem__(self, key, index: int) -> None:
+        if self.db is None:
+            self.keys[key] = index
+        else:
+            self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (self._text(key), index))
+
+    def spill(self) -> None:
+        import sqlite3
+
+        if self.db is not None:
+            return
+        self.db = sqlite3.connect("")  # 空文件名即临时数据库
+        self.db.execute("CREATE TABLE dirs (key TEXT PRIMARY KEY, entry INTEGER) WITHOUT ROWID")
+        self.db.executemany(
+            "INSERT INTO dirs VALUES (?, ?)", ((self._text(k), v) for k, v in self.keys.items())
+        )
+        self.keys = {}
+
+    def close(self) -> None:
+        self.keys = {}
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+class FileCatalog:
+    """列式文件目录：每个条目只占各数组中的一个槽位，而不是一个 dict 加若干 Path 对象
+
+    同一目录的子条目连续存放且已排序，目录通过 child_start/child_count 指向子条目区间；
+    路径片段统一驻留在 segments 中，条目只保存片段 id 与父条目下标。
+    """
+
+    def __init__(self, root_path: Path):
+        self.root_path = root_path
+        self.root = str(root_path)
+        self.segments: List[str] = []
+        self._segment_ids: Dict[str, int] = {}
+        self.name = array("l")
+        self.parent = array("l")
+        self.flags = array("B")
+        self.size = array("q")
+        self.mtime = array("q")
+        self.status = array("B")
+        self.priority = array("b")
+        self.score = array("d")  # 排序分数，越小越优先
+        self.child_start = array("l")
+        self.child_count = array("l")
+        self.target = array("l")
+        # 目录身份 -> 展开它的条目下标（根目录为 -1），只在遍历期间存在
+        self.dir_keys = _DirKeys()
+        self.root_start = 0
+        self.root_count = 0
+        self.root_error = False
+        self.included = array("l")  # 已包含条目，按输出顺序排列
+        self.ignored_count = 0
+        self.depth_pruned = 0
+        self.digests: Dict[int, str] = {}  # 已包含条目 -> 内容摘要（渲染时填充）
+        self.reducers: Dict[int, str] = {}  # 需要归约的条目 -> 归约方式
+        # 近似重复的文件 -> (代表文件, 估计相似度)；代表文件的内容渲染时暂存在 rep_texts，
+        # rep_members 记录每个代表文件还有几个成员未渲染，全部渲染后释放其内容
+        self.near_dup: Dict[int, Tuple[int, float]] = {}
+        self.rep_texts: Dict[int, Any] = {}
+        self.rep_members: Dict[int, int] = {}
+        self.rep_text_bytes = 0
+        self.rep_lock = threading.Lock()  # 渲染线程并发读写上面三项
+        self.head_only: Dict[int, int] = {}  # 只输出开头几行的生成文件 -> 计入总大小的字节数
+        # 只输出选中片段的文件 -> (合并后的行范围, 估计字节数, 已解析的选择器说明)
+        self.slices: Dict[int, Tuple[List[Tuple[int, int]], int, str]] = {}
+        self._dir_prefixes: Dict[int, str] = {-1: ""}
+        self._segment_bytes = 0  # 名称表中字符串的估计内存占用
+        self.spilled = False  # 数值列与名称表是否已移到磁盘
+        self._name_blob = None  # 遍历期间移到磁盘时，名称按追加顺序写入的临时文件
+        self._name_offsets = None
+        self._name_position = 0
+
+    def __len__(self) -> int:
+        return len(self.name)
+
+    def memory_usage(self) -> int:
+        """粗略估算目录占用的内存（字节）：数值列、名称表与各索引字典"""
+        total = 100 * (len(self.dir_keys or ()) + len(self._dir_prefixes))
+        if self.spilled:
+            return total + SPILL_CHUNK * 8 * (len(CATALOG_COLUMNS) + 1)
+        for column in CATALOG_COLUMNS:
+            values = getattr(self, column)
+            total += len(values) * values.itemsize
+        return total + self._segment_bytes + 100 * len(self._segment_ids)
+
+    def spill(self) -> int:
+        """把数值列和名称表移到临时文件，返回移出的字节数（可在遍历过程中调用）
+
+        之后追加的条目只在内存中缓冲 SPILL_CHUNK 个就写入文件，名称不再驻留去重；
+        遍历结束后 finish() 把各列映射为 memoryview，用法与 array 相同。映射页由内核按需
+        换入、在内存紧张时直接丢弃，不再是常驻内存。
+        """
+        import tempfile
+
+        if self.spilled:
+            return 0
+        moved = 0
+        for column in CATALOG_COLUMNS:
+            values = getattr(self, column)
+            moved += len(values) * values.itemsize
+            setattr(self, column, _ColumnFile(values.typecode, values))
+            values = None
+        blob = tempfile.TemporaryFile()
+        offsets = _ColumnFile("q", [0])
+        position = 0
+        for segment in self.segments:
+            data = segment.encode("utf-8", "surrogateescape")
+            blob.write(data)
+            position += len(data)
+            offsets.append(position)
+        moved += position + len(offsets) * 8
+        self._name_blob, self._name_offsets, self._name_position = blob, offsets, position
+        self.segments = None
+        self._segment_ids = None
+        self._segment_bytes = 0
+        self._dir_prefixes = {-1: ""}
+        if self.dir_keys is not None:
+            self.dir_keys.spill()
+        self.spilled = True
+        return moved
+
+    def finish(self) -> int:
+        """遍历结束：已移到磁盘的列映射为 memoryview，返回磁盘上的总字节数"""
+        if not self.spilled or self._name_blob is None:
+            return 0
+        import mmap
+
+        total = self._name_position
+        for column in CATALOG_COLUMNS:
+            values = getattr(self, column)
+            total += values.size_on_disk()
+            setattr(self, column, values.map())
+        total += self._name_offsets.size_on_disk()
+        offsets = self._name_offsets.map()
+        blob = self._name_blob
+        blob.flush()
+        if self._name_position:
+            view = memoryview(mmap.mmap(blob.fileno(), self._name_position))
+        else:
+            view = memoryview(b"")
+        blob.close()
+        self.segments = _SpilledSegments(view, offsets)
+        self._name_blob = self._name_offsets = None
+        return total
+
+    def add(self, name: str, parent: int, flags: int, size: int = 0, mtime: int = 0) -> int:
+        """追加一个条目并返回其下标"""
+        if self.spilled:
+            data = name.encode("utf-8", "surrogateescape")
+            self._name_blob.write(data)
+            self._name_position += len(data)
+            segment = len(self._name_offsets) - 1
+            self._name_offsets.append(self._name_position)
+        else:
+            segment = self._segment_ids.get(name)
+            if segment is None:
+                segment = self._segment_ids[name] = len(self.segments)
+                self.segments.append(name)
+                self._segment_bytes += len(name) + 56
+        self.name.append(segment)
+        self.parent.append(parent)
+        self.flags.append(flags)
+        self.size.append(size)
+        self.mtime.append(mtime)
+        self.status.append(0)
+        self.priority.append(-1)
+        self.score.append(0.0)
+        self.child_start.append(0)
+        self.child_count.append(0)
+        self.target.append(-1)
+        return len(self.name) - 1
+
+    def set_children(self, parent: int, start: int, count: int) -> None:
+        """记录目录的子条目区间（parent 为 -1 表示根目录）"""
+        if parent < 0:
+            self.root_start, self.root_count = start, count
+        else:
+            self.child_start[parent] = start
+            self.child_count[parent] = count
+
+    def aggregate(self) -> Tuple[array, array, array]:
+        """自底向上一次遍历，统计每个目录下的文件数、字节数与已收录文件数
+
+        子条目的下标总是大于父条目，因此逆序遍历即可保证先处理完子条目。
+        """
+        count = len(self)
+        files = array("l", [0]) * count
+        total_bytes = array("q", [0]) * count
+        included = array("l", [0]) * count
+        flags = self.flags
+        parent = self.parent
+        for index in range(count - 1, -1, -1):
+            if not flags[index] & FLAG_DIR:
+                files[index] = 1
+                total_bytes[index] = self.size[index]
+                included[index] = 1 if self.status[index] in INCLUDED_CODES else 0
+            up = parent[index]
+            if up >= 0:
+                files[up] += files[index]
+                total_bytes[up] += total_bytes[index]
+                included[up] += included[index]
+        return files, total_bytes, included
+
+    def is_ancestor(self, ancestor: int, index: int) -> bool:
+        """ancestor 是否为 index 自身或其祖先（-1 表示根目录）"""
+        while index >= 0:
+            if index == ancestor:
+                return True
+            index = self.parent[index]
+        return ancestor == -1
+
+    def entry_name(self, index: int) -> str:
+        return self.segments[self.name[index]]
+
+    def _dir_prefix(self, index: int) -> str:
+        # 渲染线程会并发调用；缓存只通过替换属性来清空，本次调用始终使用同一个字典
+        prefixes = self._dir_prefixes
+        prefix = prefixes.get(index)
+        if prefix is None:
+            chain = []
+            while index not in prefixes:
+                chain.append(index)
+                index = self.parent[index]
+            prefix = prefixes[index]
+            for node in reversed(chain):
+                prefix = prefix + self.segments[self.name[node]] + os.sep
+                prefixes[node] = prefix
+            if self.spilled and len(prefixes) > SPILLED_PREFIX_CACHE:
+                self._dir_prefixes = {-1: ""}
+        return prefix
+
+    def relpath(self, index: int) -> str:
+        """条目相对项目根目录的路径"""
+        return self._dir_prefix(self.parent[index]) + self.segments[self.name[index]]
+
+    def full_path(self, index: int) -> str:
+        return os.path.join(self.root, self.relpath(index))
+
+    def status_name(self, index: int) -> str:
+        return STATUS_NAMES[self.status[index]]
+
+    def set_status(self, index: int, status: str) -> None:
+        self.status[index] = STATUS_CODES[status]
+
+    def iter_tree_status(self) -> Iterator[Tuple[str, str]]:
+        """逐条产出全部条目的 (相对路径, 状态)，目录路径以 / 结尾（用于清单和结构对比）"""
+        for i, flags in enumerate(self.flags):
+            yield self.relpath(i) + ("/" if flags & FLAG_DIR else ""), STATUS_NAMES[self.status[i]]
+
+    def tree_status(self) -> Dict[str, str]:
+        """按相对路径导出全部条目的状态（用于调试和测试）"""
+        return dict(self.iter_tree_status())
+
+    def file_status(self) -> Dict[str, str]:
+        """按相对路径导出非 unknown 的文件状态（用于调试和测试）"""
+        return {self.relpath(i): STATUS_NAMES[code] for i, code in enumerate(self.status) if code}
+
+
+# 与项目入口文件一起修改是较强的相关性信号
+ENTRY_FILE_NAMES = frozenset(
+    {
+        "package.json",
+        "requirements.txt",
+        "cargo.toml",
+        "pyproject.toml",
+        "setup.py",
+        "main.py",
+        "__main__.py",
+        "app.py",
+        "index.js",
+        "index.ts",
+        "main.go",
+        "main.rs",
+        "lib.rs",
+    }
+)
+GIT_PRIORITY_WEIGHT = 1.5  # 历史热度最多能把文件提前约 1.5 个优先级档位
+
+
+def is_entry_file(path: str) -> bool:
+    """按文件名判断是否为项目入口文件（README、清单文件、主程序等）"""
+    name = path.rsplit("/", 1)[-1].lower()
+    return name.startswith("readme") or name in ENTRY_FILE_NAMES
+
+
+def default_cache_dir() -> str:
+    """默认缓存目录：$XDG_CACHE_HOME/context-packer 或 ~/.cache/context-packer"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "context-packer")
+
+
+class GitHistoryIndex:
+    """本地 git 历史的文件热度索引
+
+    首次使用时读取一次完整历史，之后只从上次看到的提交增量更新；索引按仓库缓存在
+    cache_dir 中，给文件打分只是一次字典查找，不会为每个文件遍历历史。
+    """
+
+    VERSION = 1
+    HALF_LIFE = 90 * 86400  # 最近修改信号的半衰期（秒）
+
+    def __init__(self, toplevel: str):
+        self.toplevel = toplevel
+        self.head = None
+        self.head_time = 0
+        # 仓库内路径 -> [最后修改时间, 修改次数, 与入口文件共同修改的次数]
+        self.files: Dict[str, List[int]] = {}
+        self._max_churn = 0
+        self._max_cochange = 0
+
+    @staticmethod
+    def _git(cwd: str, *args: str) -> str:
+        import subprocess
+
+        result = subprocess.run(
+            ["git", "-c", "core.quotePath=false", "-C", cwd, *args],
+            capture_output=True,
+            check=True,
+            encoding="utf-8",
+            errors="surrogateescape",
+        )
+        return result.stdout
+
+    @classmethod
+    def open(cls, path: str, cache_dir: str = None, stats: PackStats = None):
+        """打开 path 所在仓库的索引并同步到 HEAD；不在 git 仓库中时返回 None"""
+        import subprocess
+
+        try:
+            toplevel = cls._git(path, "rev-parse", "--show-toplevel").strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+        index = cls(toplevel)
+        cache_path = None
+        if cache_dir:
+            import hashlib
+
+            name = hashlib.blake2b(toplevel.encode("utf-8"), digest_size=8).hexdigest()
+            cache_path = os.path.join(cache_dir, "git-history", f"{name}.json")
+            index._load(cache_path)
+
+        try:
+            changed = index.update(stats)
+        except (OSError, subprocess.CalledProcessError):
+            return None  # 空仓库等情况
+        if changed and cache_path:
+            index._save(cache_path)
+        index._finalize()
+        return index
+
+    def update(self, stats: PackStats = None) -> bool:
+        """从上次看到的提交增量读取新历史；历史被改写时重新全量读取"""
+        import subprocess
+
+        head = self._git(self.toplevel, "rev-parse", "HEAD").strip()
+        if head == self.head:
+            if stats is not None:
+                stats.incr("git_index_hit")
+            return False
+
+        revisions = head
+        if self.head:
+            try:
+                self._git(self.toplevel, "merge-base", "--is-ancestor", self.head, head)
+                revisions = f"{self.head}..{head}"
+            except subprocess.CalledProcessError:
+                self.files = {}
+        if stats is not None:
+            stats.incr("git_index_miss")
+
+        log = self._git(
+            self.toplevel, "log", "--no-renames", "--name-only", "--format=%x00%ct", revisions
+        )
+        commits = log.split("\x00")[1:]
+        for position, chunk in enumerate(commits):
+            lines = chunk.split("\n")
+            timestamp = int(lines[0])
+            if position == 0:
+                self.head_time = timestamp  # git log 从 HEAD 开始输出
+            paths = [line for line in lines[1:] if line]
+            touches_entry = any(is_entry_file(p) for p in paths)
+            for path in paths:
+                record = self.files.get(path)
+                if record is None:
+                    record = self.files[path] = [0, 0, 0]
+                record[0] = max(record[0], timestamp)
+                record[1] += 1
+                if touches_entry and not is_entry_file(path):
+                    record[2] += 1
+        if stats is not None:
+            stats.incr("git_commits_read", len(commits))
+
+        self.head = head
+        return True
+
+    def _finalize(self) -> None:
+        self._max_churn = max((r[1] for r in self.files.values()), default=0)
+        self._max_cochange = max((r[2] for r in self.files.values()), default=0)
+
+    def score(self, path: str) -> float:
+        """仓库内路径的历史热度，0（无记录）到 1（最近、频繁且与入口文件一起修改）"""
+        import math
+
+        record = self.files.get(path)
+        if record is None:
+            return 0.0
+        last_time, churn, cochange = record
+        recency = 0.5 ** (max(0, self.head_time - last_time) / self.HALF_LIFE)
+        churn_score = math.log1p(churn) / math.log1p(self._max_churn) if self._max_churn else 0.0
+        cochange_score = (
+            math.log1p(cochange) / math.log1p(self._max_cochange) if self._max_cochange else 0.0
+        )
+        return 0.5 * recency + 0.3 * churn_score + 0.2 * cochange_score
+
+    def prefix_for(self, root: str) -> str:
+        """项目根目录相对仓库根目录的路径前缀（git 路径格式）"""
+        relative = os.path.relpath(os.path.realpath(root), os.path.realpath(self.toplevel))
+        if relative == ".":
+            return ""
+        return relative.replace(os.sep, "/") + "/"
+
+    def _load(self, cache_path: str) -> None:
+        import json
+
+        try:
+            with open(cache_path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") == self.VERSION and data.get("toplevel") == self.toplevel:
+            self.head = data["head"]
+            self.head_time = data["head_time"]
+            self.files = data["files"]
+
+    def _save(self, cache_path: str) -> None:
+        import json
+
+        data = {
+            "version": self.VERSION,
+            "toplevel": self.toplevel,
+            "head": self.head,
+            "head_time": self.head_time,
+            "files": self.files,
         }
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8", errors="surrogateescape") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+
+
+_IDENTIFIER_RE = _LazyRegex(r"[A-Za-z][A-Za-z0-9]*")
+_CAMEL_RE = _LazyRegex(r"[A-Z]+[0-9]*(?![a-z])|[A-Z]?[a-z]+[0-9]*")
+# 查询中不携带信息的常见词
+QUERY_STOPWORDS = frozenset(
+    {"a", "an", "and", "for", "in", "is", "of", "on", "or", "the", "to", "with", "add", "fix"}
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """拆分标识符为小写词项：snake_case、camelCase、HTTPServer 都会被拆开，数字跟随前一个词"""
+    tokens = []
+    for identifier in _IDENTIFIER_RE.findall(text):
+        for part in _CAMEL_RE.findall(identifier):
+            if len(part) > 1:
+                tokens.append(part.lower())
+    return tokens
+
+
+class QueryIndex:
+    """本地 BM25 倒排索引（SQLite）
+
+    文档为候选文件，词项来自路径片段（加权）与文件内容中的标识符和注释。
+    索引按文件 (size, mtime) 签名增量更新；打分在一条聚合 SQL 中完成，
+    查询只读取命中词项的倒排记录。
+    """
+
+    VERSION = 1
+    K1 = 1.2
+    B = 0.75
+    PATH_WEIGHT = 3  # 路径中的词项按出现 3 次计
+
+    def __init__(self, db_path: str = ":memory:"):
+        import sqlite3
+
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+            CREATE TABLE IF NOT EXISTS docs (
+                id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime INTEGER,
+                length INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT, doc INTEGER, tf INTEGER, PRIMARY KEY (term, doc)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc);
+            """)
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != self.VERSION:
+            self.db.executescript("DELETE FROM postings; DELETE FROM docs;")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (self.VERSION,))
+
+    @classmethod
+    def open(cls, root: str, cache_dir: str = None) -> "QueryIndex":
+        """打开项目的索引：有 cache_dir 时持久化到磁盘，否则只在内存中"""
+        if not cache_dir:
+            return cls()
+        import hashlib
+        import sqlite3
+
+        name = hashlib.blake2b(os.path.realpath(root).encode("utf-8"), digest_size=8).hexdigest()
+        directory = os.path.join(cache_dir, "query-index")
+        try:
+            os.makedirs(directory, exist_ok=True)
+            return cls(os.path.join(directory, f"{name}.sqlite"))
+        except (OSError, sqlite3.Error):
+            return cls()
+
+    def close(self) -> None:
+        self.db.close()
+
+    @classmethod
+    def document_terms(cls, rel_path: str, text: str) -> Dict[str, int]:
+        """文档的词频表"""
+        counts: Dict[str, int] = {}
+        for term in tokenize(rel_path):
+            counts[term] = counts.get(term, 0) + cls.PATH_WEIGHT
+        for term in tokenize(text):
+            counts[term] = counts.get(term, 0) + 1
+        return counts
+
+    def sync(
+        self,
+        documents: Iterator[Tuple[str, str, int, int]],
+        stats: PackStats = None,
+        max_bytes: int = None,
+        cancel: threading.Event = None,
+    ) -> int:
+        """让索引与当前文档集合一致，只重建签名变化的文件，返回重建的文件数
+
+        documents 逐个产出 (相对路径, 完整路径, size, mtime)；
+        max_bytes 限制每个文件读取并分词的字节数，超出部分不进入索引；
+        cancel 置位时抛出 PackCancelled，本次的更新整体回滚。
+        已有签名逐个按路径查询，本次见到的文档记在临时表中，内存占用与文档数无关。
+        """
+        db = self.db
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS seen_docs (id INTEGER PRIMARY KEY)")
+        db.execute("DELETE FROM seen_docs")
+        total = updated = 0
+        with db:
+            for rel_path, full_path, size, mtime in documents:
+                total += 1
+                entry = db.execute(
+                    "SELECT id, size, mtime FROM docs WHERE path = ?", (rel_path,)
+                ).fetchone()
+                if entry is not None:
+                    db.execute("INSERT OR IGNORE INTO seen_docs VALUES (?)", (entry[0],))
+                    if entry[1] == size and entry[2] == mtime:
+                        continue
+                if cancel is not None and cancel.is_set():
+                    raise PackCancelled("打包已取消")
+                try:
+                    with open(full_path, "rb") as f:
+                        data = f.read(-1 if max_bytes is None else max_bytes)
+                except OSError:
+                    continue
+                truncated = max_bytes is not None and size > max_bytes
+                if truncated and stats is not None:
+                    stats.incr("query_index_truncated")
+                text = data.decode(detect_encoding(data, truncated), errors="replace")
+                counts = self.document_terms(rel_path, text)
+                length = sum(counts.values())
+                if entry is not None:
+                    doc_id = entry[0]
+                    db.execute("DELETE FROM postings WHERE doc = ?", (doc_id,))
+                    db.execute(
+                        "UPDATE docs SET size = ?, mtime = ?, length = ? WHERE id = ?",
+                        (size, mtime, length, doc_id),
+                    )
+                else:
+                    doc_id = db.execute(
+                        "INSERT INTO docs (path, size, mtime, length) VALUES (?, ?, ?, ?)",
+                        (rel_path, size, mtime, length),
+                    ).lastrowid
+                    db.execute("INSERT INTO seen_docs VALUES (?)", (doc_id,))
+                db.executemany(
+                    "INSERT INTO postings VALUES (?, ?, ?)",
+                    ((term, doc_id, tf) for term, tf in counts.items()),
+                )
+                updated += 1
+            # 已删除或不再是候选的文件
+            db.execute(
+                "DELETE FROM postings WHERE doc IN "
+                "(SELECT id FROM docs WHERE id NOT IN (SELECT id FROM seen_docs))"
+            )
+            db.execute("DELETE FROM docs WHERE id NOT IN (SELECT id FROM seen_docs)")
+            db.execute("DELETE FROM seen_docs")
+        if stats is not None:
+            stats.incr("query_index_updated", updated)
+            stats.incr("query_index_reused", total - updated)
+        return updated
+
+    def search(self, query: str) -> Dict[str, float]:
+        """返回 路径 -> BM25 分数（只包含命中查询词项的文件）"""
+        import math
+
+        terms = sorted({t for t in tokenize(query) if t not in QUERY_STOPWORDS})
+        if not terms:
+            return {}
+        db = self.db
+        total, average = db.execute("SELECT COUNT(*), AVG(length) FROM docs").fetchone()
+        if not total:
+            return {}
+        placeholders = ",".join("?" * len(terms))
+        weights = [
+            (term, math.log(1 + (total - df + 0.5) / (df + 0.5)))
+            for term, df in db.execute(
+                f"SELECT term, COUNT(*) FROM postings WHERE term IN ({placeholders}) GROUP BY term",
+                terms,
+            )
+        ]
+        if not weights:
+            return {}
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS query_terms (term TEXT PRIMARY KEY, idf REAL)")
+        db.execute("DELETE FROM query_terms")
+        db.executemany("INSERT INTO query_terms VALUES (?, ?)", weights)
+        k1, b = self.K1, self.B
+        # CROSS JOIN 固定连接顺序：从查询词项出发按主键查倒排记录，而不是扫描整个倒排表
+        rows = db.execute(
+            """
+            SELECT d.path, SUM(q.idf * p.tf * (? + 1) / (p.tf + ? * (1 - ? + ? * d.length / ?)))
+            FROM query_terms q
+            CROSS JOIN postings p ON p.term = q.term
+            JOIN docs d ON d.id = p.doc
+            GROUP BY p.doc
+            """,
+            (k1, k1, b, b, average),
+        )
+        return dict(rows)
+
+
+class VerdictCache:
+    """逐文件判定结果（编码、生成文件原因）的持久化缓存（每个项目一个 SQLite 文件）
+
+    按 (种类, 完整路径) 存储并附带 (size, mtime) 签名，签名不一致即视为未命中。
+    查询逐条走主键，不把整张表读入内存；写入先攒在内存里，攒够一批才提交。
+    数据库在真正需要时才连接：项目还没有缓存文件时，未命中的判定不足 FLUSH_ROWS 条
+    （小项目）就不创建文件，也不导入 sqlite3。每次使用或写入都会记下本次运行的编号，
+    完整打包结束时删除本次没有用到的条目（已删除、改名或被忽略的文件）。
+    检测逻辑变化时提高 VERSION，旧的判定会被整体丢弃。
+    """
+
+    VERSION = 2
+    FLUSH_ROWS = 512  # 攒够这么多条写入就提交一次；也是创建缓存文件的门槛
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.db = None
+        self.run = 0
+        self._exists = os.path.exists(db_path)
+        self._errors = ()  # 连接后为 sqlite3.Error
+        self._lock = threading.Lock()  # 渲染线程共用同一个连接
+        self._pending: List[Tuple[str, bytes, int, int, str]] = []
+        self._touched: List[Tuple[str, bytes]] = []  # 本次命中的条目，提交时更新运行编号
+
+    @classmethod
+    def open(cls, root: str, cache_dir: str) -> "VerdictCache":
+        """项目的判定缓存；只确定文件位置，不连接数据库"""
+        import hashlib
+
+        name = hashlib.blake2b(os.path.realpath(root).encode("utf-8"), digest_size=8).hexdigest()
+        return cls(os.path.join(cache_dir, "verdicts", f"{name}.sqlite"))
+
+    def _connect(self) -> bool:
+        """连接（必要时创建）数据库并开始新一次运行；失败时不再尝试"""
+        if self.db is not None:
+            return True
+        if self.db_path is None:
+            return False
+        import sqlite3
+
+        try:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            db = sqlite3.connect(self.db_path, check_same_thread=False)
+            db.executescript("""
+                PRAGMA journal_mode = WAL;
+                PRAGMA synchronous = NORMAL;
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+                CREATE TABLE IF NOT EXISTS verdicts (
+                    kind TEXT, path BLOB, size INTEGER, mtime INTEGER, value TEXT, run INTEGER,
+                    PRIMARY KEY (kind, path)
+                ) WITHOUT ROWID;
+                """)
+            with db:
+                meta = dict(db.execute("SELECT key, value FROM meta"))
+                if meta.get("version") != self.VERSION:
+                    db.execute("DELETE FROM verdicts")
+                    meta["run"] = 0
+                self.run = meta.get("run", 0) + 1
+                db.executemany(
+                    "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                    (("version", self.VERSION), ("run", self.run)),
+                )
+        except (OSError, sqlite3.Error):
+            self.db_path = None
+            return False
+        self.db = db
+        self._errors = sqlite3.Error
+        return True
+
+    def get(self, kind: str, path: str, signature: Tuple[int, int]) -> str:
+        """签名一致时返回缓存的判定，否则返回 None"""
+        if not self._exists:
+            return None
+        key = path.encode("utf-8", "surrogateescape")
+        with self._lock:
+            if not self._connect():
+                return None
+            try:
+                row = self.db.execute(
+                    "SELECT size, mtime, value FROM verdicts WHERE kind = ? AND path = ?",
+                    (kind, key),
+                ).fetchone()
+            except self._errors:
+                return None  # 缓存读取失败按未命中处理
+            if row is None or (row[0], row[1]) != signature:
+                return None
+            self._touched.append((kind, key))
+            if len(self._touched) >= self.FLUSH_ROWS:
+                self._flush()
+        return row[2]
+
+    def touch(self, kind: str, path: str) -> None:
+        """记下内存缓存命中的条目在本次运行中仍被使用，避免被清理"""
+        if not self._exists:
+            return
+        with self._lock:
+            self._touched.append((kind, path.encode("utf-8", "surrogateescape")))
+            if len(self._touched) >= self.FLUSH_ROWS:
+                self._flush()
+
+    def put(self, kind: str, path: str, signature: Tuple[int, int], value: str) -> None:
+        key = path.encode("utf-8", "surrogateescape")
+        with self._lock:
+            self._pending.append((kind, key, signature[0], signature[1], value))
+            if len(self._pending) >= self.FLUSH_ROWS:
+                self._flush()
+
+    def flush(self, prune: bool = False) -> None:
+        """提交攒下的判定；prune 为 True 时删除本次运行没有用到的条目"""
+        with self._lock:
+            if self.db is None and not self._exists:
+                # 小项目：判定不足一批，不值得为它创建缓存文件
+                self._pending.clear()
+                return
+            self._flush()
+            if prune and self.db is not None:
+                try:
+                    with self.db:
+                        self.db.execute("DELETE FROM verdicts WHERE run != ?", (self.run,))
+                except self._errors:
+                    pass
+
+    def _flush(self) -> None:
+        if not self._connect():
+            self._pending.clear()
+            self._touched.clear()
+            return
+        self._exists = True
+        rows, self._pending = self._pending, []
+        touched, self._touched = self._touched, []
+        run = self.run
+        try:
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?, ?)",
+                    (row + (run,) for row in rows),
+                )
+                self.db.executemany(
+                    "UPDATE verdicts SET run = ? WHERE kind = ? AND path = ?",
+                    ((run, kind, key) for kind, key in touched),
+                )
+        except self._errors:
+            pass  # 缓存写入失败（例如被其他进程锁住）不影响打包
+
 
-        self.text_extensions = {
-            ".py",
-            ".js",
-            ".ts",
-            ".jsx",
-            ".tsx",
-            ".vue",
-            ".svelte",
-            ".html",
-            ".htm",
-            ".css",
-            ".scss",
-            ".sass",
-            ".less",
-            ".json",
-            ".xml",
-            ".yaml",
-            ".yml",
-            ".toml",
-            ".ini",
-            ".md",
-            ".mdx",
-            ".txt",
-            ".rst",
-            ".tex",
-            ".c",
-            ".cpp",
-            ".h",
-            ".hpp",
-            ".java",
-            ".cs",
-            ".php",
-            ".rb",
-            ".go",
-            ".rs",
-            ".swift",
-            ".kt",
-            ".scala",
-            ".sh",
-            ".bash",
-            ".zsh",
-            ".fish",
-            ".ps1",
-            ".bat",
-            ".sql",
-            ".r",
-            ".m",
-            ".pl",
-            ".lua",
-            ".dart",
-            ".Dockerfile",
-            ".gitignore",
-            ".gitattributes",
-            ".editorconfig",
-            ".prettierrc",
-            ".eslintrc",
+# 数据文件归约：notebook 保留单元格源码，数据文件输出推断的结构、样例记录和记录数
+REDUCER_EXTENSIONS = {
+    ".ipynb": "notebook",
+    ".csv": "csv",
+    ".tsv": "csv",
+    ".jsonl": "jsonl",
+    ".ndjson": "jsonl",
+    ".json": "json",
+    ".yaml": "yaml",
+    ".yml": "yaml",
+}
+DATA_REDUCE_SIZE = 32 * 1024  # 数据文件超过该大小才归约，小的配置文件保持原样
+STREAM_REDUCE_MAX_SIZE = 1024 * 1024 * 1024  # 逐行流式归约的文件上限
+PARSE_REDUCE_MAX_SIZE = 64 * 1024 * 1024  # 需要整体解析的格式（notebook、JSON）的上限
+REDUCED_COST = 64 * 1024  # 归约后的文件最多按这么多字节计入总大小
+REDUCER_WORKERS = 4  # 渲染时并行归约的线程数
+SAMPLE_RECORDS = 5  # 输出的样例记录数
+SCHEMA_RECORDS = 200  # 推断结构时检查的记录数
+NOTEBOOK_OUTPUT_LINES = 10  # 每个单元格输出最多保留的行数
+
+_CSV_CELL_TYPES = (
+    ("int", _LazyRegex(r"[-+]?\d+")),
+    ("float", _LazyRegex(r"[-+]?(\d+\.\d*|\.\d+|\d+)([eE][-+]?\d+)?")),
+    ("bool", _LazyRegex(r"(?i)true|false")),
+    ("date", _LazyRegex(r"\d{4}-\d{2}-\d{2}([ T][\d:.]+)?(Z|[-+][\d:]+)?")),
+)
+
+
+def reducer_for(name: str, size: int) -> str:
+    """按文件名和大小选择归约方式，不需要归约时返回空字符串"""
+    dot = name.rfind(".")
+    kind = REDUCER_EXTENSIONS.get(name[dot:].lower()) if dot > 0 else None
+    if kind is None:
+        return ""
+    if kind != "notebook" and size <= DATA_REDUCE_SIZE:
+        return ""
+    limit = PARSE_REDUCE_MAX_SIZE if kind in ("notebook", "json") else STREAM_REDUCE_MAX_SIZE
+    return kind if size <= limit else ""
+
+
+class _HashingReader(io.RawIOBase):
+    """在读取的同时计算原始字节摘要，使归约与内容摘要只需读一遍文件"""
+
+    def __init__(self, raw, hasher):
+        super().__init__()
+        self.raw = raw
+        self.hasher = hasher
+        self.bytes_read = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        count = self.raw.readinto(buffer)
+        if count:
+            self.hasher.update(memoryview(buffer)[:count])
+            self.bytes_read += count
+        return count
+
+
+class _SchemaNode:
+    """JSON 值的推断结构：出现过的类型、对象的键、列表元素与最大长度"""
+
+    __slots__ = ("types", "keys", "items", "max_length")
+
+    def __init__(self):
+        self.types: Dict[str, int] = {}
+        self.keys: Dict[str, _SchemaNode] = {}
+        self.items = None
+        self.max_length = 0
+
+    def observe(self, value: Any, depth: int = 0) -> None:
+        if value is None:
+            name = "null"
+        elif isinstance(value, bool):
+            name = "bool"
+        elif isinstance(value, int):
+            name = "int"
+        elif isinstance(value, float):
+            name = "float"
+        elif isinstance(value, str):
+            name = "str"
+        elif isinstance(value, list):
+            name = "list"
+        else:
+            name = "object"
+        self.types[name] = self.types.get(name, 0) + 1
+        if depth >= 4:
+            return
+        if name == "object":
+            for key, child in value.items():
+                node = self.keys.get(key)
+                if node is None:
+                    if len(self.keys) >= 50:
+                        continue
+                    node = self.keys[key] = _SchemaNode()
+                node.observe(child, depth + 1)
+        elif name == "list":
+            self.max_length = max(self.max_length, len(value))
+            if self.items is None:
+                self.items = _SchemaNode()
+            for item in value[:SCHEMA_RECORDS]:
+                self.items.observe(item, depth + 1)
+
+    def describe(self) -> str:
+        names = sorted(self.types, key=self.types.get, reverse=True)
+        text = "|".join(names)
+        if self.items is not None and self.items.types:
+            text += f" (最多 {self.max_length} 项, 元素: {'|'.join(self.items.types)})"
+        return text
+
+    def lines(self, prefix: str, indent: str = "") -> List[str]:
+        lines = [f"{indent}{prefix}: {self.describe()}"]
+        children = self.keys
+        if self.items is not None and self.items.keys:
+            children = self.items.keys
+        for key, node in children.items():
+            lines.extend(node.lines(key, indent + "  "))
+        return lines
+
+
+def _shorten_json(value: Any, depth: int = 0) -> Any:
+    """样例用的精简副本：列表只保留前几项，长字符串截断"""
+    if isinstance(value, dict):
+        if depth >= 4:
+            return "…"
+        return {key: _shorten_json(child, depth + 1) for key, child in value.items()}
+    if isinstance(value, list):
+        items = [_shorten_json(item, depth + 1) for item in value[:3]]
+        if len(value) > 3:
+            items.append(f"… (共 {len(value)} 项)")
+        return items
+    if isinstance(value, str) and len(value) > 80:
+        return value[:80] + "…"
+    return value
+
+
+def _csv_cell_type(cell: str) -> str:
+    for name, pattern in _CSV_CELL_TYPES:
+        if pattern.fullmatch(cell):
+            return name
+    return "str"
+
+
+def reduce_csv(stream, name: str) -> str:
+    """CSV/TSV：列名与推断的列类型、前几行样例和总行数（逐行读取，内存占用恒定）"""
+    import csv
+
+    delimiter = "\t" if name.lower().endswith(".tsv") else ","
+    reader = csv.reader(stream, delimiter=delimiter)
+    header = next(reader, [])
+    column_types: List[Dict[str, int]] = [{} for _ in header]
+    empty = [0] * len(header)
+    samples = []
+    rows = 0
+    for row in reader:
+        rows += 1
+        if rows <= SAMPLE_RECORDS:
+            samples.append(row)
+        if rows <= SCHEMA_RECORDS:
+            for column, cell in enumerate(row[: len(header)]):
+                if not cell:
+                    empty[column] += 1
+                    continue
+                kind = _csv_cell_type(cell)
+                column_types[column][kind] = column_types[column].get(kind, 0) + 1
+
+    lines = [f"# {rows} 行 × {len(header)} 列（数据文件已归约为推断的结构与前几行样例）", "# 列:"]
+    for column, title in enumerate(header):
+        kinds = "|".join(sorted(column_types[column], key=column_types[column].get, reverse=True))
+        nullable = "，可为空" if empty[column] else ""
+        lines.append(f"#   {title}: {kinds or 'empty'}{nullable}")
+    lines.append(delimiter.join(header))
+    lines.extend(delimiter.join(cell[:80] for cell in row) for row in samples)
+    if rows > len(samples):
+        lines.append(f"... (省略 {rows - len(samples)} 行)")
+    return "\n".join(lines)
+
+
+def reduce_jsonl(stream, name: str) -> str:
+    """JSON Lines：逐行读取，推断记录结构并保留前几条记录"""
+    import json
+
+    schema = _SchemaNode()
+    samples = []
+    records = invalid = 0
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        records += 1
+        if records <= SAMPLE_RECORDS:
+            samples.append(line if len(line) <= 300 else line[:300] + "…")
+        if records <= SCHEMA_RECORDS:
+            try:
+                schema.observe(json.loads(line))
+            except ValueError:
+                invalid += 1
+
+    lines = [f"// {records} 条记录（数据文件已归约为推断的结构与前几条样例）"]
+    if invalid:
+        lines.append(f"// 前 {SCHEMA_RECORDS} 条中有 {invalid} 条无法解析")
+    lines.extend(f"// {line}" for line in schema.lines("记录"))
+    lines.extend(samples)
+    if records > len(samples):
+        lines.append(f"// ... (省略 {records - len(samples)} 条)")
+    return "\n".join(lines)
+
+
+def reduce_json(stream, name: str) -> str:
+    """JSON 数据文件：推断的结构与精简后的样例（标准库没有流式解析器，需整体解析）"""
+    import json
+
+    data = json.loads(stream.read())
+    schema = _SchemaNode()
+    schema.observe(data)
+    count = f"{len(data)} 条记录，" if isinstance(data, list) else ""
+    lines = [f"// {count}数据文件已归约为推断的结构与精简样例（列表只保留前 3 项）"]
+    lines.extend(f"// {line}" for line in schema.lines("根"))
+    lines.append(json.dumps(_shorten_json(data), ensure_ascii=False, indent=2))
+    return "\n".join(lines)
+
+
+_YAML_KEY_RE = _LazyRegex(r"^(\s*)(- +)?([^\s#'\"-][^:#]*?|'[^']*'|\"[^\"]*\"):(\s|$)")
+
+
+def reduce_yaml(stream, name: str) -> str:
+    """YAML 数据文件：逐行提取前三层键的结构和出现次数，再保留开头几行"""
+    paths: Dict[Tuple[str, ...], int] = {}
+    stack: List[Tuple[int, str]] = []  # (缩进, 键)
+    head = []
+    line_count = 0
+    for line in stream:
+        line_count += 1
+        if line_count <= SAMPLE_RECORDS * 4:
+            head.append(line.rstrip("\n")[:200])
+        match = _YAML_KEY_RE.match(line)
+        if match is None:
+            continue
+        indent = len(match.group(1)) + len(match.group(2) or "")
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+        stack.append((indent, match.group(3).strip()))
+        if len(stack) <= 3:
+            path = tuple(key for _, key in stack)
+            paths[path] = paths.get(path, 0) + 1
+
+    lines = [f"# {line_count} 行（数据文件已归约为前三层键的结构与开头几行）", "# 结构:"]
+    for path, count in paths.items():
+        repeat = f" (×{count})" if count > 1 else ""
+        lines.append(f"#   {'  ' * (len(path) - 1)}{path[-1]}{repeat}")
+    lines.extend(head)
+    if line_count > len(head):
+        lines.append(f"# ... (省略 {line_count - len(head)} 行)")
+    return "\n".join(lines)
+
+
+def _notebook_text(value: Any) -> str:
+    return "".join(value) if isinstance(value, list) else str(value or "")
+
+
+def reduce_notebook(stream, name: str) -> str:
+    """Jupyter notebook：保留全部单元格源码（percent 格式），输出只保留开头几行，图片等省略"""
+    import json
+
+    notebook = json.loads(stream.read())
+    cells = notebook.get("cells")
+    if cells is None:  # nbformat 3
+        worksheets = notebook.get("worksheets") or [{}]
+        cells = worksheets[0].get("cells", [])
+    code_cells = sum(1 for cell in cells if cell.get("cell_type") == "code")
+
+    lines = [
+        f"# Jupyter notebook: {len(cells)} 个单元格（代码 {code_cells} 个），输出已精简",
+    ]
+    for cell in cells:
+        source = _notebook_text(cell.get("source", cell.get("input", ""))).rstrip("\n")
+        if cell.get("cell_type") != "code":
+            lines.append(f"\n# %% [{cell.get('cell_type', 'markdown')}]")
+            lines.extend(f"# {line}".rstrip() for line in source.split("\n"))
+            continue
+        lines.append("\n# %%")
+        lines.append(source)
+        for output in cell.get("outputs", []):
+            kind = output.get("output_type")
+            if kind == "error":
+                lines.append(f"# > {output.get('ename', '')}: {output.get('evalue', '')}")
+                continue
+            data = output.get("data", {})
+            text = output.get("text", data.get("text/plain", ""))
+            if text:
+                output_lines = _notebook_text(text).rstrip("\n").split("\n")
+                lines.extend(f"# > {line}" for line in output_lines[:NOTEBOOK_OUTPUT_LINES])
+                if len(output_lines) > NOTEBOOK_OUTPUT_LINES:
+                    lines.append(f"# > ... (省略 {len(output_lines) - NOTEBOOK_OUTPUT_LINES} 行)")
+            for mime, payload in data.items():
+                if mime != "text/plain":
+                    size = format_size(len(_notebook_text(payload)))
+                    lines.append(f"# > [{mime} 输出 {size}，已省略]")
+    return "\n".join(lines)
+
+
+REDUCERS = {
+    "notebook": reduce_notebook,
+    "csv": reduce_csv,
+    "jsonl": reduce_jsonl,
+    "json": reduce_json,
+    "yaml": reduce_yaml,
+}
+REDUCER_LANGUAGES = {"notebook": "python", "csv": "", "jsonl": "", "json": "", "yaml": "yaml"}
+
+
+# 近似重复聚类（MinHash + LSH）
+MINHASH_BINS = 64  # 签名长度（单次哈希分桶的 MinHash）
+LSH_BANDS = 16  # LSH 分段数，每段 MINHASH_BINS // LSH_BANDS 个值
+SHINGLE_TOKENS = 3  # 每个 shingle 包含的连续词数
+NEAR_DUP_MIN_TOKENS = 16  # 词数更少的文件不参与聚类
+_WORD_RE = _LazyRegex(r"\w+")
+NEAR_DUP_DIFF_OVERHEAD = 256  # 估算差异段落大小时每个文件的固定开销（字节）
+_MASK64 = (1 << 64) - 1
+
+
+def minhash_signature(text: str) -> Tuple[int, ...]:
+    """文本的 MinHash 签名：词级 shingle 只哈希一次并按高位分桶取最小值，耗时与文件长度成线性
+
+    使用 crc32 而不是内置 hash()，保证不同进程中的签名（进而聚类结果）一致。
+    """
+    import zlib
+
+    token_ids: Dict[str, int] = {}
+    ids = []
+    for token in _WORD_RE.findall(text):
+        token_id = token_ids.get(token)
+        if token_id is None:
+            token_id = token_ids[token] = zlib.crc32(token.encode("utf-8"))
+        ids.append(token_id)
+    if len(ids) < NEAR_DUP_MIN_TOKENS:
+        return ()
+
+    shift = 64 - (MINHASH_BINS - 1).bit_length()
+    low_mask = (1 << shift) - 1
+    bins = [low_mask + 1] * MINHASH_BINS
+    for a, b, c in zip(ids, ids[1:], ids[2:]):
+        value = (((a * 1000003) ^ b) * 1000003 ^ c) * 0x9E3779B97F4A7C15 & _MASK64
+        slot = value >> shift
+        value &= low_mask
+        if value < bins[slot]:
+            bins[slot] = value
+
+    # 空桶借用其后最近的非空桶的值（加上距离），使短文件的签名仍可逐位比较
+    empty = low_mask + 1
+    if empty in bins:
+        last = max(i for i, value in enumerate(bins) if value != empty)
+        borrowed = distance = 0
+        for step in range(MINHASH_BINS):
+            i = (last - step) % MINHASH_BINS
+            if bins[i] != empty:
+                borrowed, distance = bins[i], 0
+            else:
+                distance += 1
+                bins[i] = borrowed + (distance << shift)
+    return tuple(bins)
+
+
+def signature_similarity(left: Tuple[int, ...], right: Tuple[int, ...]) -> float:
+    """由签名估计两个文件 shingle 集合的 Jaccard 相似度"""
+    return sum(1 for a, b in zip(left, right) if a == b) / MINHASH_BINS
+
+
+# 预算配额："PATTERN:PERCENT"，PATTERN 含 "/" 时匹配相对路径（如 src/**），否则匹配文件名（如 *.md）
+def parse_quota(spec: str) -> Tuple[str, float]:
+    """解析一条配额，返回 (模式, 百分比)；格式错误时抛出 ValueError"""
+    for separator in ("=", ":"):
+        pattern, found, percent = spec.rpartition(separator)
+        if found and pattern.strip():
+            break
+    else:
+        raise ValueError(f"配额格式应为 PATTERN:PERCENT，例如 'src/**:60%'，收到: {spec!r}")
+    try:
+        value = float(percent.strip().rstrip("%"))
+    except ValueError:
+        raise ValueError(f"配额百分比无效: {spec!r}") from None
+    if not 0 < value <= 100:
+        raise ValueError(f"配额百分比应在 0-100 之间: {spec!r}")
+    return pattern.strip(), value
+
+
+class BudgetQuotas:
+    """按目录 glob 或文件名/扩展名划分的预算份额
+
+    每个文件归入第一个匹配的配额；没有匹配任何配额的文件共享剩余的百分比。
+    """
+
+    def __init__(self, quotas: List[Tuple[str, float]] = ()):
+        total = sum(percent for _, percent in quotas)
+        if total > 100:
+            raise ValueError(f"配额总和为 {total:g}%，超过 100%")
+        self.patterns = [pattern for pattern, _ in quotas]
+        self.labels = self.patterns + ["(其余文件)"]
+        self.shares = [percent / 100 for _, percent in quotas] + [max(0.0, 1 - total / 100)]
+        self._matchers = [
+            (re.compile(fnmatch.translate(pattern.lstrip("/"))).match, "/" in pattern)
+            for pattern in self.patterns
+        ]
+
+    def group_of(self, rel_path: str) -> int:
+        """相对路径（以 / 分隔）所属配额的下标，未匹配时为最后一个（其余文件）"""
+        name = rel_path.rpartition("/")[2]
+        for group, (match, full_path) in enumerate(self._matchers):
+            if match(rel_path if full_path else name):
+                return group
+        return len(self._matchers)
+
+
+# 片段选择：path:120-340（行范围）或 path::Class.method（符号）
+LINE_INDEX_STRIDE = 64  # 行偏移索引每隔这么多行记录一个检查点
+SLICE_READ_CHUNK = 1024 * 1024  # 建立行偏移索引时每次读取的字节数
+_SELECTOR_RANGE_RE = _LazyRegex(r"^(?P<path>.+?):(?P<start>\d+)(?:-(?P<end>\d*))?$")
+# 按扩展名选择符号大纲的提取方式；Python 优先用 ast，语法错误时退回正则
+OUTLINE_LANGUAGES = {
+    ".py": "python",
+    ".pyi": "python",
+    ".go": "go",
+    ".rb": "ruby",
+    **dict.fromkeys(
+        (".js", ".jsx", ".mjs", ".cjs", ".ts", ".tsx", ".java", ".kt", ".kts", ".scala"),
+        "c",
+    ),
+    **dict.fromkeys(
+        (".swift", ".cs", ".php", ".rs", ".c", ".h", ".cpp", ".hpp", ".cc", ".dart"), "c"
+    ),
+}
+_OUTLINE_MODIFIERS = (
+    r"(?:(?:export|default|public|private|protected|internal|static|async|abstract|final"
+    r"|override|open|sealed|virtual|inline|unsafe|const|pub(?:\([^)]*\))?)[ \t]+)*"
+)
+_OUTLINE_PATTERNS = {
+    "python": [r"^(?P<indent>[ \t]*)(?:async[ \t]+)?(?:def|class)[ \t]+(?P<name>\w+)"],
+    "c": [
+        r"^(?P<indent>[ \t]*)" + _OUTLINE_MODIFIERS + r"(?:function\*?|class|interface|enum"
+        r"|struct|trait|object|namespace|module|fun|fn|impl|mod|def)[ \t]+(?P<name>\w+)",
+        # 类体内的方法：缩进的 name(...) {，排除控制语句
+        r"^(?P<indent>[ \t]+)" + _OUTLINE_MODIFIERS + r"(?:[\w<>\[\],.?*&]+[ \t]+)?"
+        r"(?P<name>(?!(?:if|for|while|switch|catch|return|else|do|try|new|await)\b)\w+)"
+        r"[ \t]*\([^;]*\)[^;]*\{[ \t]*$",
+    ],
+    "go": [
+        r"^func[ \t]+(?:\([ \t]*(?:\w+[ \t]+)?\*?(?P<recv>\w+)[^)]*\)[ \t]*)?(?P<name>\w+)",
+        r"^type[ \t]+(?P<name>\w+)",
+    ],
+    "ruby": [
+        r"^(?P<indent>[ \t]*)(?:def[ \t]+(?:self\.)?|class[ \t]+|module[ \t]+)(?P<name>\w+[?!]?)"
+    ],
+}
+_OUTLINE_COMMENTS = ("#", "//", "/*", "*")
+
+
+class Selector(NamedTuple):
+    """一个片段选择器：行范围（end 为 0 表示到文件末尾）或符号名"""
+
+    path: str
+    start: int = 1
+    end: int = 0
+    symbol: str = ""
+
+    def __str__(self) -> str:
+        if self.symbol:
+            return self.symbol
+        if self.end == self.start:
+            return str(self.start)
+        return f"{self.start}-{self.end or ''}"
+
+
+def parse_selector(spec: str) -> Selector:
+    """解析 path:120-340、path:120（单行）、path:120-（到末尾）或 path::Class.method"""
+    spec = spec.strip()
+    path, found, symbol = spec.rpartition("::")
+    if found:
+        if not path.strip() or not symbol.strip():
+            raise ValueError(f"选择器缺少路径或符号名: {spec!r}")
+        return Selector(os.path.normpath(path.strip()), symbol=symbol.strip())
+    match = _SELECTOR_RANGE_RE.match(spec)
+    if match is None:
+        raise ValueError(f"选择器格式应为 path:120-340 或 path::Class.method，收到: {spec!r}")
+    start = int(match["start"])
+    end = match["end"]
+    end = start if end is None else int(end or 0)
+    if start < 1 or (end and end < start):
+        raise ValueError(f"选择器的行范围无效: {spec!r}")
+    return Selector(os.path.normpath(match["path"].strip()), start, end)
+
+
+def load_selectors(path: str) -> List[Selector]:
+    """读取选择器清单文件：每行一个选择器，忽略空行和以 # 开头的注释"""
+    with open(path, encoding="utf-8") as f:
+        return [
+            parse_selector(line) for line in f if line.strip() and not line.lstrip().startswith("#")
+        ]
+
+
+def python_outline(text: str) -> Dict[str, List[Tuple[int, int]]]:
+    """用 ast 提取 Python 文件中的类与函数，返回 限定名 -> [(起始行, 结束行)]（含装饰器）"""
+    import ast
+
+    symbols: Dict[str, List[Tuple[int, int]]] = {}
+
+    def visit(node, prefix: str) -> None:
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                name = prefix + child.name
+                start = min([child.lineno] + [item.lineno for item in child.decorator_list])
+                symbols.setdefault(name, []).append((start, child.end_lineno))
+                visit(child, name + ".")
+            elif isinstance(child, ast.stmt):
+                visit(child, prefix)  # if/try 等语句块中的定义
+
+    visit(ast.parse(text), "")
+    return symbols
+
+
+def regex_outline(lines: List[str], family: str) -> Dict[str, List[Tuple[int, int]]]:
+    """用逐行正则提取符号大纲：符号延续到下一个缩进不深于它的非注释行之前
+
+    与符号同缩进的 }、)、]、end 行视为符号的结尾并包含在内。
+    """
+    patterns = [re.compile(pattern) for pattern in _OUTLINE_PATTERNS[family]]
+    symbols: Dict[str, List[Tuple[int, int]]] = {}
+    stack: List[Tuple[int, str, int]] = []  # (缩进, 限定名, 起始行)
+    last_code = 0
+
+    def close(indent: int, closing: bool) -> None:
+        while stack and (stack[-1][0] > indent or (stack[-1][0] == indent and not closing)):
+            _, name, start = stack.pop()
+            symbols.setdefault(name, []).append((start, max(start, last_code)))
+
+    for number, line in enumerate(lines, 1):
+        stripped = line.strip()
+        if not stripped or stripped.startswith(_OUTLINE_COMMENTS):
+            continue
+        expanded = line.expandtabs(4)
+        indent = len(expanded) - len(expanded.lstrip())
+        close(indent, stripped[0] in "})]" or stripped == "end")
+        last_code = number
+        for pattern in patterns:
+            match = pattern.match(line)
+            if match is None:
+                continue
+            name = match["name"]
+            receiver = match.groupdict().get("recv")
+            if receiver:
+                name = f"{receiver}.{name}"
+            elif stack:
+                name = f"{stack[-1][1]}.{name}"
+            stack.append((indent, name, number))
+            break
+    close(-1, False)
+    return symbols
+
+
+class SliceIndex:
+    """单个文件的行偏移索引与符号表，用于只读取选中的行
+
+    行偏移每 LINE_INDEX_STRIDE 行记录一个检查点：定位到第 N 行只需 seek 到前一个检查点，
+    再最多读取 LINE_INDEX_STRIDE - 1 行。检查点按块流式扫描文件得到，内存占用与文件大小无关；
+    符号表需要解码并解析整个文件，只在有符号选择器时才建立。结果按 (size, mtime) 签名
+    缓存在内存与缓存目录中。
+    """
+
+    VERSION = 2
+
+    def __init__(self, signature: Tuple[int, int], encoding: str, line_count: int):
+        self.signature = signature
+        self.encoding = encoding
+        self.line_count = line_count
+        self.size = signature[0]
+        # 检查点的字节偏移；为空表示编码不支持按字节定位行（如 UTF-16），切片时整体解码
+        self.checkpoints = array("q")
+        self.symbols: Dict[str, List[Tuple[int, int]]] = {}
+        self.outlined = False  # 是否已建立符号表
+
+    @classmethod
+    def build(
+        cls, full_path: str, size: int, mtime: int, outline: bool = False, max_decode: int = None
+    ) -> "SliceIndex":
+        """按块扫描一次文件建立行偏移检查点；outline 为 True 时另外解析符号表
+
+        不能按字节定位行的编码需要整体解码，文件超过 max_decode 字节时抛出 ValueError。
+        """
+        with open(full_path, "rb") as f:
+            chunk = f.read(SLICE_READ_CHUNK)
+            encoding = detect_encoding(chunk[:ENCODING_SAMPLE_SIZE], size > ENCODING_SAMPLE_SIZE)
+            index = cls((size, mtime), encoding, 0)
+            if encoding in _LINE_SAFE_ENCODINGS or encoding == "utf-8-sig":
+                checkpoints = index.checkpoints
+                checkpoints.append(0)
+                offset = newlines = 0
+                last = b""
+                while chunk:
+                    # 只在跨过下一个检查点时逐个查找换行符，其余部分整块计数
+                    count = chunk.count(b"\n")
+                    due = LINE_INDEX_STRIDE - newlines % LINE_INDEX_STRIDE
+                    position = -1
+                    while count >= due:
+                        for _ in range(due):
+                            position = chunk.find(b"\n", position + 1)
+                        checkpoints.append(offset + position + 1)
+                        count -= due
+                        newlines += due
+                        due = LINE_INDEX_STRIDE
+                    newlines += count
+                    offset += len(chunk)
+                    last = chunk[-1:]
+                    chunk = f.read(SLICE_READ_CHUNK)
+                # 以换行符结尾时最后一个换行之后没有新行
+                index.line_count = newlines + (last != b"\n" or not offset)
+                if len(checkpoints) > 1 and checkpoints[-1] == offset:
+                    checkpoints.pop()
+                if not outline:
+                    return index
+                f.seek(0)
+                text = f.read().decode(encoding, errors="replace")
+            else:
+                if max_decode is not None and size > max_decode:
+                    raise ValueError(f"{encoding} 编码的文件无法按行定位，且超过单文件大小限制")
+                text = (chunk + f.read()).decode(encoding, errors="replace")
+                index.line_count = text.count("\n") + 1 - text.endswith("\n")
+        if not outline:
+            return index
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+
+        index.outlined = True
+        family = OUTLINE_LANGUAGES.get(os.path.splitext(full_path)[1].lower())
+        if family == "python":
+            try:
+                index.symbols = python_outline(text)
+                family = None
+            except (SyntaxError, ValueError):
+                pass
+        if family:
+            index.symbols = regex_outline(text.split("\n"), family)
+        return index
+
+    def resolve(self, selectors: List[Selector]) -> Tuple[List[Tuple[int, int]], List[str]]:
+        """把选择器解析为合并后的行范围，返回 (行范围, 无法解析的选择器)"""
+        regions = []
+        missing = []
+        for selector in selectors:
+            if selector.symbol:
+                found = self.symbols.get(selector.symbol)
+                if found is None:
+                    # 允许省略外层限定名，例如 method 或 Inner.method
+                    suffix = "." + selector.symbol
+                    found = [
+                        span
+                        for name, spans in self.symbols.items()
+                        if name.endswith(suffix)
+                        for span in spans
+                    ]
+                if found:
+                    regions.extend(found)
+                else:
+                    missing.append(str(selector))
+            elif selector.start > self.line_count:
+                missing.append(str(selector))
+            else:
+                end = min(selector.end or self.line_count, self.line_count)
+                regions.append((selector.start, end))
+
+        merged: List[Tuple[int, int]] = []
+        for start, end in sorted(regions):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged, missing
+
+    def estimate_size(self, regions: List[Tuple[int, int]]) -> int:
+        """由检查点估算行范围的字节数（按检查点取整，略大于实际值）"""
+        checkpoints = self.checkpoints
+        if not checkpoints:
+            return self.size
+        total = 0
+        for start, end in regions:
+            upper = -(-end // LINE_INDEX_STRIDE)
+            high = checkpoints[upper] if upper < len(checkpoints) else self.size
+            total += high - checkpoints[(start - 1) // LINE_INDEX_STRIDE]
+        return min(total, self.size)
+
+    def read_regions(self, full_path: str, regions: List[Tuple[int, int]]) -> Tuple[List[str], int]:
+        """只读取 regions 中的行，返回 (各行范围的文本, 读取的字节数)"""
+        encoding = "utf-8" if self.encoding == "utf-8-sig" else self.encoding
+        with open(full_path, "rb") as f:
+            if not self.checkpoints:
+                data = f.read()
+                lines = data.decode(self.encoding, errors="replace")
+                lines = lines.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+                return ["\n".join(lines[start - 1 : end]) for start, end in regions], len(data)
+
+            texts = []
+            bytes_read = 0
+            for start, end in regions:
+                checkpoint = (start - 1) // LINE_INDEX_STRIDE
+                f.seek(self.checkpoints[checkpoint])
+                for _ in range(start - 1 - checkpoint * LINE_INDEX_STRIDE):
+                    bytes_read += len(f.readline())
+                data = b"".join([f.readline() for _ in range(end - start + 1)])
+                bytes_read += len(data)
+                if start == 1 and data.startswith(b"\xef\xbb\xbf"):
+                    data = data[3:]
+                text = _normalize_newlines(data).decode(encoding, errors="replace")
+                texts.append(text[:-1] if text.endswith("\n") else text)
+        return texts, bytes_read
+
+    @classmethod
+    def load(cls, cache_path: str, signature: Tuple[int, int]):
+        """读取缓存的索引；签名不一致或缓存损坏时返回 None"""
+        import json
+
+        try:
+            with open(cache_path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != cls.VERSION or tuple(data["signature"]) != signature:
+                return None
+            index = cls(signature, data["encoding"], data["lines"])
+            index.outlined = data["outlined"]
+            index.checkpoints = array("q", data["checkpoints"])
+            index.symbols = {
+                name: [tuple(span) for span in spans] for name, spans in data["symbols"].items()
+            }
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return index
+
+    def save(self, cache_path: str) -> None:
+        import json
+
+        data = {
+            "version": self.VERSION,
+            "signature": list(self.signature),
+            "encoding": self.encoding,
+            "lines": self.line_count,
+            "outlined": self.outlined,
+            "checkpoints": self.checkpoints.tolist(),
+            "symbols": self.symbols,
         }
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+
+
+# 内存预算模式下的分配：文件目录与渲染预读各最多占预算的 1/4，其余留给解释器与单个文件
+MEMORY_CATALOG_SHARE = 4
+MEMORY_READ_AHEAD_SHARE = 4
+PARSE_MEMORY_FACTOR = 8  # 整体解析 JSON/notebook 时内存占用约为文件大小的倍数
+SECTION_MEMORY_FACTOR = 4  # 读取并渲染一个文件时内存占用约为文件大小的倍数
+
+
+def peak_rss() -> int:
+    """进程的峰值常驻内存（字节），平台不支持时返回 0"""
+    try:
+        import resource
+    except ImportError:
+        return 0
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Linux 以 KB 为单位
+
+
+class ContextPacker:
+    def __init__(self):
+        self.follow_symlinks = True  # 是否跟随软链接
+        self.default_ignore_patterns = set(DEFAULT_IGNORE_PATTERNS)
+
+        self.text_extensions = set(TEXT_EXTENSIONS)
 
         self.max_file_size = 1024 * 1024  # 1MB
         self.max_total_size = 10 * 1024 * 1024  # 10MB
+        self.max_files = 100
         self.max_depth = None  # 无限制
+        self.walk_workers = 1  # 大于 1 时用线程池并行列举目录
+        self.git_priority = False  # 是否用本地 git 历史调整文件优先级
+        self.cache_dir = None  # 持久化缓存目录；None 表示只在内存中缓存
+        self.query = None  # 自然语言查询；设置后按 BM25 相关度排序
+        self.manifest = False  # 是否在输出文件旁写入打包清单（<输出>.manifest.json）
+        self.skip_generated = True  # 是否识别并跳过锁文件、压缩代码与自动生成的代码
+        self.generated_head = 0  # 大于 0 时生成文件只保留前 N 行，而不是整个跳过
+        self.delta_from = None  # 上一次打包的清单；设置后只输出变更的文件
+        self.near_dup_threshold = None  # 近似重复的相似度阈值（0-1）；None 表示不聚类
+        self.max_memory = None  # 内存预算（字节）；设置后流式写出并限制预读与目录占用
+        self.selections: Dict[str, List[Selector]] = {}  # 相对路径 -> 片段选择器
+        self.quotas: List[Tuple[str, float]] = []  # 预算配额 (模式, 百分比)，见 BudgetQuotas
+        self.tree_budget = None  # 文件树行数预算，超出时折叠未收录的目录；None 表示总是完整显示
         self.verbose = False
+        self.collect_stats = False  # 是否收集分阶段统计
+        self.quiet = False  # 不向标准输出打印进度信息（嵌入其他服务时使用）
+        self._cancel_event = None  # threading.Event，置位后遍历尽快中止
+        self.stats = PackStats()
+        self._matchers: Dict[frozenset, _IgnoreMatcher] = {}
+        self._mime_text_cache: Dict[str, bool] = {}
+        # 路径 -> ((size, mtime_ns), 编码)，签名不变时跳过编码检测
+        self._encoding_cache: Dict[str, Tuple[Tuple[int, int], str]] = {}
+        # 路径 -> ((size, mtime), 生成文件判定原因)
+        self._generated_cache: Dict[str, Tuple[Tuple[int, int], str]] = {}
+        # 路径 -> ((size, mtime), MinHash 签名)
+        self._signature_cache: Dict[str, Tuple[Tuple[int, int], Tuple[int, ...]]] = {}
+        self._slice_cache: Dict[str, SliceIndex] = {}  # 路径 -> 行偏移索引与符号表
+        self._verdicts: VerdictCache = None  # cache_dir 中持久化的编码与生成文件判定
+
+    def check_cancelled(self) -> None:
+        """异步调用方取消或超时后，在遍历和各个逐文件阶段之间尽快中止"""
+        cancel = self._cancel_event
+        if cancel is not None and cancel.is_set():
+            raise PackCancelled("打包已取消")
+
+    def log(self, *args) -> None:
+        """输出进度信息（quiet 模式下静默）"""
+        if not self.quiet:
+            print(*args)
 
     def should_ignore(self, path: Path, ignore_patterns: Set[str]) -> bool:
         """检查文件/目录是否应该被忽略"""
-        for pattern in ignore_patterns:
-            if fnmatch.fnmatch(path.name, pattern) or fnmatch.fnmatch(str(path), pattern):
-                return True
-        return False
+        with self.stats.stage("should_ignore"):
+            return self.get_ignore_matcher(ignore_patterns).match(path.name, str(path))
+
+    def get_ignore_matcher(self, ignore_patterns: Set[str]) -> _IgnoreMatcher:
+        """获取（并缓存）一组忽略规则对应的预编译匹配器"""
+        key = frozenset(ignore_patterns)
+        matcher = self._matchers.get(key)
+        if matcher is None:
+            matcher = self._matchers[key] = _IgnoreMatcher(key)
+        return matcher
 
     def is_text_file(self, file_path: Path) -> bool:
         """判断文件是否为文本文件"""
-        if file_path.suffix.lower() in self.text_extensions:
+        with self.stats.stage("is_text_file"):
+            return self._is_text_name(file_path.name)
+
+    def _is_text_name(self, name: str) -> bool:
+        # 与 Path.suffix 的规则一致：忽略开头的点和结尾的点
+        dot = name.rfind(".")
+        suffix = name[dot:] if 0 < dot < len(name) - 1 else ""
+        if suffix.lower() in self.text_extensions:
             return True
 
-        if file_path.name in ["Makefile", "Dockerfile", "LICENSE", "README"]:
+        if name in TEXT_FILENAMES:
             return True
 
+        # mimetypes 首次使用时会读取系统 mime 数据库，因此按需导入并按后缀缓存结果
+        key = "".join(Path(name).suffixes).lower()
+        cached = self._mime_text_cache.get(key)
+        if cached is not None:
+            self.stats.incr("mime_cache_hit")
+            return cached
+        self.stats.incr("mime_cache_miss")
+
+        is_text = False
         try:
-            mime_type, _ = mimetypes.guess_type(str(file_path))
-            if mime_type and mime_type.startswith("text/"):
-                return True
+            import mimetypes
+
+            mime_type, _ = mimetypes.guess_type(name)
+            is_text = bool(mime_type and mime_type.startswith("text/"))
         except Exception:
             pass
 
-        return False
+        self._mime_text_cache[key] = is_text
+        return is_text
 
     def get_file_tree(
-        self, root_path: Path, ignore_patterns: Set[str], file_status: Dict[Path, str] = None
+        self, root_path: Path, ignore_patterns: Set[str], catalog: FileCatalog = None
     ) -> str:
-        """生成项目文件树结构并显示文件状态"""
-        if file_status is None:
-            file_status = {}
-
-        def get_file_status_symbol(path: Path) -> str:
-            """获取文件状态符号"""
-            if path.is_symlink():
-                if path.is_dir():
-                    return " 🔗📁"  # 软链接目录
-                else:
-                    return " 🔗"  # 软链接文件
-            if path.is_dir():
-                return ""
-
-            status = file_status.get(path, "unknown")
-            symbols = {
-                "included_high": " ✅",  # 高优先级，已包含
-                "included_medium": " ☑️",  # 中优先级，已包含
-                "included_low": " ✅",  # 低优先级，已包含
-                "skipped_ignored": " ⏭️",  # 被忽略
-                "skipped_binary": " 💾",  # 二进制文件
-                "skipped_large": " 📊",  # 文件过大
-                "skipped_limit": " 🚫",  # 超出数量限制
-                "unknown": "",
-            }
-            return symbols.get(status, "")
+        """生成项目文件树结构并显示文件状态（直接读取列式目录）
+
+        设置 tree_budget 后，完整树超过该行数时改用摘要模式：只展开包含已收录文件的目录，
+        其余目录各折叠为一行统计，输出规模随已收录文件数而不是总条目数增长。已收录文件
+        仍然太多时，从最深的一层开始把含已收录文件的目录也折叠为一行，直到不超出预算。
+        """
+        if catalog is None:
+            catalog = self.scan_catalog(root_path, ignore_patterns)
+        return "\n".join(self.iter_file_tree(root_path, catalog))
+
+    def iter_file_tree(self, root_path: Path, catalog: FileCatalog) -> Iterator[str]:
+        """逐行生成文件树（不含换行符），内存预算模式下无需把整棵树拼在内存中"""
+        symbols = {
+            "included_high": " ✅",  # 高优先级，已包含
+            "included_medium": " ☑️",  # 中优先级，已包含
+            "included_low": " ✅",  # 低优先级，已包含
+            "skipped_ignored": " ⏭️",  # 被忽略
+            "skipped_binary": " 💾",  # 二进制文件
+            "skipped_large": " 📊",  # 文件过大
+            "skipped_limit": " 🚫",  # 超出数量限制
+            "skipped_generated": " 🏭",  # 锁文件、压缩或自动生成的代码
+        }
+        status_symbols = [symbols.get(name, "") for name in STATUS_NAMES]
+        segments = catalog.segments
+        names = catalog.name
+        flags = catalog.flags
+        status = catalog.status
+
+        summary = self.tree_budget is not None and len(catalog) > self.tree_budget
+        expand_depth = None
+        if summary:
+            with self.stats.stage("tree_aggregate"):
+                agg_files, agg_bytes, agg_included = catalog.aggregate()
+                aggregates = (agg_files, agg_bytes, agg_included)
+                expand_depth = self._summary_depth(catalog, aggregates, self.tree_budget)
 
-        def build_tree(
-            path: Path, prefix: str = "", is_last: bool = True, current_depth: int = 0
-        ) -> List[str]:
-            if self.should_ignore(path, ignore_patterns):
-                return []
+        def children(start: int, count: int, depth: int):
+            if not summary:
+                return range(start, start + count)
+            expand = expand_depth is None or depth < expand_depth
+            return self._summary_items(catalog, start, count, *aggregates, expand)
 
-            # 检查深度限制
-            if self.max_depth is not None and current_depth > self.max_depth:
-                return []
+        yield root_path.name
+        if catalog.root_error:
+            yield "Permission denied"
 
-            lines = []
+        # 显式栈: [子条目序列, 下一个位置, 前缀]
+        stack = [[children(catalog.root_start, catalog.root_count, 0), 0, ""]]
+        while stack:
+            frame = stack[-1]
+            items, position, prefix = frame
+            if position >= len(items):
+                stack.pop()
+                continue
+            frame[1] = position + 1
+            is_last = position + 1 == len(items)
             connector = "└── " if is_last else "├── "
-            status_symbol = get_file_status_symbol(path)
-            lines.append(f"{prefix}{connector}{path.name}{status_symbol}")
+            index = items[position]
+
+            if isinstance(index, tuple):
+                # 摘要行: ("dir", 下标) 折叠的目录；("others", 目录数, 文件数, 字节数) 其余条目
+                if index[0] == "dir":
+                    dir_index = index[1]
+                    yield (
+                        f"{prefix}{connector}{segments[names[dir_index]]}/ "
+                        f"({agg_files[dir_index]:,} 个文件, {format_size(agg_bytes[dir_index])}, "
+                        f"{agg_included[dir_index]:,} 个已包含)"
+                    )
+                else:
+                    _, dirs, files, size = index
+                    parts = ([f"{dirs:,} 个目录"] if dirs else []) + [f"{files:,} 个文件"]
+                    summary_line = f"… 其余 {'、'.join(parts)} ({format_size(size)}, 未包含)"
+                    yield f"{prefix}{connector}{summary_line}"
+                continue
+
+            entry_flags = flags[index]
+            if entry_flags & FLAG_SYMLINK:
+                symbol = " 🔗📁" if entry_flags & FLAG_DIR else " 🔗"
+            elif entry_flags & FLAG_DIR:
+                symbol = ""
+            else:
+                symbol = status_symbols[status[index]]
 
-            if path.is_dir():
-                # 如果是软链接目录且不跟随软链接，则不展开其内容
-                if path.is_symlink() and not self.follow_symlinks:
-                    return lines
+            line = f"{prefix}{connector}{segments[names[index]]}{symbol}"
+            if entry_flags & FLAG_ALIAS:
+                yield f"{line} → {catalog.relpath(catalog.target[index])}"
+                continue
+            yield line
+            if entry_flags & FLAG_CYCLE:
+                yield f"{prefix}    ⚠️ [循环引用，已跳过]"
+            elif entry_flags & FLAG_DIR and catalog.child_count[index]:
+                extension = "    " if is_last else "│   "
+                items = children(catalog.child_start[index], catalog.child_count[index], len(stack))
+                stack.append([items, 0, prefix + extension])
 
-                # 处理软链接目录
-                real_path = path.resolve() if path.is_symlink() and self.follow_symlinks else path
+    @classmethod
+    def _summary_depth(cls, catalog: FileCatalog, aggregates, budget: int) -> int:
+        """摘要树在 budget 行内最多能展开到第几层目录（根目录为第 0 层），全部展开也不超出时返回 None
 
-                # 防止循环引用
-                if real_path in self.visited_paths:
-                    lines.append(f"{prefix}    ⚠️ [循环引用，已跳过]")
-                    return lines
+        每个目录在摘要中占的行数与它的子目录是否展开无关，因此按层累加即可，无需实际渲染。
+        根目录总是展开，其直接列出的条目本身超出预算时只能尽量少地输出。
+        """
+        flags = catalog.flags
+        agg_included = aggregates[2]
+        base = cls._summary_items(catalog, catalog.root_start, catalog.root_count, *aggregates)
+        lines = 1 + bool(catalog.root_error) + len(base)
+        per_depth = [0]
+        stack = [(catalog.root_start, catalog.root_count, 0)]
+        while stack:
+            start, count, depth = stack.pop()
+            for index in range(start, start + count):
+                entry_flags = flags[index]
+                if not entry_flags & FLAG_DIR or entry_flags & (FLAG_ALIAS | FLAG_CYCLE):
+                    continue
+                child_start, child_count = catalog.child_start[index], catalog.child_count[index]
+                if not agg_included[index] or not child_count:
+                    continue
+                if len(per_depth) <= depth + 1:
+                    per_depth.append(0)
+                items = cls._summary_items(catalog, child_start, child_count, *aggregates)
+                per_depth[depth + 1] += len(items)
+                stack.append((child_start, child_count, depth + 1))
+        for depth in range(1, len(per_depth)):
+            lines += per_depth[depth]
+            if lines > budget:
+                return depth - 1
+        return None
+
+    @staticmethod
+    def _summary_items(
+        catalog: FileCatalog, start, count, agg_files, agg_bytes, agg_included, expand=True
+    ):
+        """摘要模式下一个目录要显示的条目：已收录的文件和目录逐条显示，其余折叠
+
+        expand 为 False 时含已收录文件的子目录也只显示一行统计，不再展开。
+        """
+        flags = catalog.flags
+        status = catalog.status
+        items = []
+        collapsed = 0
+        other_dirs = other_files = other_bytes = 0
+        for index in range(start, start + count):
+            if flags[index] & FLAG_DIR:
+                if agg_included[index]:
+                    items.append(index if expand else ("dir", index))
+                elif collapsed < TREE_SUMMARY_DIRS:
+                    collapsed += 1
+                    # 别名、循环或未展开的目录没有统计可显示，保持原样
+                    if agg_files[index]:
+                        items.append(("dir", index))
+                    else:
+                        items.append(index)
+                else:
+                    other_dirs += 1
+                    other_files += agg_files[index]
+                    other_bytes += agg_bytes[index]
+            elif status[index] in INCLUDED_CODES:
+                items.append(index)
+            else:
+                other_files += 1
+                other_bytes += catalog.size[index]
+        if other_dirs or other_files:
+            items.append(("others", other_dirs, other_files, other_bytes))
+        return items
+
+    def truncate_content(self, content: str, max_lines: int = 500) -> str:
+        """截断过长的文件内容"""
+        return truncate_lines(content, max_lines)
 
-                self.visited_paths.add(real_path)
+    def scan_catalog(self, root_path: Path, ignore_patterns: Set[str]) -> FileCatalog:
+        """一次遍历项目目录，把所有未被忽略的条目写入列式目录（显式栈，支持软链接）
+
+        目录以 (st_dev, st_ino) 识别：每个真实目录只展开一次，其余经软链接到达的位置
+        记为指向该目录的别名；指向祖先目录的软链接记为循环引用。真实路径上的目录先于
+        软链接目录展开，因此目录优先列在它真实所在的位置。
+
+        walk_workers > 1 时目录列举（scandir 与 stat 会释放 GIL）交给线程池预取，
+        主线程仍按同样的确定性顺序消费列举结果，因此输出与单线程遍历完全一致。
+        """
+        catalog = FileCatalog(root_path)
+        matcher = self.get_ignore_matcher(ignore_patterns)
+        stats = self.stats
+        root = str(root_path)
+
+        stats.incr("stat")
+        listed = catalog.dir_keys  # (st_dev, st_ino) -> 展开该目录的条目下标
+        listed[_dir_key(os.stat(root), root)] = -1
+
+        pool = None
+        futures = {}  # 目录条目下标 -> 预取中的列举结果
+        prefetched = set()  # 已提交预取、尚未展开的目录身份，同一目录只预取一次
+        if self.walk_workers > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            pool = ThreadPoolExecutor(max_workers=self.walk_workers, thread_name_prefix="walk")
+
+        # 栈元素: (目录条目下标, 目录路径, 深度, 目录身份)；软链接目录进入 deferred，
+        # 真实目录全部展开后再处理。待展开的目录只存在栈上，已展开的才记入 listed
+        stack = [(-1, root, 0, None)]
+        deferred = []
+        # 内存预算模式下目录超过预算的份额时，在遍历过程中就移到磁盘，而不是遍历完再移
+        catalog_budget = None
+        if self.max_memory is not None:
+            catalog_budget = self.max_memory // MEMORY_CATALOG_SHARE
+        try:
+            while stack or deferred:
+                self.check_cancelled()
+                dir_index, dir_path, depth, key = stack.pop() if stack else deferred.pop()
+                future = futures.pop(dir_index, None)
+
+                if dir_index >= 0:
+                    prefetched.discard(key)
+                    canonical = listed.get(key)
+                    if canonical is not None:
+                        if catalog.is_ancestor(canonical, dir_index):
+                            catalog.flags[dir_index] |= FLAG_CYCLE
+                        else:
+                            catalog.flags[dir_index] |= FLAG_ALIAS
+                            catalog.target[dir_index] = canonical
+                        stats.incr("dir_key_hit")
+                        if future is not None:
+                            future.cancel()
+                        continue
+                    listed[key] = dir_index
 
                 try:
-                    children = sorted(
-                        [p for p in path.iterdir() if not self.should_ignore(p, ignore_patterns)]
+                    if future is not None:
+                        records, ignored = future.result()
+                    else:
+                        records, ignored = self._list_directory(dir_path, matcher)
+                except OSError:
+                    if dir_index < 0:
+                        catalog.root_error = True
+                    continue
+                catalog.ignored_count += ignored
+
+                start = len(catalog)
+                subdirs = []
+                link_subdirs = []
+                for name, flags, size, mtime, key in records:
+                    if key is None:
+                        catalog.add(name, dir_index, flags, size, mtime)
+                        continue
+                    index = catalog.add(name, dir_index, flags, 0, mtime)
+                    if self.max_depth is not None and depth + 1 >= self.max_depth:
+                        catalog.depth_pruned += 1
+                        continue
+                    path = os.path.join(dir_path, name)
+                    (link_subdirs if flags & FLAG_SYMLINK else subdirs).append(
+                        (index, path, depth + 1, key)
                     )
-                    for i, child in enumerate(children):
-                        is_child_last = i == len(children) - 1
-                        extension = "    " if is_last else "│   "
-                        lines.extend(
-                            build_tree(child, prefix + extension, is_child_last, current_depth + 1)
+                    if pool is not None and key not in listed and key not in prefetched:
+                        prefetched.add(key)
+                        futures[index] = pool.submit(self._list_directory, path, matcher)
+
+                catalog.set_children(dir_index, start, len(catalog) - start)
+                stack.extend(reversed(subdirs))
+                deferred.extend(reversed(link_subdirs))
+                if catalog_budget is not None and not catalog.spilled:
+                    usage = catalog.memory_usage()
+                    if usage > catalog_budget:
+                        with stats.stage("spill"):
+                            catalog.spill()
+                        self.log(
+                            f"💽 文件目录已超过 {format_size(usage)}，超出内存预算的份额，"
+                            "其余部分边遍历边写入磁盘"
                         )
-                except PermissionError:
-                    pass
-                finally:
-                    self.visited_paths.discard(real_path)
+        finally:
+            if pool is not None:
+                for future in futures.values():
+                    future.cancel()
+                pool.shutdown(wait=True)
+            catalog.dir_keys.close()
+            catalog.dir_keys = None
 
-            return lines
+        if catalog.spilled:
+            with stats.stage("spill"):
+                stats.incr("catalog_spilled_bytes", catalog.finish())
+        return catalog
 
-        tree_lines = [root_path.name]
-        try:
-            children = sorted(
-                [p for p in root_path.iterdir() if not self.should_ignore(p, ignore_patterns)]
-            )
-            for i, child in enumerate(children):
-                is_last = i == len(children) - 1
-                tree_lines.extend(build_tree(child, "", is_last, 1))
-        except PermissionError:
-            tree_lines.append("Permission denied")
+    def _list_directory(self, dir_path: str, matcher: _IgnoreMatcher):
+        """列举单个目录（线程安全，可在工作线程中执行）
 
-        return "\n".join(tree_lines)
+        返回按名称排序、已过滤忽略项的 (名称, 标志, 大小, mtime, 目录身份) 列表与被忽略条目数；
+        只有需要展开的目录才带有目录身份，其余条目为 None。
+        """
+        stats = self.stats
+        normcase = os.path.normcase
+        stats.incr("scandir")
+        with os.scandir(dir_path) as it:
+            entries = sorted(it, key=lambda e: normcase(e.name))
 
-    def truncate_content(self, content: str, max_lines: int = 500) -> str:
-        """截断过长的文件内容"""
-        lines = content.split("\n")
-        if len(lines) <= max_lines:
-            return content
-
-        truncated_lines = (
-            lines[: max_lines // 2]
-            + [f"\n... (省略 {len(lines) - max_lines} 行) ...\n"]
-            + lines[-max_lines // 2 :]
-        )
-        return "\n".join(truncated_lines)
+        records = []
+        ignored = 0
+        for entry in entries:
+            name = entry.name
+            with stats.stage("should_ignore"):
+                is_ignored = matcher.match(name, entry.path)
+            if is_ignored:
+                ignored += 1
+                continue
 
-    def get_path_depth(self, path: Path, root_path: Path) -> int:
-        """计算路径相对于根目录的深度"""
-        try:
-            relative = path.relative_to(root_path)
-            return len(relative.parts)
-        except ValueError:
+            flags = 0
+            is_link = entry.is_symlink()
+            if is_link:
+                flags |= FLAG_SYMLINK
+                stats.incr("stat")
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+
+            if is_dir:
+                if is_link and not self.follow_symlinks:
+                    records.append((name, flags | FLAG_DIR, 0, 0, None))
+                    continue
+                try:
+                    # 软链接的 stat 结果已在 is_dir() 时缓存；真实目录需要一次 stat
+                    if not is_link:
+                        stats.incr("stat")
+                    st = entry.stat()
+                except OSError:
+                    records.append((name, flags | FLAG_BROKEN, 0, 0, None))
+                    continue
+                key = _dir_key(st, entry.path)
+                records.append((name, flags | FLAG_DIR, 0, st.st_mtime_ns, key))
+                continue
+
+            size = mtime = 0
+            if not is_link or self.follow_symlinks:
+                try:
+                    stats.incr("stat")
+                    st = entry.stat()
+                    size, mtime = st.st_size, st.st_mtime_ns
+                except OSError:
+                    flags |= FLAG_BROKEN
+            records.append((name, flags, size, mtime, None))
+
+        return records, ignored
+
+    @staticmethod
+    def get_priority(rel_path: str) -> int:
+        """按文件名和扩展名给出优先级（越小越重要）"""
+        path = rel_path.lower()
+        if any(
+            name in path for name in ["readme", "package.json", "requirements.txt", "cargo.toml"]
+        ):
             return 0
+        if path.endswith((".py", ".js", ".ts", ".jsx", ".tsx")):
+            return 1
+        if path.endswith((".md", ".txt", ".json", ".yml", ".yaml")):
+            return 2
+        return 3
+
+    def rank_candidates(self, catalog: FileCatalog, candidates: array) -> Sequence[int]:
+        """为候选文件打分并返回选择顺序：基础分为优先级档位，可叠加 git 历史热度"""
+        score = catalog.score
+        priority = catalog.priority
+        for index in candidates:
+            score[index] = priority[index]
 
-    def collect_files_recursive(
-        self, path: Path, root_path: Path, ignore_patterns: Set[str], visited: Set[Path] = None
-    ) -> List[Path]:
-        """递归收集文件，支持软链接"""
-        if visited is None:
-            visited = set()
+        if self.git_priority:
+            with self.stats.stage("git_history"):
+                history = GitHistoryIndex.open(catalog.root, self.cache_dir, self.stats)
+            if history is not None:
+                prefix = history.prefix_for(catalog.root)
+                for index in candidates:
+                    path = prefix + catalog.relpath(index).replace(os.sep, "/")
+                    score[index] -= GIT_PRIORITY_WEIGHT * history.score(path)
+            elif self.verbose:
+                self.log("⚠️  项目不在 git 仓库中，忽略 --git-priority")
 
-        files = []
-        real_path = path.resolve() if path.is_symlink() else path
+        if self.query:
+            # 查询相关度取代优先级档位，档位（及 git 热度）只用于打破平局
+            with self.stats.stage("query"):
+                relevance = self.query_relevance(catalog, candidates)
+            base = score
+            score = catalog.score = array("d", base)
+            for index in candidates:
+                score[index] = -relevance.get(index, 0.0)
+            return sorted(candidates, key=lambda index: (score[index], base[index]))
 
-        # 防止循环引用
-        if real_path in visited:
-            return files
-        visited.add(real_path)
+        if not self.git_priority:
+            # 分数只有几个优先级档位：按档位分桶（稳定），避免为每个候选创建 int 对象的列表
+            order = array("l")
+            for bucket in sorted({score[index] for index in candidates}):
+                order.extend(index for index in candidates if score[index] == bucket)
+            return order
+        return sorted(candidates, key=score.__getitem__)
 
+    def query_relevance(self, catalog: FileCatalog, candidates: array) -> Dict[int, float]:
+        """同步本地 BM25 索引并返回 条目索引 -> 与 self.query 的相关度
+
+        候选文件逐个交给索引，不建立完整的文档列表；结果只含命中查询词项的文件。
+        """
+        documents = (
+            (catalog.relpath(i), catalog.full_path(i), catalog.size[i], catalog.mtime[i])
+            for i in candidates
+        )
+        index = QueryIndex.open(catalog.root, self.cache_dir)
         try:
-            for item in path.iterdir():
-                if self.should_ignore(item, ignore_patterns):
+            # 数据文件（精简器）不受单文件大小限制，只索引开头部分，避免整读大文件
+            index.sync(documents, self.stats, self.max_file_size, self._cancel_event)
+            results = index.search(self.query)
+        finally:
+            index.close()
+        relevance = {}
+        if results:
+            for i in candidates:
+                value = results.get(catalog.relpath(i))
+                if value is not None:
+                    relevance[i] = value
+        return relevance
+
+    def collect_files(self, root_path: Path, ignore_patterns: Set[str]) -> FileCatalog:
+        """收集需要打包的文件，状态与选择结果都记录在返回的列式目录中"""
+        with self.stats.stage("walk"):
+            catalog = self.scan_catalog(root_path, ignore_patterns)
+        self._verdicts = VerdictCache.open(catalog.root, self.cache_dir) if self.cache_dir else None
+
+        skipped_files = {"too_large": 0, "binary": 0, "generated": 0, "limit": 0}
+        flags = catalog.flags
+        sizes = catalog.size
+        priority = catalog.priority
+        skip_mask = FLAG_DIR | FLAG_ALIAS | FLAG_BROKEN
+        if not self.follow_symlinks:
+            skip_mask |= FLAG_SYMLINK
+
+        file_indexes = array("l", (i for i in range(len(catalog)) if not flags[i] & skip_mask))
+        self.stats.incr("files_seen", len(file_indexes))
+
+        if self.verbose:
+            self.log(f"📂 扫描项目: {root_path.name}")
+            self.log(f"📄 发现 {len(file_indexes)} 个文件")
+
+        candidates = array("l")
+        selected_paths: Set[str] = set()
+        processed = 0
+        for index in file_indexes:
+            self.check_cancelled()  # 生成文件检测与片段索引都要读文件
+            processed += 1
+
+            if self.verbose and processed % 50 == 0:
+                percent = processed / len(file_indexes) * 100
+                self.log(f"⏳ 处理进度: {processed}/{len(file_indexes)} ({percent:.1f}%)")
+
+            name = catalog.entry_name(index)
+            if self.selections:
+                # 选中片段的文件只读取所选的行，不受单文件大小限制
+                rel_path = catalog.relpath(index)
+                selectors = self.selections.get(rel_path)
+                if selectors is not None:
+                    selected_paths.add(rel_path)
+                    if self._is_text_name(name) and self.select_regions(catalog, index, selectors):
+                        priority[index] = 0
+                        candidates.append(index)
+                        continue
+
+            # notebook 与大型数据文件归约后输出，不受文本后缀和单文件大小限制
+            reducer = reducer_for(name, sizes[index])
+            if reducer in ("notebook", "json") and not self._fits_memory(
+                sizes[index] * PARSE_MEMORY_FACTOR
+            ):
+                reducer = ""  # 整体解析会超出内存预算，按普通文件处理
+            if reducer and not generated_reason(name):
+                catalog.reducers[index] = reducer
+                priority[index] = self.get_priority(catalog.relpath(index))
+                candidates.append(index)
+                continue
+
+            # 锁文件与压缩代码按文件名即可判定，且都是文本（yarn.lock 等不在文本后缀中），
+            # 先于二进制与大小检查，否则会被记为二进制或大文件而不是生成文件
+            named_reason = generated_reason(name)
+            if not named_reason:
+                with self.stats.stage("is_text_file"):
+                    is_text = self._is_text_name(name)
+                if not is_text:
+                    catalog.set_status(index, "skipped_binary")
+                    skipped_files["binary"] += 1
                     continue
 
-                if item.is_symlink():
-                    # 处理软链接
-                    if self.follow_symlinks:
-                        if item.is_dir():
-                            # 递归处理软链接目录
-                            files.extend(
-                                self.collect_files_recursive(
-                                    item, root_path, ignore_patterns, visited
-                                )
-                            )
-                        else:
-                            # 包含软链接文件
-                            files.append(item)
-                elif item.is_file():
-                    # 普通文件
-                    files.append(item)
-                elif item.is_dir():
-                    # 普通目录，递归处理
-                    files.extend(
-                        self.collect_files_recursive(item, root_path, ignore_patterns, visited)
+            if sizes[index] > self.max_file_size and not (named_reason and self.skip_generated):
+                catalog.set_status(index, "skipped_large")
+                skipped_files["too_large"] += 1
+                if self.verbose:
+                    self.log(
+                        f"⚠️  跳过大文件: {catalog.relpath(index)} ({sizes[index]/1024/1024:.1f}MB)"
                     )
-        except (PermissionError, OSError):
-            pass
+                continue
+
+            if self.skip_generated:
+                reason = named_reason
+                if not reason:
+                    with self.stats.stage("generated"):
+                        reason = self.generated_reason(catalog, index)
+                if reason:
+                    self.stats.incr(f"generated.{reason}")
+                    if not self.generated_head:
+                        catalog.set_status(index, "skipped_generated")
+                        skipped_files["generated"] += 1
+                        if self.verbose:
+                            self.log(f"⚠️  跳过生成文件: {catalog.relpath(index)} ({reason})")
+                        continue
+                    # 只保留前 N 行，按这部分的大小计入总大小
+                    catalog.head_only[index] = self._head_size(catalog, index)
+                    priority[index] = 3
+                    candidates.append(index)
+                    continue
+
+            priority[index] = self.get_priority(catalog.relpath(index))
+            candidates.append(index)
+
+        # 按重要性排序（稳定排序，同分数保持遍历顺序），再按数量和总大小上限依次选择
+        with self.stats.stage("rank"):
+            order = self.rank_candidates(catalog, candidates)
+        self.check_cancelled()
+        for rel_path in sorted(set(self.selections) - selected_paths):
+            self.log(f"⚠️  选择器没有匹配到文件: {rel_path}")
+        if catalog.slices:
+            # 显式选择的片段排在最前面
+            slices = catalog.slices
+            order = [i for i in order if i in slices] + [i for i in order if i not in slices]
+        if self.near_dup_threshold is not None:
+            with self.stats.stage("near_dup"):
+                self.cluster_near_duplicates(catalog, order)
+        total_size, skipped_files["limit"] = self.select_files(catalog, order)
+
+        # 输出统计信息
+        self.log("\n📊 文件统计:")
+        self.log(f"  ✅ 已包含: {len(catalog.included)} 个文件 ({total_size/1024/1024:.2f}MB)")
+        self.log(f"  ⏭️  跳过忽略: {catalog.ignored_count} 个")
+        self.log(f"  ⏭️  跳过二进制: {skipped_files['binary']} 个")
+        self.log(f"  ⏭️  跳过大文件: {skipped_files['too_large']} 个")
+        if skipped_files["generated"] > 0:
+            self.log(f"  ⏭️  跳过生成文件: {skipped_files['generated']} 个")
+        if catalog.near_dup:
+            groups = len({rep for rep, _ in catalog.near_dup.values()})
+            self.log(f"  🧬 近似重复: {len(catalog.near_dup)} 个文件归入 {groups} 组，只输出差异")
+        if catalog.depth_pruned > 0:
+            self.log(f"  ⏭️  跳过深度: {catalog.depth_pruned} 个目录")
+        if skipped_files["limit"] > 0:
+            self.log(f"  ⏭️  超出限制: {skipped_files['limit']} 个")
 
-        return files
+        self.flush_verdicts()
+        return catalog
 
-    def collect_files(
-        self, root_path: Path, ignore_patterns: Set[str]
-    ) -> tuple[List[Dict], Dict[Path, str]]:
-        """收集需要打包的文件并返回文件状态信息"""
-        files = []
+    def _selection_cost(self, catalog: FileCatalog, index: int) -> int:
+        """文件计入总大小的字节数（生成文件只算开头、归约文件有上限、近似重复只算差异）"""
+        if index in catalog.slices:
+            return catalog.slices[index][1]
+        cost = catalog.head_only.get(index, catalog.size[index])
+        if index in catalog.reducers:
+            cost = min(cost, REDUCED_COST)
+        near = catalog.near_dup.get(index)
+        if near is not None:
+            # 代表文件已收录时只输出差异，按估计的差异大小计入总大小
+            if catalog.status[near[0]] in INCLUDED_CODES:
+                cost = min(cost, int(cost * (1 - near[1])) + NEAR_DUP_DIFF_OVERHEAD)
+            else:
+                del catalog.near_dup[index]
+        return cost
+
+    def select_files(self, catalog: FileCatalog, order: List[int]) -> Tuple[int, int]:
+        """按排序顺序在数量和总大小上限内选择文件，返回 (已选总大小, 超出限制的文件数)
+
+        设置了配额时，第一轮每个文件只能使用所属配额的份额；放不下的文件留到第二轮，
+        按原顺序用其他配额没有用完的预算补选。两轮合计只遍历每个候选文件一次。
+        """
+        quotas = BudgetQuotas(self.quotas)
+        priority = catalog.priority
+        bucket_status = ("included_high", "included_medium", "included_low", "included_low")
+        byte_caps = [self.max_total_size * share for share in quotas.shares]
+        file_caps = [self.max_files * share for share in quotas.shares]
+        used_bytes = [0] * len(byte_caps)
+        used_files = [0] * len(byte_caps)
+        closed = [False] * len(byte_caps)
+        # 留到第二轮的文件与所属配额（两个平行数组，避免为每个文件创建元组）
+        deferred = array("l")
+        deferred_groups = array("l")
         total_size = 0
-        skipped_files = {"too_large": 0, "ignored": 0, "binary": 0, "limit": 0, "depth": 0}
-        file_status = {}  # 记录每个文件的状态
 
-        # 递归收集所有文件（支持软链接）
-        all_files = self.collect_files_recursive(root_path, root_path, ignore_patterns)
-        text_files = [f for f in all_files if f.is_file() or (f.is_symlink() and f.exists())]
+        for index in order:
+            group = 0
+            if quotas.patterns:
+                group = quotas.group_of(catalog.relpath(index).replace(os.sep, "/"))
+            cost = self._selection_cost(catalog, index)
+            if (
+                closed[group]
+                or used_files[group] + 1 > file_caps[group]
+                or used_bytes[group] + cost > byte_caps[group]
+            ):
+                # 与全局上限一致：配额内有文件放不下后，同一配额的后续文件都留到第二轮
+                closed[group] = True
+                deferred.append(index)
+                deferred_groups.append(group)
+                continue
+            catalog.set_status(index, bucket_status[priority[index]])
+            catalog.included.append(index)
+            used_files[group] += 1
+            used_bytes[group] += cost
+            total_size += cost
 
-        if self.verbose:
-            print(f"📂 扫描项目: {root_path.name}")
-            print(f"📄 发现 {len(text_files)} 个文件")
+        first_round = len(catalog.included)
+        skipped = 0
+        for position, index in enumerate(deferred):
+            if len(catalog.included) >= self.max_files:
+                catalog.set_status(index, "skipped_limit")
+                skipped += 1
+                continue
+            cost = self._selection_cost(catalog, index)
+            if total_size + cost > self.max_total_size:
+                self.log(
+                    f"\n⚠️  达到总大小限制 ({self.max_total_size/1024/1024:.1f}MB)，停止收集文件"
+                )
+                self.log(
+                    f"已收集 {len(catalog.included)} 个文件，总大小 {total_size/1024/1024:.2f}MB"
+                )
+                for rest in range(position, len(deferred)):
+                    catalog.set_status(deferred[rest], "skipped_limit")
+                skipped += len(deferred) - position
+                break
+            group = deferred_groups[position]
+            catalog.set_status(index, bucket_status[priority[index]])
+            catalog.included.append(index)
+            used_files[group] += 1
+            used_bytes[group] += cost
+            total_size += cost
+
+        if quotas.patterns:
+            redistributed = len(catalog.included) - first_round
+            self.stats.incr("quota_redistributed", redistributed)
+            if redistributed:
+                # 补选的文件恢复到排序顺序中的位置输出
+                rank = {index: position for position, index in enumerate(order)}
+                catalog.included = array("l", sorted(catalog.included, key=rank.__getitem__))
+            if self.verbose:
+                for label, used, cap, count in zip(
+                    quotas.labels, used_bytes, byte_caps, used_files
+                ):
+                    budget = format_size(int(cap))
+                    self.log(f"📐 配额 {label}: {count} 个文件，{format_size(used)} / {budget}")
+        return total_size, skipped
+
+    def cluster_near_duplicates(self, catalog: FileCatalog, order: List[int]) -> None:
+        """把内容高度相似的候选文件聚成簇，结果写入 catalog.near_dup
+
+        每簇以排序最靠前的文件为代表，其余成员与代表的估计相似度需达到阈值。签名按 LSH
+        分段分桶，只和同桶中最早出现的文件比较，整体耗时与文件数近似成线性。
+        """
+        threshold = self.near_dup_threshold
+        rows = MINHASH_BINS // LSH_BANDS
+        signatures: Dict[int, Tuple[int, ...]] = {}
+        buckets: Dict[Tuple[int, Tuple[int, ...]], int] = {}
+        parent: Dict[int, int] = {}  # 并查集，根总是簇中排序最靠前的文件
+        position: Dict[int, int] = {}
+
+        def find(index: int) -> int:
+            while parent[index] != index:
+                parent[index] = parent[parent[index]]
+                index = parent[index]
+            return index
+
+        for index in order:
+            if index in catalog.reducers or index in catalog.head_only or index in catalog.slices:
+                continue
+            self.check_cancelled()
+            signature = self._near_dup_signature(catalog, index)
+            if not signature:
+                continue
+            signatures[index] = signature
+            parent[index] = index
+            position[index] = len(position)
+            for band in range(LSH_BANDS):
+                key = (band, signature[band * rows : (band + 1) * rows])
+                first = buckets.setdefault(key, index)
+                if first == index:
+                    continue
+                if signature_similarity(signatures[first], signature) >= threshold:
+                    root, other = find(first), find(index)
+                    if root != other:
+                        if position[other] < position[root]:
+                            root, other = other, root
+                        parent[other] = root
+
+        for index, signature in signatures.items():
+            rep = find(index)
+            if rep != index:
+                similarity = signature_similarity(signatures[rep], signature)
+                if similarity >= threshold:
+                    catalog.near_dup[index] = (rep, similarity)
+                    catalog.rep_texts[rep] = None
+                    catalog.rep_members[rep] = catalog.rep_members.get(rep, 0) + 1
+        self.stats.incr("near_dup_files", len(catalog.near_dup))
+        self.stats.incr("near_dup_clusters", len({rep for rep, _ in catalog.near_dup.values()}))
+
+    def select_regions(self, catalog: FileCatalog, index: int, selectors: List[Selector]) -> bool:
+        """把文件的片段选择器解析为行范围并记录到 catalog.slices；没有可用的范围时返回 False"""
+        rel_path = catalog.relpath(index)
+        size = catalog.size[index]
+        # 行范围只需要流式建立的检查点；符号需要解析整个文件，受单文件大小与内存预算限制
+        outline = any(selector.symbol for selector in selectors)
+        if outline and not self._fits_decode(size):
+            self.log(f"⚠️  {rel_path} 超过单文件大小限制，不解析符号，只能按行范围选择")
+            outline = False
+        try:
+            with self.stats.stage("slice_index"):
+                slice_index = self.slice_index(
+                    catalog.full_path(index), size, catalog.mtime[index], outline
+                )
+        except (OSError, ValueError) as e:
+            self.log(f"⚠️  无法建立行索引: {rel_path} ({e})")
+            return False
+        regions, missing = slice_index.resolve(selectors)
+        if missing:
+            self.log(f"⚠️  {rel_path} 中找不到选中的片段: {', '.join(missing)}")
+        if not regions:
+            return False
+        estimate = slice_index.estimate_size(regions)
+        if not self._fits_decode(estimate):
+            self.log(f"⚠️  {rel_path} 中选中的片段过大 ({estimate/1024/1024:.1f}MB)，已跳过")
+            return False
+        resolved = ", ".join(str(item) for item in selectors if str(item) not in missing)
+        catalog.slices[index] = (regions, estimate, resolved)
+        return True
+
+    def _fits_decode(self, size: int) -> bool:
+        """一次性读入并解码 size 字节是否在单文件大小限制与内存预算之内"""
+        return size <= self.max_file_size and self._fits_memory(size * SECTION_MEMORY_FACTOR)
+
+    def slice_index(
+        self, full_path: str, size: int, mtime: int, outline: bool = False
+    ) -> SliceIndex:
+        """文件的行偏移索引（outline 时含符号表），按 (size, mtime) 签名复用内存和缓存目录中的结果"""
+        signature = (size, mtime)
+        cached = self._slice_cache.get(full_path)
+        if cached is not None and cached.signature == signature:
+            if cached.outlined or not outline:
+                return cached
+
+        index = cache_path = None
+        if self.cache_dir:
+            import hashlib
+
+            key = os.path.abspath(full_path).encode("utf-8", "surrogateescape")
+            name = hashlib.blake2b(key, digest_size=8).hexdigest()
+            cache_path = os.path.join(self.cache_dir, "slices", f"{name}.json")
+            index = SliceIndex.load(cache_path, signature)
+            if index is not None and outline and not index.outlined:
+                index = None
+        if index is None:
+            self.stats.incr("slice_index_built")
+            index = SliceIndex.build(full_path, size, mtime, outline, self.max_file_size)
+            if cache_path:
+                index.save(cache_path)
+        else:
+            self.stats.incr("slice_index_cache_hit")
+        self._slice_cache[full_path] = index
+        return index
+
+    def verdict_cache(self) -> VerdictCache:
+        """本次打包项目的逐文件判定缓存（collect_files 时按 cache_dir 打开），没有时返回 None"""
+        return self._verdicts
+
+    def flush_verdicts(self, prune: bool = False) -> None:
+        """把本次打包新得到的判定写入缓存目录；完整打包结束时顺带清理用不到的条目"""
+        if self._verdicts is not None:
+            self._verdicts.flush(prune)
+
+    def _near_dup_signature(self, catalog: FileCatalog, index: int) -> Tuple[int, ...]:
+        """文件内容的 MinHash 签名，按 (size, mtime) 缓存"""
+        full_path = catalog.full_path(index)
+        signature = (catalog.size[index], catalog.mtime[index])
+        cached = self._signature_cache.get(full_path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        try:
+            with open(full_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return ()
+        self.stats.incr("near_dup_bytes_hashed", len(data))
+        result = minhash_signature(data.decode(detect_encoding(data), errors="replace"))
+        if self.max_memory is None:
+            self._signature_cache[full_path] = (signature, result)
+        return result
+
+    def generated_reason(self, catalog: FileCatalog, index: int) -> str:
+        """判断文件是否为生成文件：先看文件名，再只读取开头部分；结果按 (size, mtime) 缓存"""
+        name = catalog.entry_name(index)
+        reason = generated_reason(name)
+        if reason:
+            return reason
+
+        full_path = catalog.full_path(index)
+        signature = (catalog.size[index], catalog.mtime[index])
+        cached = self._generated_cache.get(full_path)
+        verdicts = self.verdict_cache()
+        reason = None
+        if cached is not None and cached[0] == signature:
+            reason = cached[1]
+            if verdicts is not None:
+                verdicts.touch("generated", full_path)
+        elif verdicts is not None:
+            reason = verdicts.get("generated", full_path, signature)
+            if reason is not None and self.max_memory is None:
+                self._generated_cache[full_path] = (signature, reason)
+        if reason is not None:
+            self.stats.incr("generated_cache_hit")
+            return reason
+        self.stats.incr("generated_cache_miss")
 
-        processed = 0
-        for file_path in text_files:
-            processed += 1
+        try:
+            with open(full_path, "rb") as f:
+                prefix = f.read(GENERATED_PREFIX_SIZE)
+        except OSError:
+            return ""
+        self.stats.incr("generated_prefix_bytes", len(prefix))
+        reason = generated_reason(name, prefix)
+        if self.max_memory is None:  # 按路径的缓存随文件数增长，内存预算模式下不保留
+            self._generated_cache[full_path] = (signature, reason)
+        if verdicts is not None:
+            verdicts.put("generated", full_path, signature, reason)
+        return reason
 
-            if self.verbose and processed % 50 == 0:
-                print(
-                    f"⏳ 处理进度: {processed}/{len(text_files)} ({processed/len(text_files)*100:.1f}%)"
-                )
+    def _head_size(self, catalog: FileCatalog, index: int) -> int:
+        """文件前 generated_head 行的字节数（只读取到第 N 行为止）"""
+        remaining = self.generated_head
+        total = 0
+        try:
+            with open(catalog.full_path(index), "rb") as f:
+                for line in f:
+                    total += len(line)
+                    remaining -= 1
+                    if remaining <= 0:
+                        break
+        except OSError:
+            return catalog.size[index]
+        return total
 
-            if self.should_ignore(file_path, ignore_patterns):
-                file_status[file_path] = "skipped_ignored"
-                skipped_files["ignored"] += 1
-                continue
+    def load_head(self, full_path: str, max_lines: int) -> Tuple["FileText", bool]:
+        """只读取并解码文件的前 max_lines 行，返回 (内容, 之后是否还有内容)
 
-            # 检查深度限制
-            if self.max_depth is not None:
-                depth = self.get_path_depth(file_path, root_path)
-                if depth > self.max_depth:
-                    file_status[file_path] = "skipped_depth"
-                    skipped_files["depth"] += 1
-                    continue
+        用于 --generated-head：不经过 decode_text 的首尾截断，摘要只针对读取的这部分字节。
+        """
+        import hashlib
 
-            if not self.is_text_file(file_path):
-                file_status[file_path] = "skipped_binary"
-                skipped_files["binary"] += 1
-                continue
+        stats = self.stats
+        stats.incr("open")
+        lines = []
+        with stats.stage("read"), open(full_path, "rb") as f:
+            for line in f:
+                lines.append(line)
+                if len(lines) >= max_lines:
+                    break
+            more = bool(f.read(1))
+        data = b"".join(lines)
+        stats.incr("bytes_read", len(data))
 
+        with stats.stage("decode"):
+            encoding = detect_encoding(data, truncated=more)
             try:
-                file_size = file_path.stat().st_size
-                if file_size > self.max_file_size:
-                    file_status[file_path] = "skipped_large"
-                    skipped_files["too_large"] += 1
-                    if self.verbose:
-                        print(
-                            f"⚠️  跳过大文件: {file_path.relative_to(root_path)} ({file_size/1024/1024:.1f}MB)"
-                        )
-                    continue
+                text = data.decode(encoding)
+            except UnicodeDecodeError:
+                encoding = "latin-1"
+                text = data.decode(encoding)
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        return FileText(text, encoding, digest), more
 
-                if total_size + file_size > self.max_total_size:
-                    print(
-                        f"\n⚠️  达到总大小限制 ({self.max_total_size/1024/1024:.1f}MB)，停止收集文件"
-                    )
-                    print(f"已收集 {len(files)} 个文件，总大小 {total_size/1024/1024:.2f}MB")
-                    break
+    def load_text(self, full_path: str, size: int = -1, mtime: int = -1) -> "FileText":
+        """读取一次原始字节：检测编码、无损解码（含截断），并复用同一份字节计算摘要"""
+        import hashlib
 
-                relative_path = file_path.relative_to(root_path)
-                files.append({"path": relative_path, "size": file_size, "full_path": file_path})
-                total_size += file_size
+        stats = self.stats
+        stats.incr("open")
+        with stats.stage("read"), open(full_path, "rb") as f:
+            data = f.read()
+        stats.incr("bytes_read", len(data))
 
-            except (OSError, PermissionError) as e:
-                if self.verbose:
-                    print(f"⚠️  无法读取: {file_path.relative_to(root_path)} ({e})")
-                continue
+        with stats.stage("decode"):
+            signature = (size, mtime)
+            cached = self._encoding_cache.get(full_path)
+            verdicts = self.verdict_cache() if size >= 0 else None
+            encoding = None
+            if cached is not None and cached[0] == signature:
+                encoding = cached[1]
+                if verdicts is not None:
+                    verdicts.touch("encoding", full_path)
+            elif verdicts is not None:
+                encoding = verdicts.get("encoding", full_path, signature)
+                if encoding is not None:
+                    self._encoding_cache[full_path] = (signature, encoding)
+            if encoding is not None:
+                stats.incr("encoding_cache_hit")
+            else:
+                stats.incr("encoding_cache_miss")
 
-        # 按重要性排序
-        def get_priority(file_info):
-            path = str(file_info["path"]).lower()
-            if any(
-                name in path
-                for name in ["readme", "package.json", "requirements.txt", "cargo.toml"]
-            ):
-                return 0
-            if path.endswith((".py", ".js", ".ts", ".jsx", ".tsx")):
-                return 1
-            if path.endswith((".md", ".txt", ".json", ".yml", ".yaml")):
-                return 2
-            return 3
-
-        files.sort(key=get_priority)
-
-        # 设置包含文件的状态和优先级
-        for i, file_info in enumerate(files):
-            file_path = file_info["full_path"]
-            priority = get_priority(file_info)
-
-            if i < 100:  # 在限制范围内
-                if priority == 0:
-                    file_status[file_path] = "included_high"
-                elif priority <= 1:
-                    file_status[file_path] = "included_medium"
-                else:
-                    file_status[file_path] = "included_low"
-            else:  # 超出限制
-                file_status[file_path] = "skipped_limit"
-                skipped_files["limit"] += 1
+            text = None
+            if encoding is not None:
+                try:
+                    text = decode_text(data, encoding)
+                except UnicodeDecodeError:
+                    encoding = None
+            if encoding is None:
+                encoding = detect_encoding(data)
+                try:
+                    text = decode_text(data, encoding)
+                except UnicodeDecodeError:
+                    # 样本之外出现非法字节时退回 Latin-1，保证逐字节无损
+                    encoding = "latin-1"
+                    text = decode_text(data, encoding)
+                if size >= 0:
+                    self._encoding_cache[full_path] = (signature, encoding)
+                if verdicts is not None:
+                    verdicts.put("encoding", full_path, signature, encoding)
 
-        limited_files = files[:100]  # 限制文件数量
+        if encoding not in ("utf-8", "utf-8-sig"):
+            stats.incr("non_utf8_files")
+            stats.incr(f"encoding.{encoding}")
+        stats.incr("tokens_estimate", len(text) // 4)
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        return FileText(text, encoding, digest)
 
-        # 输出统计信息
-        print("\n📊 文件统计:")
-        print(f"  ✅ 已包含: {len(limited_files)} 个文件 ({total_size/1024/1024:.2f}MB)")
-        print(f"  ⏭️  跳过忽略: {skipped_files['ignored']} 个")
-        print(f"  ⏭️  跳过二进制: {skipped_files['binary']} 个")
-        print(f"  ⏭️  跳过大文件: {skipped_files['too_large']} 个")
-        if skipped_files["depth"] > 0:
-            print(f"  ⏭️  跳过深度: {skipped_files['depth']} 个")
-        if skipped_files["limit"] > 0:
-            print(f"  ⏭️  超出限制: {skipped_files['limit']} 个")
+    def reduce_file(self, full_path: str, kind: str) -> "FileText":
+        """用对应的归约器处理 notebook 或数据文件，读取的同时计算原始字节摘要"""
+        import hashlib
+
+        stats = self.stats
+        stats.incr("open")
+        hasher = hashlib.blake2b(digest_size=16)
+        with stats.stage("reduce"), open(full_path, "rb", buffering=0) as raw:
+            sample = raw.read(ENCODING_SAMPLE_SIZE)
+            encoding = detect_encoding(sample, truncated=len(sample) == ENCODING_SAMPLE_SIZE)
+            raw.seek(0)
+            reader = _HashingReader(raw, hasher)
+            stream = io.TextIOWrapper(
+                io.BufferedReader(reader), encoding=encoding, errors="replace", newline=None
+            )
+            text = REDUCERS[kind](stream, os.path.basename(full_path))
+            # 归约器没有读到文件末尾时补齐摘要
+            buffer = bytearray(64 * 1024)
+            while reader.readinto(buffer):
+                pass
+        stats.incr("bytes_read", reader.bytes_read)
+        stats.incr(f"reduced.{kind}")
 
-        return limited_files, file_status
+        if len(text) > 10000:
+            text = truncate_lines(text)
+        stats.incr("tokens_estimate", len(text) // 4)
+        return FileText(text, encoding, hasher.hexdigest())
 
     def pack_project(
         self, project_path: str, output_path: str = None, custom_ignore: List[str] = None
     ) -> str:
-        """打包项目到markdown文件"""
+        """打包项目到markdown文件，返回生成的内容（设置 max_memory 时流式写出，返回 None）"""
+        self.stats = PackStats(enabled=self.collect_stats)
         root_path = Path(project_path).resolve()
         if not root_path.exists():
             raise FileNotFoundError(f"❌ 项目路径不存在: {project_path}")
@@ -464,17 +3337,67 @@ class ContextPacker:
         # 检查输出文件是否在项目内部
         try:
             output_path.relative_to(root_path)
-            print("⚠️  输出文件在项目内部，可能导致自循环")
-            print("建议使用 -o 参数指定项目外的输出路径")
+            self.log("⚠️  输出文件在项目内部，可能导致自循环")
+            self.log("建议使用 -o 参数指定项目外的输出路径")
         except ValueError:
             pass  # 输出文件不在项目内部，正常
 
-        ignore_patterns = self.default_ignore_patterns.copy()
-        if custom_ignore:
-            ignore_patterns.update(custom_ignore)
+        ignore_patterns = self.build_ignore_patterns(root_path, custom_ignore)
 
         # 添加输出文件到忽略列表
         ignore_patterns.add(output_path.name)
+        manifest_path = None
+        if self.manifest or self.delta_from is not None:
+            manifest_path = manifest_path_for(output_path)
+            ignore_patterns.add(os.path.basename(manifest_path))
+
+        self.log(f"\n🚀 开始打包项目: {root_path.name}")
+
+        # 逐段生成并写出；有内存预算时不在内存中保留完整内容
+        sections = self.iter_markdown(root_path, ignore_patterns, manifest_path)
+        kept = [] if self.max_memory is None else None
+        try:
+            writer = PackWriter(output_path)
+            try:
+                # 只统计写出本身；生成各段的耗时已计入 collect/tree/render 等阶段
+                footer = None
+                for section in sections:
+                    if footer is not None:
+                        with self.stats.stage("write"):
+                            writer.write(footer)
+                    footer = section
+                    if kept is not None:
+                        kept.append(section)
+                with self.stats.stage("write"):
+                    # 尾部含生成时间，不计入内容指纹
+                    writer.write(footer, fingerprint=False)
+                    writer.commit()
+            except BaseException:
+                writer.abort()
+                raise
+            self.stats.incr("bytes_emitted", writer.bytes_written)
+            if writer.replaced:
+                self.log(f"\n✅ 项目已成功打包到: {output_path}")
+                self.log(f"📄 文件大小: {output_path.stat().st_size / 1024:.1f}KB")
+            else:
+                self.stats.incr("output_unchanged")
+                self.log(f"\n✅ 内容没有变化，保留现有文件: {output_path}")
+        except Exception as e:
+            self.log(f"\n❌ 写入文件失败: {e}")
+            raise
+
+        # 只在设置内存预算或收集统计时报告峰值内存
+        peak = peak_rss() if self.max_memory is not None or self.collect_stats else 0
+        if peak:
+            self.stats.incr("peak_rss_bytes", peak)
+            self.log(f"🧠 峰值内存: {peak / 1024 / 1024:.1f}MB")
+        return None if kept is None else "".join(kept)
+
+    def build_ignore_patterns(self, root_path: Path, custom_ignore: List[str] = None) -> Set[str]:
+        """合并默认规则、自定义规则和项目 .gitignore 中的规则"""
+        ignore_patterns = self.default_ignore_patterns.copy()
+        if custom_ignore:
+            ignore_patterns.update(custom_ignore)
 
         # 检查是否有项目特定的忽略文件
         gitignore_path = root_path / ".gitignore"
@@ -488,89 +3411,268 @@ class ContextPacker:
                             ignore_patterns.add(line)
                             gitignore_count += 1
                 if self.verbose and gitignore_count > 0:
-                    print(f"📋 从 .gitignore 加载 {gitignore_count} 个忽略规则")
+                    self.log(f"📋 从 .gitignore 加载 {gitignore_count} 个忽略规则")
             except Exception:
                 pass
 
-        print(f"\n🚀 开始打包项目: {root_path.name}")
+        return ignore_patterns
 
-        # 生成输出
-        markdown_content = self.generate_markdown(root_path, ignore_patterns)
+    def generate_markdown(
+        self, root_path: Path, ignore_patterns: Set[str], manifest_path: str = None
+    ) -> str:
+        """生成markdown格式的项目内容"""
+        content = "".join(self.iter_markdown(root_path, ignore_patterns, manifest_path))
+        if self.stats.enabled:
+            self.stats.incr("bytes_emitted", len(content.encode("utf-8")))
+        return content
 
-        try:
-            with open(output_path, "w", encoding="utf-8") as f:
-                f.write(markdown_content)
-            print(f"\n✅ 项目已成功打包到: {output_path}")
-            print(f"📄 文件大小: {output_path.stat().st_size / 1024:.1f}KB")
-        except Exception as e:
-            print(f"\n❌ 写入文件失败: {e}")
-            raise
+    def iter_markdown(
+        self, root_path: Path, ignore_patterns: Set[str], manifest_path: str = None
+    ) -> Iterator[str]:
+        """逐段生成markdown：头部（含文件树）、每个文件一段、尾部
 
-        return markdown_content
+        设置了 delta_from 时只生成增量内容；给出 manifest_path 时在最后写入本次的打包清单。
+        """
+        # 收集文件和状态信息
+        with self.stats.stage("collect"):
+            catalog = self.collect_files(root_path, ignore_patterns)
 
-    def generate_markdown(self, root_path: Path, ignore_patterns: Set[str]) -> str:
-        """生成markdown格式的项目内容"""
-        project_name = root_path.name
+        if self.delta_from is not None:
+            yield from self.iter_delta(root_path, catalog, self.delta_from)
+        else:
+            yield from self.iter_header(root_path, catalog)
 
-        # 重置已访问路径集合
-        self.visited_paths = set()
+            with self.stats.stage("render"):
+                yield from self.iter_sections(catalog)
 
-        # 收集文件和状态信息
-        files, file_status = self.collect_files(root_path, ignore_patterns)
+            yield self.render_footer(root_path)
+        # 只有完整打包才检查了全部文件，增量或片段打包不清理缓存条目
+        self.flush_verdicts(prune=self.delta_from is None and not self.selections)
 
-        # 生成文件树（包含状态标记）
-        file_tree = self.get_file_tree(root_path, ignore_patterns, file_status)
+        if manifest_path is not None:
+            with self.stats.stage("manifest"):
+                write_manifest(catalog, manifest_path)
 
-        # 生成markdown
-        content = f"""# {project_name} - 项目上下文
+    def _fits_memory(self, size: int) -> bool:
+        return self.max_memory is None or size <= self.max_memory // MEMORY_READ_AHEAD_SHARE
 
-## 项目结构
+    def read_ahead_limit(self, requested: int) -> int:
+        """内存预算允许的渲染预读文件数（至少为 1）"""
+        if self.max_memory is None:
+            return requested
+        per_file = self.max_file_size * SECTION_MEMORY_FACTOR
+        return max(1, min(requested, self.max_memory // MEMORY_READ_AHEAD_SHARE // per_file))
 
+    def iter_sections(self, catalog: FileCatalog) -> Iterator[str]:
+        """按输出顺序渲染已包含的文件；需要归约的文件提前交给线程池，不阻塞其余文件"""
+        reduced = [index for index in catalog.included if index in catalog.reducers]
+        if not reduced:
+            for index in catalog.included:
+                yield self.render_file_section(catalog, index)
+            return
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        window = self.read_ahead_limit(REDUCER_WORKERS * 2)  # 最多提前归约的文件数
+        queue = iter(reduced)
+        pending = {}
+
+        def schedule(pool):
+            while len(pending) < window:
+                index = next(queue, None)
+                if index is None:
+                    return
+                pending[index] = pool.submit(self.render_file_section, catalog, index)
+
+        with ThreadPoolExecutor(REDUCER_WORKERS, thread_name_prefix="ctxpack-reduce") as pool:
+            try:
+                schedule(pool)
+                for index in catalog.included:
+                    future = pending.pop(index, None)
+                    if future is None:
+                        yield self.render_file_section(catalog, index)
+                    else:
+                        section = future.result()
+                        schedule(pool)
+                        yield section
+            finally:
+                for future in pending.values():
+                    future.cancel()
+
+    def iter_delta(
+        self, root_path: Path, catalog: FileCatalog, previous: Dict[str, Any]
+    ) -> Iterator[str]:
+        """增量模式：只输出相对上一次打包新增或修改的文件，附结构变更与移除列表
+
+        大小、修改时间与片段选择都与清单一致的文件直接沿用清单中的摘要，不再读取。
+        """
+        old_files = previous.get("files", {})
+        yield self.render_delta_header(root_path, catalog, previous)
+
+        added = changed = unchanged = 0
+        current = set()
+        with self.stats.stage("render"):
+            for index in catalog.included:
+                rel_path = catalog.relpath(index)
+                current.add(rel_path)
+                old = old_files.get(rel_path)
+                signature = [catalog.size[index], catalog.mtime[index]]
+                if (
+                    old is not None
+                    and old[:2] == signature
+                    and old[3:] == slice_view(catalog, index)
+                ):
+                    catalog.digests[index] = old[2]
+                    self.stats.incr("delta_signature_hit")
+                    unchanged += 1
+                    continue
+                section = self.render_file_section(catalog, index)
+                if old is not None and catalog.digests.get(index) == old[2]:
+                    unchanged += 1  # 仅修改时间变化，内容相同
+                    continue
+                if old is None:
+                    added += 1
+                else:
+                    changed += 1
+                yield section
+
+        removed = sorted(path for path in old_files if path not in current)
+        self.stats.incr("delta_added", added)
+        self.stats.incr("delta_changed", changed)
+        self.stats.incr("delta_removed", len(removed))
+        self.stats.incr("delta_unchanged", unchanged)
+        self.log(
+            f"  🔁 增量: 新增 {added}，修改 {changed}，移除 {len(removed)}，未变 {unchanged} 个文件"
+        )
+
+        lines = [f"- {path}" for path in removed] or ["（无）"]
+        removed_list = "\n".join(lines)
+        yield f"""
+## 已移除的文件
+
+以下文件在上一次打包中已包含，本次已删除或不再包含：
+
+{removed_list}
+
+*增量统计: 新增 {added} 个，修改 {changed} 个，移除 {len(removed)} 个，未变 {unchanged} 个文件*
+"""
+        yield self.render_footer(root_path)
+
+    def render_delta_header(
+        self, root_path: Path, catalog: FileCatalog, previous: Dict[str, Any]
+    ) -> str:
+        """生成增量输出的标题与结构变更（按路径对比新旧清单中的条目状态）"""
+        with self.stats.stage("tree"):
+            # 新目录逐条对比，不另建一份完整的状态表；只有变更行留在内存中
+            old_tree = dict(previous.get("tree", {}))
+            changes = []
+            for path, new_status in catalog.iter_tree_status():
+                old_status = old_tree.pop(path, None)
+                if old_status is None:
+                    changes.append((path, f"+ {path}  [{new_status}]"))
+                elif old_status != new_status:
+                    changes.append((path, f"~ {path}  [{old_status} → {new_status}]"))
+            changes.extend((path, f"- {path}") for path in old_tree)
+            changes.sort()
+            tree_diff = "\n".join(line for _, line in changes) if changes else "（无）"
+
+        return f"""# {root_path.name} - 增量上下文
+
+相对 {previous.get("generated", "上一次打包")} 生成的打包结果，只包含新增和修改的文件；
+未列出的文件内容与上一次相同。
+
+## 结构变更
+
+```diff
+{tree_diff}
 ```
-{file_tree}
-```
 
-### 文件状态说明\n\n- ✅ 高优先级文件（已包含）：README、package.json、配置文件等\n- ☑️ 中优先级文件（已包含）：代码文件（.py、.js、.ts等）  \n- ✅ 低优先级文件（已包含）：文档、配置等其他文件\n- 🔗 软链接文件：指向其他位置的符号链接\n- 🔗📁 软链接目录：指向其他目录的符号链接\n- ⏭️ 跳过的文件：被忽略规则排除的文件\n- 💾 二进制文件：图片、视频、压缩包等\n- 📊 文件过大：超过大小限制的文件  \n- 🚫 超出限制：超过文件数量限制的文件\n- ⚠️ 循环引用：检测到的循环软链接\n\n## 项目文件内容
+## 变更文件内容
+
+"""
+
+    def render_header(
+        self, root_path: Path, ignore_patterns: Set[str], catalog: FileCatalog
+    ) -> str:
+        """生成标题、项目结构与状态说明"""
+        return "".join(self.iter_header(root_path, catalog))
+
+    def iter_header(self, root_path: Path, catalog: FileCatalog) -> Iterator[str]:
+        """分块生成头部：文件树按 TREE_CHUNK_LINES 行一块输出，不在内存中拼出整棵树"""
+        yield f"# {root_path.name} - 项目上下文\n\n## 项目结构\n\n```\n"
+        from itertools import islice
+
+        tree = self.iter_file_tree(root_path, catalog)
+        while True:
+            with self.stats.stage("tree"):
+                lines = list(islice(tree, TREE_CHUNK_LINES))
+            if not lines:
+                break
+            yield "\n".join(lines) + "\n"
+        yield f"""```
+
+### 文件状态说明\n\n- ✅ 高优先级文件（已包含）：README、package.json、配置文件等\n- ☑️ 中优先级文件（已包含）：代码文件（.py、.js、.ts等）  \n- ✅ 低优先级文件（已包含）：文档、配置等其他文件\n- 🔗 软链接文件：指向其他位置的符号链接\n- 🔗📁 软链接目录：指向其他目录的符号链接\n- ⏭️ 跳过的文件：被忽略规则排除的文件\n- 💾 二进制文件：图片、视频、压缩包等\n- 📊 文件过大：超过大小限制的文件  \n- 🏭 生成文件：锁文件、压缩代码与自动生成的代码\n- 🚫 超出限制：超过文件数量限制的文件\n- ⚠️ 循环引用：检测到的循环软链接\n- → 路径：软链接目录已在该路径下展开，不重复列出\n- 目录/ (N 个文件, 大小, 0 个已包含)：未收录任何文件的目录（摘要模式下折叠）\n\n## 项目文件内容
 
-本文档包含了 {len(files)} 个主要文件的内容。
+本文档包含了 {len(catalog.included)} 个主要文件的内容。
 
 """
 
-        for file_info in files:
-            rel_path = file_info["path"]
-            full_path = file_info["full_path"]
+    def render_file_section(self, catalog: FileCatalog, index: int) -> str:
+        """读取并渲染单个文件的内容段落（可在工作线程中调用）"""
+        self.check_cancelled()
+        rel_path = catalog.relpath(index)
+        full_path = os.path.join(catalog.root, rel_path)
+        if index in catalog.slices:
+            return self.render_slice_section(catalog, index, rel_path, full_path)
 
-            try:
-                with open(full_path, encoding="utf-8", errors="ignore") as f:
-                    file_content = f.read()
-
-                # 截断过长内容
-                if len(file_content) > 10000:
-                    file_content = self.truncate_content(file_content)
-
-                # 确定语言类型
-                extension = full_path.suffix.lower()
-                lang_map = {
-                    ".py": "python",
-                    ".js": "javascript",
-                    ".ts": "typescript",
-                    ".jsx": "jsx",
-                    ".tsx": "tsx",
-                    ".html": "html",
-                    ".css": "css",
-                    ".scss": "scss",
-                    ".json": "json",
-                    ".yaml": "yaml",
-                    ".yml": "yaml",
-                    ".xml": "xml",
-                    ".sh": "bash",
-                    ".sql": "sql",
-                    ".md": "markdown",
-                    ".mdx": "mdx",
-                }
-                lang = lang_map.get(extension, "")
-
-                content += f"""
+        reducer = catalog.reducers.get(index, "")
+        truncated = False
+        try:
+            file_text = None
+            if index in catalog.head_only:
+                file_text, truncated = self.load_head(full_path, self.generated_head)
+            elif reducer:
+                try:
+                    file_text = self.reduce_file(full_path, reducer)
+                except Exception:
+                    # 内容不符合预期格式时按普通文本输出（文件不太大时）
+                    self.stats.incr("reduce_failed")
+                    reducer = ""
+                    if catalog.size[index] > self.max_file_size:
+                        raise
+            if file_text is None:
+                file_text = self.load_text(full_path, catalog.size[index], catalog.mtime[index])
+        except Exception as e:
+            return f"""
+### {rel_path}
+
+```
+无法读取文件内容: {str(e)}
+```
+
+"""
+
+        catalog.digests[index] = file_text.digest
+        file_content = file_text.text
+        if truncated:
+            file_content = file_content[:-1] if file_content.endswith("\n") else file_content
+            file_content += f"\n\n... (生成文件，仅保留前 {self.generated_head} 行) ..."
+
+        # 确定语言类型
+        extension = os.path.splitext(full_path)[1].lower()
+        lang = REDUCER_LANGUAGES[reducer] if reducer else LANGUAGE_MAP.get(extension, "")
+        self.stats.incr("files_included")
+
+        if catalog.near_dup:
+            near = catalog.near_dup.get(index)
+            if near is not None:
+                section = self.render_near_dup_section(catalog, index, file_content, *near)
+                if section is not None:
+                    return section
+            elif index in catalog.rep_texts:
+                self.keep_rep_text(catalog, index, file_content)
+
+        return f"""
 ### {rel_path}
 
 ```{lang}
@@ -578,28 +3680,525 @@ class ContextPacker:
 ```
 
 """
-            except Exception as e:
-                content += f"""
+
+    def render_slice_section(
+        self, catalog: FileCatalog, index: int, rel_path: str, full_path: str
+    ) -> str:
+        """只读取并渲染文件中选中的行范围，未选中的部分以省略行数代替"""
+        import hashlib
+
+        regions, _, resolved = catalog.slices[index]
+        try:
+            slice_index = self.slice_index(full_path, catalog.size[index], catalog.mtime[index])
+            self.stats.incr("open")
+            with self.stats.stage("read"):
+                texts, bytes_read = slice_index.read_regions(full_path, regions)
+        except OSError as e:
+            return f"""
 ### {rel_path}
 
 ```
 无法读取文件内容: {str(e)}
 ```
 
+"""
+        self.stats.incr("bytes_read", bytes_read)
+        self.stats.incr("sliced_files")
+        self.stats.incr("sliced_lines", sum(end - start + 1 for start, end in regions))
+
+        parts = []
+        previous = 0
+        for (start, end), text in zip(regions, texts):
+            if start > previous + 1:
+                gap = f"... (省略 {start - previous - 1} 行) ...\n"
+                parts.append(f"\n{gap}" if parts else gap)
+            parts.append(text)
+            previous = end
+        if previous < slice_index.line_count:
+            parts.append(f"\n... (省略 {slice_index.line_count - previous} 行) ...")
+        file_content = "\n".join(parts)
+        catalog.digests[index] = hashlib.blake2b(
+            file_content.encode("utf-8", "surrogateescape"), digest_size=16
+        ).hexdigest()
+        self.stats.incr("tokens_estimate", len(file_content) // 4)
+        self.stats.incr("files_included")
+
+        lang = LANGUAGE_MAP.get(os.path.splitext(full_path)[1].lower(), "")
+        ranges = "、".join(
+            str(start) if start == end else f"{start}-{end}" for start, end in regions
+        )
+        return f"""
+### {rel_path}
+
+> 只包含选中的片段（{resolved}）：第 {ranges} 行，共 {slice_index.line_count} 行
+
+```{lang}
+{file_content}
+```
+
+"""
+
+    def keep_rep_text(self, catalog: FileCatalog, rep: int, text: str) -> None:
+        """暂存代表文件的内容供其成员做差异；内存预算模式下超出预读份额的不保留，用到时重新读取"""
+        with catalog.rep_lock:
+            if not catalog.rep_members[rep] or catalog.rep_texts[rep] is not None:
+                return
+            if self.max_memory is not None:
+                if not self._fits_memory(catalog.rep_text_bytes + len(text)):
+                    self.stats.incr("near_dup_reread")
+                    return
+            catalog.rep_texts[rep] = text
+            catalog.rep_text_bytes += len(text)
+
+    def render_near_dup_section(
+        self, catalog: FileCatalog, index: int, file_content: str, rep: int, similarity: float
+    ) -> str:
+        """把近似重复的文件渲染为相对代表文件的 unified diff；差异不比原文短时返回 None"""
+        import difflib
+
+        with catalog.rep_lock:
+            rep_text = catalog.rep_texts[rep]
+            # 最后一个成员用完后释放代表文件的内容
+            remaining = catalog.rep_members[rep] - 1
+            catalog.rep_members[rep] = remaining
+            if not remaining and rep_text is not None:
+                catalog.rep_texts[rep] = None
+                catalog.rep_text_bytes -= len(rep_text)
+        if rep_text is None:  # 增量模式下代表文件可能未渲染，或超出内存预算没有保留
+            try:
+                rep_text = self.load_text(
+                    catalog.full_path(rep), catalog.size[rep], catalog.mtime[rep]
+                ).text
+            except Exception:
+                return None
+            if remaining:
+                self.keep_rep_text(catalog, rep, rep_text)
+
+        rel_path = catalog.relpath(index)
+        rep_path = catalog.relpath(rep)
+        diff = "\n".join(
+            difflib.unified_diff(
+                rep_text.split("\n"),
+                file_content.split("\n"),
+                fromfile=rep_path,
+                tofile=rel_path,
+                n=1,
+                lineterm="",
+            )
+        )
+        if len(diff) >= len(file_content):
+            self.stats.incr("near_dup_fallback")
+            return None
+        self.stats.incr("near_dup_bytes_saved", len(file_content) - len(diff))
+
+        if not diff:
+            return f"""
+### {rel_path}
+
+> 与 {rep_path} 内容相同
+
+"""
+        return f"""
+### {rel_path}
+
+> 与 {rep_path} 近似重复（相似度约 {similarity:.0%}），以下只列出相对它的差异
+
+```diff
+{diff}
+```
+
 """
 
-        content += f"""
+    def render_footer(self, root_path: Path) -> str:
+        return f"""
 ---
 
 *此文档由 Context Packer 自动生成*
 *项目路径: {root_path}*
-*生成时间: {os.popen('date').read().strip()}*
+*生成时间: {datetime.now().astimezone().strftime("%Y-%m-%d %H:%M:%S %Z")}*
 """
 
-        return content
 
+class AsyncContextPacker:
+    """供 asyncio 服务嵌入的异步接口：遍历与读取在线程池中执行，逐段产出markdown
+
+    所有实例共享同一个线程池，max_open_files 即整个进程内同时进行的文件操作上限，
+    因此大量并发打包请求也不会耗尽文件描述符。
+    """
+
+    max_open_files = 32
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, packer: ContextPacker = None, read_ahead: int = 8):
+        self.packer = packer if packer is not None else ContextPacker()
+        self.read_ahead = max(1, read_ahead)  # 单次打包最多提前排队的文件数
+        self.last_stats = None  # 最近一次打包的 PackStats
+
+    @classmethod
+    def get_executor(cls):
+        """获取（首次调用时创建）共享线程池"""
+        with cls._executor_lock:
+            if cls._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=cls.max_open_files, thread_name_prefix="ctxpack"
+                )
+            return cls._executor
+
+    def _session(self) -> ContextPacker:
+        """每次打包使用配置的浅拷贝，独立的统计与取消标志，共享编码缓存等"""
+        packer = copy.copy(self.packer)
+        packer.quiet = True
+        packer.stats = PackStats(enabled=packer.collect_stats)
+        packer._cancel_event = threading.Event()
+        return packer
+
+    async def pack(
+        self, project_path: str, custom_ignore: List[str] = None, timeout: float = None
+    ) -> AsyncIterator[str]:
+        """异步打包项目，按输出顺序逐段产出markdown
+
+        timeout 为整次打包的时限（秒），超时抛出 asyncio.TimeoutError；
+        调用方取消或提前关闭迭代器时，排队中的读取会被撤销，遍历也会尽快中止。
+        """
+        import asyncio
+        from collections import deque
+
+        loop = asyncio.get_running_loop()
+        executor = self.get_executor()
+        deadline = None if timeout is None else loop.time() + timeout
+        packer = self._session()
+        self.last_stats = packer.stats
+
+        async def wait(future):
+            if deadline is None:
+                return await future
+            return await asyncio.wait_for(future, max(0.0, deadline - loop.time()))
+
+        async def run(func, *args):
+            return await wait(loop.run_in_executor(executor, func, *args))
+
+        root_path = Path(project_path).resolve()
+        if not root_path.exists():
+            raise FileNotFoundError(f"❌ 项目路径不存在: {project_path}")
+
+        pending = deque()
+        try:
+            ignore_patterns = await run(packer.build_ignore_patterns, root_path, custom_ignore)
+            catalog = await run(packer.collect_files, root_path, ignore_patterns)
+            yield await run(packer.render_header, root_path, ignore_patterns, catalog)
+
+            indexes = iter(catalog.included)
+
+            def schedule_next():
+                index = next(indexes, None)
+                if index is not None:
+                    pending.append(
+                        loop.run_in_executor(executor, packer.render_file_section, catalog, index)
+                    )
+
+            # 有界预读：始终最多有 read_ahead 个文件在排队或读取中
+            for _ in range(packer.read_ahead_limit(self.read_ahead)):
+                schedule_next()
+            while pending:
+                section = await wait(pending.popleft())
+                schedule_next()
+                yield section
+
+            await run(packer.flush_verdicts, not packer.selections)
+            yield packer.render_footer(root_path)
+        finally:
+            packer._cancel_event.set()
+            for future in pending:
+                future.cancel()
+
+    async def pack_to_string(
+        self, project_path: str, custom_ignore: List[str] = None, timeout: float = None
+    ) -> str:
+        """异步打包并返回完整的markdown文本"""
+        sections = []
+        async for section in self.pack(project_path, custom_ignore, timeout):
+            sections.append(section)
+        return "".join(sections)
+
+
+def write_stats_json(stats: PackStats, destination: str) -> None:
+    """将统计报告写入文件，'-' 表示标准输出"""
+    import json
+
+    report = json.dumps(stats.to_dict(), ensure_ascii=False, indent=2)
+    if destination == "-":
+        print(report)
+    else:
+        Path(destination).write_text(report + "\n", encoding="utf-8")
+
+
+FINGERPRINT_RE = _LazyRegex(rb"<!-- ctxpack-fingerprint: ([0-9a-f]+) -->\s*$")
+OUTPUT_COMPRESSION = {".gz": "gzip", ".xz": "xz", ".zst": "zstd"}
+
+
+def _open_compressed(raw, compression: str, mode: str = "wb"):
+    """用对应的压缩格式包装已打开的二进制文件"""
+    if compression == "gzip":
+        import gzip
+
+        # mtime=0 使相同内容的压缩结果也相同
+        return gzip.GzipFile(fileobj=raw, mode=mode, mtime=0)
+    if compression == "xz":
+        import lzma
+
+        return lzma.LZMAFile(raw, mode)
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("写入或读取 .zst 文件需要安装 zstandard：pip install zstandard") from None
+    if mode == "wb":
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+    return zstandard.ZstdDecompressor().stream_reader(raw, closefd=False)
+
+
+def read_fingerprint(path: Path) -> str:
+    """读取已有输出末尾记录的内容指纹；文件不存在或没有指纹时返回空字符串"""
+    compression = OUTPUT_COMPRESSION.get(Path(path).suffix.lower())
+    try:
+        with open(path, "rb") as raw:
+            if compression is None:
+                raw.seek(max(0, os.fstat(raw.fileno()).st_size - 256))
+                tail = raw.read()
+            else:
+                # 压缩流无法从末尾读取，只能解压一遍并保留最后一段
+                tail = b""
+                with _open_compressed(raw, compression, "rb") as stream:
+                    while True:
+                        chunk = stream.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        tail = (tail + chunk)[-256:]
+    except (OSError, EOFError, ValueError):
+        return ""
+    match = FINGERPRINT_RE.search(tail)
+    return match.group(1).decode("ascii") if match else ""
+
+
+class PackWriter:
+    """流式写出打包结果：边写边计算内容指纹，按扩展名压缩，最后原子替换目标文件
+
+    内容先写入同目录的临时文件，完成后 os.replace；指纹与现有文件记录的相同时丢弃
+    临时文件，现有文件及其修改时间保持不变。压缩在后台线程中进行（zlib/lzma 压缩时
+    释放 GIL），与渲染重叠；队列有界，渲染快于压缩时写入会阻塞等待。
+    """
+
+    CHUNK_SIZE = 256 * 1024  # 交给压缩线程的批量大小
+    QUEUE_SIZE = 8
+
+    def __init__(self, path: Path):
+        import hashlib
+
+        self.path = Path(path)
+        self.compression = OUTPUT_COMPRESSION.get(self.path.suffix.lower())
+        self.hasher = hashlib.blake2b(digest_size=16)
+        self.fingerprint = ""
+        self.replaced = False  # 提交后：是否替换了目标文件
+        self.bytes_written = 0  # 未压缩的字节数
+        self._tmp_path = None
+        self._raw = None
+        self._stream = None
+        self._queue = None
+        self._thread = None
+        self._error = None
+        self._pending: List[bytes] = []
+        self._pending_size = 0
+
+    def __enter__(self) -> "PackWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+        return False
+
+    def _open(self) -> None:
+        # 临时文件以 0o666 创建，由内核套用 umask，权限与直接创建目标文件一致；
+        # 不读取或临时修改进程的 umask，并发打包的线程之间不会互相干扰
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+        while True:
+            tmp_path = str(self.path.parent / f".{self.path.name}.{os.urandom(6).hex()}.tmp")
+            try:
+                fd = os.open(tmp_path, flags, 0o666)
+                break
+            except FileExistsError:
+                continue
+        self._tmp_path = tmp_path
+        self._raw = os.fdopen(fd, "wb")
+        if self.compression is None:
+            self._stream = self._raw
+            return
+        import queue
+
+        self._stream = _open_compressed(self._raw, self.compression)
+        self._queue = queue.Queue(self.QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._compress, name="ctxpack-compress")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _compress(self) -> None:
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            if self._error is None:
+                try:
+                    self._stream.write(chunk)
+                except BaseException as e:  # 交给写入方抛出，继续取出队列避免其阻塞
+                    self._error = e
+
+    def write(self, text: str, fingerprint: bool = True) -> None:
+        """写出一段文本；fingerprint 为 False 的内容（如含生成时间的尾部）不计入指纹"""
+        if self._raw is None:
+            self._open()
+        data = text.encode("utf-8")
+        self.bytes_written += len(data)
+        if fingerprint:
+            self.hasher.update(data)
+        if self._queue is None:
+            self._stream.write(data)
+            return
+        if self._error is not None:
+            raise self._error
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= self.CHUNK_SIZE:
+            self._flush_pending()
+
+    def _flush_pending(self) -> None:
+        if self._pending:
+            self._queue.put(b"".join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+    def _close(self) -> None:
+        if self._queue is not None:
+            self._flush_pending()
+            self._queue.put(None)
+            self._thread.join()
+            self._queue = None
+        try:
+            if self._stream is not self._raw:
+                self._stream.close()
+        finally:
+            self._raw.close()
+        if self._error is not None:
+            raise self._error
+
+    def commit(self) -> bool:
+        """写入指纹并完成输出：内容有变化时原子替换目标文件，返回是否替换"""
+        self.fingerprint = self.hasher.hexdigest()
+        self.write(f"\n<!-- ctxpack-fingerprint: {self.fingerprint} -->\n", fingerprint=False)
+        try:
+            self._close()
+        except BaseException:
+            self.abort()
+            raise
+
+        if read_fingerprint(self.path) == self.fingerprint:
+            os.unlink(self._tmp_path)
+            self.replaced = False
+        else:
+            try:
+                # 替换已有文件时保留其权限
+                os.chmod(self._tmp_path, os.stat(self.path).st_mode & 0o7777)
+            except FileNotFoundError:
+                pass
+            os.replace(self._tmp_path, self.path)
+            self.replaced = True
+        self._tmp_path = None
+        return self.replaced
+
+    def abort(self) -> None:
+        """放弃输出，删除临时文件，目标文件保持不变"""
+        if self._raw is not None and not self._raw.closed:
+            try:
+                self._close()
+            except BaseException:
+                pass
+        if self._tmp_path is not None:
+            try:
+                os.unlink(self._tmp_path)
+            except OSError:
+                pass
+            self._tmp_path = None
+
+
+MANIFEST_VERSION = 1
+
+
+def manifest_path_for(output_path) -> str:
+    """打包输出对应的清单路径"""
+    return f"{output_path}.manifest.json"
+
+
+def slice_view(catalog: FileCatalog, index: int) -> List[str]:
+    """清单条目的可选第四项：只输出片段的文件记录已解析的选择器，整文件输出时为空"""
+    if index in catalog.slices:
+        return [catalog.slices[index][2]]
+    return []
+
+
+def write_manifest(catalog: FileCatalog, destination: str) -> None:
+    """写入打包清单：已包含文件的 (size, mtime, 摘要[, 选择器]) 与全部条目的状态，先写临时文件再替换
+
+    条目逐个写出，不在内存中拼出完整的清单对象。
+    """
+    import json
 
-def main():
+    def dump(value) -> str:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+    header = {
+        "version": MANIFEST_VERSION,
+        "root": catalog.root,
+        "generated": datetime.now().astimezone().strftime("%Y-%m-%d %H:%M:%S %Z"),
+    }
+    tmp_path = f"{destination}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(dump(header)[:-1] + ',"files":{')
+        separator = ""
+        for index in catalog.included:
+            digest = catalog.digests.get(index)
+            if digest is not None:
+                entry = [catalog.size[index], catalog.mtime[index], digest]
+                entry += slice_view(catalog, index)
+                f.write(f"{separator}{dump(catalog.relpath(index))}:{dump(entry)}")
+                separator = ","
+        f.write('},"tree":{')
+        separator = ""
+        for path, status in catalog.iter_tree_status():
+            f.write(f"{separator}{dump(path)}:{dump(status)}")
+            separator = ","
+        f.write("}}")
+    os.replace(tmp_path, destination)
+
+
+def load_manifest(path: str) -> Dict[str, Any]:
+    """读取打包清单；path 可以是清单本身，也可以是带清单的打包输出"""
+    import json
+
+    if not path.endswith(".json"):
+        path = manifest_path_for(path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"打包清单不存在: {path}（生成上一次打包时需使用 --manifest）")
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"不支持的打包清单版本: {manifest.get('version')}")
+    return manifest
+
+
+def main(argv: List[str] = None):
     parser = argparse.ArgumentParser(
         description="将项目文件夹打包成单个markdown文件，便于AI分析",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -615,7 +4214,9 @@ def main():
     parser.add_argument("project_path", help="项目文件夹路径")
     parser.add_argument("-o", "--output", help="输出文件路径（默认：项目名_context_时间戳.md）")
     parser.add_argument("--ignore", nargs="*", help="额外的忽略模式")
-    parser.add_argument("--suffixes", nargs="*", help="要包含的额外文件后缀列表（例如：.mdx .vue .astro）")
+    parser.add_argument(
+        "--suffixes", nargs="*", help="要包含的额外文件后缀列表（例如：.mdx .vue .astro）"
+    )
     parser.add_argument("--max-size", type=int, default=10, help="最大总大小(MB，默认：10)")
     parser.add_argument("--max-files", type=int, default=100, help="最大文件数量（默认：100）")
     parser.add_argument("-v", "--verbose", action="store_true", help="显示详细处理信息")
@@ -627,49 +4228,187 @@ def main():
         help="是否跟随软链接目录（默认：是）",
     )
     parser.add_argument("--no-follow-symlinks", action="store_true", help="不跟随软链接目录")
+    parser.add_argument(
+        "--walk-workers",
+        type=int,
+        default=1,
+        metavar="N",
+        help="并行列举目录的线程数，适用于网络/叠加文件系统上的超大目录树（默认：1）",
+    )
+    parser.add_argument(
+        "--tree-budget",
+        type=int,
+        metavar="LINES",
+        help="文件树行数预算，超出时只展开包含已收录文件的目录，其余折叠为摘要行",
+    )
+    parser.add_argument(
+        "--select",
+        action="append",
+        default=[],
+        metavar="SELECTOR",
+        help="只输出文件中选中的片段：path:120-340（行范围）或 path::Class.method（符号），"
+        "可重复，选中的文件排在最前面",
+    )
+    parser.add_argument(
+        "--select-file",
+        metavar="PATH",
+        help="从清单文件读取片段选择器（每行一个，# 开头为注释）",
+    )
+    parser.add_argument(
+        "--quota",
+        action="append",
+        default=[],
+        metavar="PATTERN:PERCENT",
+        help="按目录 glob 或文件名/扩展名划分总大小与文件数预算，可重复（例如 'src/**:60%%' '*.md:10%%'）；"
+        "先在各配额内选择，未用完的预算再分给其他文件",
+    )
+    parser.add_argument(
+        "--git-priority",
+        action="store_true",
+        help="结合本地 git 历史（最近修改、修改频率、与入口文件共同修改）调整文件优先级",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=default_cache_dir(),
+        help="持久化缓存目录（git 历史索引等，默认：~/.cache/context-packer）",
+    )
+    parser.add_argument("--no-cache", action="store_true", help="不读写持久化缓存")
+    parser.add_argument(
+        "--query",
+        help="按与查询文本的相关度（本地 BM25 索引）排序文件，取代默认优先级",
+    )
+    parser.add_argument(
+        "--generated-head",
+        type=int,
+        default=0,
+        metavar="N",
+        help="锁文件、压缩代码与自动生成的代码只保留前 N 行（默认：整个跳过）",
+    )
+    parser.add_argument(
+        "--keep-generated",
+        action="store_true",
+        help="不识别生成文件，按普通文件处理",
+    )
+    parser.add_argument(
+        "--near-dup",
+        type=float,
+        nargs="?",
+        const=0.8,
+        metavar="THRESHOLD",
+        help="把内容近似重复的文件聚类，每组完整输出一个代表文件，其余只输出差异"
+        "（相似度阈值 0-1，默认：0.8）",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=int,
+        metavar="MB",
+        help="内存预算（MB）：流式写出输出，限制预读，文件目录过大时移到磁盘",
+    )
+    parser.add_argument(
+        "--manifest",
+        action="store_true",
+        help="在输出文件旁写入打包清单（<输出>.manifest.json），供之后的 --delta-from 使用",
+    )
+    parser.add_argument(
+        "--delta-from",
+        metavar="PACK",
+        help="只输出相对上一次打包（打包文件或其清单）新增、修改和移除的文件；隐含 --manifest",
+    )
+    parser.add_argument(
+        "--stats-json", metavar="PATH", help="输出分阶段耗时与计数统计（JSON，'-' 表示标准输出）"
+    )
+    parser.add_argument("--profile", metavar="PATH", help="使用 cProfile 采样并写入 pstats 文件")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.near_dup is not None and not 0 < args.near_dup <= 1:
+        parser.error(f"--near-dup 相似度阈值应在 0-1 之间（不含 0）: {args.near_dup}")
 
     packer = ContextPacker()
+    try:
+        packer.quotas = [parse_quota(spec) for spec in args.quota]
+        BudgetQuotas(packer.quotas)
+        selectors = [parse_selector(spec) for spec in args.select]
+        if args.select_file:
+            selectors.extend(load_selectors(args.select_file))
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
+    for selector in selectors:
+        packer.selections.setdefault(selector.path, []).append(selector)
     packer.max_total_size = args.max_size * 1024 * 1024
+    packer.max_files = args.max_files
     packer.max_depth = args.max_depth
+    packer.tree_budget = args.tree_budget
+    packer.walk_workers = args.walk_workers
+    packer.git_priority = args.git_priority
+    packer.query = args.query
+    packer.manifest = args.manifest
+    packer.near_dup_threshold = args.near_dup
+    if args.max_memory is not None:
+        packer.max_memory = args.max_memory * 1024 * 1024
+    packer.skip_generated = not args.keep_generated
+    packer.generated_head = max(0, args.generated_head)
+    packer.cache_dir = None if args.no_cache else args.cache_dir
     packer.verbose = args.verbose
     packer.follow_symlinks = not args.no_follow_symlinks
-    
+    packer.collect_stats = bool(args.stats_json)
+    # 统计报告写到标准输出时不能混入进度信息，否则无法直接交给 jq 等工具解析
+    stats_to_stdout = args.stats_json == "-"
+    packer.quiet = stats_to_stdout
+    status_stream = sys.stderr if stats_to_stdout else sys.stdout
+
     # 处理自定义后缀列表
     if args.suffixes:
         for suffix in args.suffixes:
             # 确保后缀以点开头
-            if not suffix.startswith('.'):
-                suffix = '.' + suffix
+            if not suffix.startswith("."):
+                suffix = "." + suffix
             packer.text_extensions.add(suffix.lower())
 
     try:
         start_time = datetime.now()
+        if args.delta_from:
+            packer.delta_from = load_manifest(args.delta_from)
 
-        packer.pack_project(
-            project_path=args.project_path, output_path=args.output, custom_ignore=args.ignore or []
-        )
+        profiler = None
+        if args.profile:
+            import cProfile
+
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            packer.pack_project(
+                project_path=args.project_path,
+                output_path=args.output,
+                custom_ignore=args.ignore or [],
+            )
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(args.profile)
+                print(f"📈 性能剖析已写入: {args.profile}", file=status_stream)
 
         end_time = datetime.now()
         duration = (end_time - start_time).total_seconds()
 
         if args.verbose:
-            print(f"\\n⏱️  总耗时: {duration:.2f}秒")
+            print(f"\\n⏱️  总耗时: {duration:.2f}秒", file=status_stream)
+
+        if args.stats_json:
+            write_stats_json(packer.stats, args.stats_json)
 
     except FileNotFoundError as e:
-        print(f"❌ {e}")
-        print("请检查项目路径是否正确")
+        print(f"❌ {e}", file=status_stream)
+        print("请检查项目路径是否正确", file=status_stream)
         return 1
     except PermissionError as e:
-        print(f"❌ 权限错误: {e}")
-        print("请检查是否有足够的读写权限")
+        print(f"❌ 权限错误: {e}", file=status_stream)
+        print("请检查是否有足够的读写权限", file=status_stream)
         return 1
     except KeyboardInterrupt:
-        print("\\n⚠️  用户取消操作")
+        print("\\n⚠️  用户取消操作", file=status_stream)
         return 1
     except Exception as e:
-        print(f"❌ 未知错误: {e}")
+        print(f"❌ 未知错误: {e}", file=status_stream)
         if args.verbose:
             import traceback
 
@@ -3,9 +3,13 @@
 Basic tests for context_packer module.
 """
 
+import contextlib
+import io
 import os
+import subprocess
 import sys
 import tempfile
+import time
 import shutil
 from pathlib import Path
 
@@ -149,6 +153,1159 @@ def test_symlink_handling():
         assert "link_to_subdir" in content_no_follow or "link_to_file" in content_no_follow
 
 
+def test_pack_stats():
+    """Test per-stage timers and counters."""
+    # Disabled stats must not record anything
+    stats = context_packer.PackStats()
+    with stats.stage("walk"):
+        pass
+    stats.incr("stat")
+    assert stats.to_dict()["stages"] == {}
+    assert stats.to_dict()["counters"] == {}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_dir = Path(tmpdir) / "test_project"
+        test_dir.mkdir()
+        (test_dir / "README.md").write_text("# Stats")
+        (test_dir / "main.py").write_text("print('hi')")
+
+        packer = context_packer.ContextPacker()
+        packer.collect_stats = True
+        packer.pack_project(project_path=str(test_dir), output_path=str(Path(tmpdir) / "out.md"))
+
+        report = packer.stats.to_dict()
+        for stage in ["walk", "should_ignore", "is_text_file", "read", "render", "write"]:
+            assert stage in report["stages"]
+        counters = report["counters"]
+        assert counters["open"] == 2
+        assert counters["files_included"] == 2
+        assert counters["scandir"] >= 1
+        assert counters["bytes_read"] == len("# Stats") + len("print('hi')")
+        assert counters["bytes_emitted"] > counters["bytes_read"]
+
+        # Rendering time must not leak into the write stage
+        render = packer.render_file_section
+
+        def slow_render(catalog, index):
+            time.sleep(0.1)
+            return render(catalog, index)
+
+        packer = context_packer.ContextPacker()
+        packer.collect_stats = True
+        packer.render_file_section = slow_render
+        packer.pack_project(project_path=str(test_dir), output_path=str(Path(tmpdir) / "out.md"))
+        stages = packer.stats.to_dict()["stages"]
+        assert stages["write"]["seconds"] < 0.1
+        assert stages["write"]["calls"] > 1
+
+        # `--stats-json -` keeps stdout machine-readable
+        import json
+
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(io.StringIO()):
+            argv = [str(test_dir), "-o", str(Path(tmpdir) / "cli.md"), "--stats-json", "-", "-v"]
+            code = context_packer.main(argv + ["--cache-dir", str(Path(tmpdir) / "cache")])
+        assert code == 0
+        report = json.loads(stdout.getvalue())
+        assert report["counters"]["files_included"] == 2
+
+
+def test_lazy_startup():
+    """Test that --help does not pay for mimetypes, ignore-pattern or regex compilation."""
+    code = (
+        "import sys, context_packer\n"
+        "try:\n"
+        "    context_packer.main(['--help'])\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "assert 'mimetypes' not in sys.modules\n"
+        "assert isinstance(context_packer.DEFAULT_IGNORE_PATTERNS, frozenset)\n"
+        "lazy = [v for v in vars(context_packer).values()\n"
+        "        if isinstance(v, context_packer._LazyRegex)]\n"
+        "assert lazy and all(set(vars(v)) == {'pattern', 'flags'} for v in lazy)\n"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True)
+    assert result.returncode == 0, result.stderr.decode()
+
+    # A small pack with the persistent cache enabled does not import sqlite3
+    with tempfile.TemporaryDirectory() as tmpdir:
+        (Path(tmpdir) / "project").mkdir()
+        (Path(tmpdir) / "project" / "main.py").write_text("print('hi')\n")
+        code = (
+            "import sys, context_packer\n"
+            "args = ['project', '-o', 'out.md', '--cache-dir', 'cache']\n"
+            "assert context_packer.main(args) == 0\n"
+            "assert 'sqlite3' not in sys.modules\n"
+        )
+        env = dict(os.environ, PYTHONPATH=root)
+        result = subprocess.run(
+            [sys.executable, "-c", code], cwd=tmpdir, env=env, capture_output=True
+        )
+        assert result.returncode == 0, result.stderr.decode()
+
+    # Instances get their own mutable copies of the frozen tables
+    packer = context_packer.ContextPacker()
+    packer.text_extensions.add(".astro")
+    assert ".astro" not in context_packer.TEXT_EXTENSIONS
+
+
+def test_file_catalog():
+    """Test the columnar file catalog built by collect_files."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_dir = Path(tmpdir) / "test_project"
+        (test_dir / "src" / "pkg").mkdir(parents=True)
+        (test_dir / "README.md").write_text("# Catalog")
+        (test_dir / "logo.bin").write_bytes(b"\x00\x01")
+        for i in range(3):
+            (test_dir / "src" / "pkg" / f"mod{i}.py").write_text(f"x = {i}")
+        (test_dir / "src" / "notes.txt").write_text("notes")
+
+        packer = context_packer.ContextPacker()
+        packer.max_files = 3
+        catalog = packer.collect_files(test_dir, packer.default_ignore_patterns)
+
+        # Path segments are interned, directories hold contiguous sorted child ranges
+        assert catalog.segments.count("pkg") == 1
+        root_children = [
+            catalog.entry_name(i)
+            for i in range(catalog.root_start, catalog.root_start + catalog.root_count)
+        ]
+        assert root_children == ["README.md", "logo.bin", "src"]
+
+        status = catalog.file_status()
+        sep = os.sep
+        assert status["README.md"] == "included_high"
+        assert status["logo.bin"] == "skipped_binary"
+        assert status[f"src{sep}pkg{sep}mod0.py"] == "included_medium"
+        assert status[f"src{sep}pkg{sep}mod1.py"] == "included_medium"
+        # max_files keeps the highest-priority files
+        assert status[f"src{sep}pkg{sep}mod2.py"] == "skipped_limit"
+        assert status[f"src{sep}notes.txt"] == "skipped_limit"
+        assert [catalog.relpath(i) for i in catalog.included] == [
+            "README.md",
+            f"src{sep}pkg{sep}mod0.py",
+            f"src{sep}pkg{sep}mod1.py",
+        ]
+
+        tree = packer.get_file_tree(test_dir, packer.default_ignore_patterns, catalog)
+        assert "    └── pkg" in tree
+        assert "mod0.py ☑️" in tree
+        assert "notes.txt 🚫" in tree
+
+
+def test_encoding_detection():
+    """Test BOM/UTF-8/statistical encoding detection and lossless decoding."""
+    chinese = "# 重试逻辑\nprint('你好，世界')\n" * 20
+    latin = "café naïve résumé déjà\n" * 20
+    assert context_packer.detect_encoding(chinese.encode("utf-8")) == "utf-8"
+    assert context_packer.detect_encoding(chinese.encode("gbk")) == "gb18030"
+    assert context_packer.detect_encoding(chinese.encode("utf-16")) == "utf-16"
+    assert context_packer.detect_encoding(latin.encode("latin-1")) == "cp1252"
+
+    # Truncation decodes only the kept lines but matches truncate_content
+    data = "".join(f"第{i}行\r\n" for i in range(2000)).encode("gbk")
+    packer = context_packer.ContextPacker()
+    expected = packer.truncate_content(data.decode("gbk").replace("\r\n", "\n"))
+    assert context_packer.decode_text(data, "gb18030") == expected
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_dir = Path(tmpdir) / "test_project"
+        test_dir.mkdir()
+        (test_dir / "gbk.py").write_bytes(chinese.encode("gbk"))
+        (test_dir / "latin.txt").write_bytes(latin.encode("latin-1"))
+        (test_dir / "utf8.md").write_text("# 说明", encoding="utf-8")
+
+        packer.collect_stats = True
+        output_file = Path(tmpdir) / "out.md"
+        packer.pack_project(project_path=str(test_dir), output_path=str(output_file))
+
+        content = output_file.read_text(encoding="utf-8")
+        assert "print('你好，世界')" in content
+        assert "café naïve résumé" in content
+        counters = packer.stats.to_dict()["counters"]
+        assert counters["non_utf8_files"] == 2
+        assert counters["encoding.gb18030"] == 1
+        assert counters["encoding_cache_miss"] == 3
+
+        # Unchanged files reuse the cached encoding
+        packer.pack_project(project_path=str(test_dir), output_path=str(output_file))
+        assert packer.stats.to_dict()["counters"]["encoding_cache_hit"] == 3
+
+
+def test_async_pack():
+    """Test the asyncio API: streamed sections, timeouts and quiet output."""
+    import asyncio
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_dir = Path(tmpdir) / "test_project"
+        test_dir.mkdir()
+        (test_dir / "README.md").write_text("# Async")
+        for i in range(12):
+            (test_dir / f"mod{i:02d}.py").write_text(f"value = {i}")
+
+        async_packer = context_packer.AsyncContextPacker(read_ahead=3)
+
+        async def collect():
+            return [section async for section in async_packer.pack(str(test_dir))]
+
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            sections = asyncio.run(collect())
+        assert stdout.getvalue() == ""
+        # header + one section per file + footer, in priority order
+        assert len(sections) == 15
+        assert sections[0].startswith("# test_project - 项目上下文")
+        assert "### README.md" in sections[1]
+        assert "value = 0" in sections[2] and "value = 11" in sections[13]
+        assert "Context Packer 自动生成" in sections[-1]
+
+        sync_packer = context_packer.ContextPacker()
+        ignore = sync_packer.build_ignore_patterns(test_dir.resolve())
+        expected = sync_packer.generate_markdown(test_dir.resolve(), ignore)
+        assert "".join(sections[:-1]) == expected[: expected.index("\n---\n")]
+
+        async def with_timeout():
+            try:
+                await async_packer.pack_to_string(str(test_dir), timeout=0)
+            except asyncio.TimeoutError:
+                return True
+            return False
+
+        assert asyncio.run(with_timeout())
+
+        # A timeout after the walk also stops the per-file stages still running in the pool
+        calls = []
+
+        def slow_generated(catalog, index):
+            calls.append(index)
+            time.sleep(0.05)
+            return ""
+
+        base = context_packer.ContextPacker()
+        base.generated_reason = slow_generated
+        slow_packer = context_packer.AsyncContextPacker(base)
+
+        async def timed_out():
+            try:
+                await slow_packer.pack_to_string(str(test_dir), timeout=0.2)
+            except asyncio.TimeoutError:
+                return True
+            return False
+
+        assert asyncio.run(timed_out())
+        seen = len(calls)
+        time.sleep(0.3)
+        assert len(calls) <= seen + 1 < 13
+
+
+def test_symlink_farm_lists_each_directory_once():
+    """Test inode-based dedupe of directories reached through many symlinks."""
+    if sys.platform.startswith('win'):
+        return
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        real_tree = Path(tmpdir) / "real"
+        (real_tree / "core").mkdir(parents=True)
+        (real_tree / "core" / "engine.py").write_text("def run():\n    pass")
+        (real_tree / "core" / "loop").symlink_to(real_tree)
+
+        farm = Path(tmpdir) / "farm"
+        farm.mkdir()
+        (farm / "a").symlink_to(real_tree)
+        (farm / "b").symlink_to(real_tree)
+        (farm / "c").symlink_to(real_tree / "core")
+
+        packer = context_packer.ContextPacker()
+        catalog = packer.collect_files(farm, packer.default_ignore_patterns)
+        sep = os.sep
+        assert [catalog.relpath(i) for i in catalog.included] == [f"a{sep}core{sep}engine.py"]
+
+        tree = packer.get_file_tree(farm, packer.default_ignore_patterns, catalog)
+        assert "b 🔗📁 → a" in tree
+        assert f"c 🔗📁 → a{sep}core" in tree
+        assert "循环引用" in tree  # core/loop points back at a
+        assert tree.count("engine.py") == 1
+
+
+def test_summary_tree():
+    """Test budgeted tree rendering that collapses directories without included files."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_dir = Path(tmpdir) / "test_project"
+        (test_dir / "assets" / "img").mkdir(parents=True)
+        for i in range(200):
+            (test_dir / "assets" / "img" / f"pic{i}.bin").write_bytes(b"\x00" * 10)
+        (test_dir / "src").mkdir()
+        (test_dir / "src" / "main.py").write_text("print('hi')")
+        for i in range(50):
+            (test_dir / "src" / f"blob{i}.bin").write_bytes(b"\x00")
+        for i in range(15):
+            (test_dir / f"data{i:02d}").mkdir()
+            (test_dir / f"data{i:02d}" / "rows.bin").write_bytes(b"\x00" * 4)
+
+        packer = context_packer.ContextPacker()
+        catalog = packer.collect_files(test_dir, packer.default_ignore_patterns)
+
+        # Within budget the full tree is rendered
+        packer.tree_budget = len(catalog)
+        full_tree = packer.get_file_tree(test_dir, packer.default_ignore_patterns, catalog)
+        assert "pic199.bin" in full_tree
+
+        packer.tree_budget = 20
+        tree = packer.get_file_tree(test_dir, packer.default_ignore_patterns, catalog)
+        lines = tree.split("\n")
+        assert len(lines) <= 20
+        assert "├── assets/ (200 个文件, 2.0KB, 0 个已包含)" in lines
+        assert "│   ├── main.py ☑️" in lines
+        assert "│   └── … 其余 50 个文件 (50B, 未包含)" in lines
+        # Only the first collapsed directories get their own line
+        assert "data08/ (1 个文件, 4B, 0 个已包含)" in tree
+        assert "data09" not in tree
+        assert lines[-1] == "└── … 其余 6 个目录、6 个文件 (24B, 未包含)"
+
+    # Too many included files: the deepest directories collapse until the tree fits
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_dir = Path(tmpdir) / "many"
+        for a in range(4):
+            for b in range(5):
+                sub = test_dir / f"pkg{a}" / f"mod{b}"
+                sub.mkdir(parents=True)
+                for c in range(6):
+                    (sub / f"f{c}.py").write_text("x = 1\n")
+
+        packer = context_packer.ContextPacker()
+        packer.max_files = 1000
+        catalog = packer.collect_files(test_dir, packer.default_ignore_patterns)
+        assert len(catalog.included) == 120
+
+        packer.tree_budget = 30
+        lines = packer.get_file_tree(test_dir, packer.default_ignore_patterns, catalog).split("\n")
+        assert len(lines) <= 30
+        assert "│   ├── mod0/ (6 个文件, 36B, 6 个已包含)" in lines
+        assert not any("f0.py" in line for line in lines)
+
+        packer.tree_budget = 8
+        lines = packer.get_file_tree(test_dir, packer.default_ignore_patterns, catalog).split("\n")
+        assert len(lines) <= 8
+        assert "├── pkg0/ (30 个文件, 180B, 30 个已包含)" in lines
+
+
+def test_parallel_walk():
+    """Test that the parallel walker matches the sequential one and handles deep trees."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_dir = Path(tmpdir) / "p"
+        for a in range(6):
+            for b in range(4):
+                sub = test_dir / f"pkg{a}" / f"mod{b}"
+                sub.mkdir(parents=True)
+                for c in range(3):
+                    (sub / f"f{c}.py").write_text(f"x = {a}{b}{c}")
+        if not sys.platform.startswith('win'):
+            (test_dir / "alias").symlink_to(test_dir / "pkg3")
+            (test_dir / "pkg0" / "up").symlink_to(test_dir)
+
+        # Deeper than the recursion limit used below
+        deep = test_dir / "d"
+        deep.mkdir()
+        for _ in range(300):
+            deep = deep / "d"
+            deep.mkdir()
+        (deep / "leaf.txt").write_text("bottom")
+
+        def snapshot(workers):
+            packer = context_packer.ContextPacker()
+            packer.walk_workers = workers
+            packer.max_total_size = 1 << 40
+            packer.max_files = 1000
+            catalog = packer.collect_files(test_dir, packer.default_ignore_patterns)
+            tree = packer.get_file_tree(test_dir, packer.default_ignore_patterns, catalog)
+            return tree, [catalog.relpath(i) for i in catalog.included]
+
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(200)
+        try:
+            sequential = snapshot(1)
+            for _ in range(3):
+                assert snapshot(8) == sequential
+        finally:
+            sys.setrecursionlimit(limit)
+        assert sequential[1][-1].endswith("leaf.txt")
+        assert len(sequential[1]) == 6 * 4 * 3 + 1
+
+
+def test_git_priority():
+    """Test that git history reorders files and the history index updates incrementally."""
+    if shutil.which("git") is None:
+        return
+    with tempfile.TemporaryDirectory() as tmpdir:
+        repo = Path(tmpdir) / "repo"
+        (repo / "src").mkdir(parents=True)
+        cache_dir = Path(tmpdir) / "cache"
+        day = 86400
+        now = 1700000000
+
+        def commit(when, **files):
+            for name, content in files.items():
+                (repo / "src" / name).write_text(content)
+            date = f"@{when} +0000"
+            env = dict(os.environ, GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date)
+            git = ["git", "-C", str(repo), "-c", "user.name=t", "-c", "user.email=t@t"]
+            subprocess.run(git + ["add", "-A"], check=True)
+            subprocess.run(git + ["commit", "-q", "-m", "c"], check=True, env=env)
+
+        subprocess.run(["git", "init", "-q", str(repo)], check=True)
+        commit(now - 400 * day, **{"cold.py": "a = 1", "hot.py": "b = 1"})
+        for i in range(5):
+            commit(now - (5 - i) * day, **{"hot.py": f"b = {i}"})
+
+        def included(git_priority):
+            packer = context_packer.ContextPacker()
+            packer.git_priority = git_priority
+            packer.cache_dir = str(cache_dir)
+            packer.collect_stats = True
+            packer.stats = context_packer.PackStats(enabled=True)
+            packer.max_files = 1
+            catalog = packer.collect_files(repo / "src", packer.default_ignore_patterns)
+            return [catalog.relpath(i) for i in catalog.included], packer.stats.counters
+
+        assert included(False)[0] == ["cold.py"]
+        files, counters = included(True)
+        assert files == ["hot.py"]
+        assert counters["git_commits_read"] == 6
+
+        # Cached index: unchanged HEAD reads nothing, a new commit reads only that commit
+        assert included(True)[1].get("git_commits_read", 0) == 0
+        commit(now, **{"cold.py": "a = 2"})
+        assert included(True)[1]["git_commits_read"] == 1
+
+
+def test_query_ranking():
+    """Test BM25 query ranking, identifier splitting and incremental index updates."""
+    assert context_packer.tokenize("uploadClient retry_logic HTTPServer") == [
+        "upload", "client", "retry", "logic", "http", "server"
+    ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_dir = Path(tmpdir) / "project"
+        (test_dir / "src" / "net").mkdir(parents=True)
+        (test_dir / "README.md").write_text("# Project\n")
+        (test_dir / "src" / "config.py").write_text("def load_config():\n    pass\n")
+        (test_dir / "src" / "net" / "client.py").write_text(
+            "class UploadClient:\n"
+            "    # send with retry on failure\n"
+            "    def send(self):\n"
+            "        pass\n"
+        )
+        cache_dir = Path(tmpdir) / "cache"
+
+        def ranked(query):
+            packer = context_packer.ContextPacker()
+            packer.query = query
+            packer.cache_dir = str(cache_dir)
+            packer.stats = context_packer.PackStats(enabled=True)
+            catalog = packer.collect_files(test_dir, packer.default_ignore_patterns)
+            return [catalog.relpath(i) for i in catalog.included], packer.stats.counters
+
+        files, counters = ranked("add retry logic to the upload client")
+        assert files[0] == os.path.join("src", "net", "client.py")
+        assert counters["query_index_updated"] == 3
+        files, counters = ranked("config loader")
+        assert files[0] == os.path.join("src", "config.py")
+        assert counters.get("query_index_updated", 0) == 0
+
+        (test_dir / "README.md").write_text("# Project\nConfig loading lives in src.\n")
+        assert ranked("config")[1]["query_index_updated"] == 1
+
+        # Files that are gone drop out of the index
+        (test_dir / "src" / "config.py").unlink()
+        assert ranked("config")[1]["query_index_reused"] == 2
+        index = context_packer.QueryIndex.open(str(test_dir), str(cache_dir))
+        try:
+            paths = {path for (path,) in index.db.execute("SELECT path FROM docs")}
+            postings = index.db.execute("SELECT COUNT(DISTINCT doc) FROM postings").fetchone()
+        finally:
+            index.close()
+        assert paths == {"README.md", os.path.join("src", "net", "client.py")}
+        assert postings == (2,)
+
+        # Large data files are ranking candidates, but only their prefix is indexed
+        (test_dir / "events.jsonl").write_text(
+            '{"event": "noop"}\n' * 70000 + '{"event": "upload retry client"}\n'
+        )
+        files, counters = ranked("add retry logic to the upload client")
+        assert files[0] == os.path.join("src", "net", "client.py")
+        assert "events.jsonl" in files
+        assert counters["query_index_truncated"] == 1
+
+
+def test_delta_pack():
+    """Test that delta packs emit only added/changed sections and reuse manifest digests."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_dir = Path(tmpdir) / "project"
+        (test_dir / "src").mkdir(parents=True)
+        (test_dir / "README.md").write_text("# Project\n")
+        for name in ("keep", "edit", "gone", "touch"):
+            (test_dir / "src" / f"{name}.py").write_text(f"name = '{name}'\n")
+
+        first = Path(tmpdir) / "v1.md"
+        packer = context_packer.ContextPacker()
+        packer.manifest = True
+        packer.pack_project(str(test_dir), str(first))
+        assert Path(f"{first}.manifest.json").exists()
+
+        (test_dir / "src" / "edit.py").write_text("name = 'edited'\n")
+        (test_dir / "src" / "gone.py").unlink()
+        (test_dir / "src" / "new.py").write_text("name = 'new'\n")
+        stat = (test_dir / "src" / "touch.py").stat()
+        os.utime(test_dir / "src" / "touch.py", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        packer = context_packer.ContextPacker()
+        packer.delta_from = context_packer.load_manifest(str(first))
+        packer.collect_stats = True
+        delta = packer.pack_project(str(test_dir), str(Path(tmpdir) / "v2.md"))
+
+        assert "### src/edit.py" in delta and "### src/new.py" in delta
+        assert "### src/keep.py" not in delta and "### src/touch.py" not in delta
+        assert "- src/gone.py" in delta and "+ src/new.py" in delta
+        counters = packer.stats.counters
+        assert counters["delta_signature_hit"] == 2  # README.md and keep.py are not read
+        assert counters["delta_unchanged"] == 3
+        # The new manifest describes the full current state, so deltas chain
+        chained = context_packer.load_manifest(str(Path(tmpdir) / "v2.md"))
+        assert len(chained["files"]) == 5
+
+
+def test_generated_detection():
+    """Test that lockfiles, minified bundles and marked generated code are skipped."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_dir = Path(tmpdir) / "project"
+        (test_dir / "src").mkdir(parents=True)
+        (test_dir / "README.md").write_text("# Project\n" + "Plain prose. " * 200 + "\n")
+        (test_dir / "package-lock.json").write_text('{\n  "lockfileVersion": 3\n}\n' * 50)
+        (test_dir / "src" / "app.py").write_text("print('hi')\n")
+        (test_dir / "src" / "vendor.js").write_text("var a=1;" * 2000)
+        (test_dir / "src" / "api.py").write_text(
+            "# Code generated by protoc-gen. DO NOT EDIT.\n" + "x = 1\n" * 100
+        )
+        (test_dir / "src" / "server.go").write_text(
+            "// Copyright 2024 Example\n\n// Code generated by mockgen. DO NOT EDIT.\n\n"
+            "package main\n"
+        )
+        # 只在代码或正文里提到生成标记的文件不是生成文件
+        (test_dir / "src" / "checker.py").write_text(
+            'MARKERS = ("@generated", "DO NOT EDIT")\n\n\ndef is_generated(text):\n'
+            "    return any(marker in text for marker in MARKERS)\n"
+        )
+        (test_dir / "GUIDE.md").write_text(
+            "# Guide\n\nFiles whose header says DO NOT EDIT are skipped.\n"
+        )
+
+        packer = context_packer.ContextPacker()
+        packer.stats = context_packer.PackStats(enabled=True)
+        catalog = packer.collect_files(test_dir, packer.default_ignore_patterns)
+        status = catalog.file_status()
+        generated = ["package-lock.json", os.path.join("src", "vendor.js")]
+        marked = [os.path.join("src", "api.py"), os.path.join("src", "server.go")]
+        for name in generated + marked:
+            assert status[name] == "skipped_generated", name
+        assert status["README.md"] == "included_high"
+        assert status["GUIDE.md"] == "included_low"
+        assert status[os.path.join("src", "app.py")] == "included_medium"
+        assert status[os.path.join("src", "checker.py")] == "included_medium"
+        with open(context_packer.__file__, "rb") as f:
+            prefix = f.read(context_packer.GENERATED_PREFIX_SIZE)
+        assert context_packer.generated_reason("context_packer.py", prefix) == ""
+        tree = packer.get_file_tree(test_dir, packer.default_ignore_patterns, catalog)
+        assert "package-lock.json 🏭" in tree
+
+        # Verdicts are cached per (size, mtime) signature
+        catalog = packer.collect_files(test_dir, packer.default_ignore_patterns)
+        assert packer.stats.counters["generated_cache_hit"] == 7
+
+        # Verdicts persist in cache_dir, so a new run skips the prefix reads and encoding checks
+        cache_dir = Path(tmpdir) / "cache"
+
+        def fresh_pack(max_memory=None):
+            fresh = context_packer.ContextPacker()
+            fresh.cache_dir = str(cache_dir)
+            fresh.max_memory = max_memory
+            fresh.stats = context_packer.PackStats(enabled=True)
+            fresh.generate_markdown(test_dir, fresh.default_ignore_patterns)
+            return fresh.stats.counters
+
+        # Fewer verdicts than one batch: small projects never create a cache file
+        fresh_pack()
+        assert not (cache_dir / "verdicts").exists()
+
+        batch = context_packer.VerdictCache.FLUSH_ROWS
+        context_packer.VerdictCache.FLUSH_ROWS = 4
+        try:
+            (test_dir / "src" / "extra.py").write_text("extra = 1\n")
+            counters = fresh_pack()
+            assert counters["generated_cache_miss"] == 8 and counters["encoding_cache_miss"] == 5
+            (test_dir / "src" / "extra.py").unlink()
+            for max_memory in (None, 64 * 1024 * 1024):
+                counters = fresh_pack(max_memory)
+                assert counters["generated_cache_hit"] == 7
+                assert "generated_cache_miss" not in counters
+                assert "generated_prefix_bytes" not in counters
+                assert counters["encoding_cache_hit"] == 4 and "encoding_cache_miss" not in counters
+        finally:
+            context_packer.VerdictCache.FLUSH_ROWS = batch
+
+        # A full pack drops the verdicts of files it no longer sees
+        import sqlite3
+
+        (db_path,) = (cache_dir / "verdicts").glob("*.sqlite")
+        with contextlib.closing(sqlite3.connect(str(db_path))) as db:
+            paths = [bytes(path).decode() for (path,) in db.execute("SELECT path FROM verdicts")]
+        assert len(paths) == 11 and not any(path.endswith("extra.py") for path in paths)
+
+        # With --generated-head the files are included, truncated to their first lines
+        packer.generated_head = 3
+        content = packer.generate_markdown(test_dir, packer.default_ignore_patterns)
+        assert "DO NOT EDIT" in content and "仅保留前 3 行" in content
+        assert content.count('"lockfileVersion"') == 1
+
+        # The head is read directly, not taken from the 500-line/10k-char truncated text
+        lock = "".join(f"  resolution-{i:04d}: integrity sha512-abc\n" for i in range(2000))
+        (test_dir / "pnpm-lock.yaml").write_text(lock)
+        packer.generated_head = 300
+        content = packer.generate_markdown(test_dir, packer.default_ignore_patterns)
+        assert "resolution-0299:" in content and "resolution-0300:" not in content
+        assert "resolution-0299: integrity sha512-abc\n\n... (生成文件，仅保留前 300 行) ..." in content
+        assert "省略" not in content
+
+        # Lockfiles are recognised by name before the text-suffix and size checks
+        lock_dir = Path(tmpdir) / "locks"
+        lock_dir.mkdir()
+        (lock_dir / "yarn.lock").write_text('"left-pad@^1.3.0":\n  version "1.3.0"\n')
+        (lock_dir / "Cargo.lock").write_text("[[package]]\n" * 200000)  # > max_file_size
+        (lock_dir / "main.py").write_text("print('hi')\n")
+        packer = context_packer.ContextPacker()
+        catalog = packer.collect_files(lock_dir, packer.default_ignore_patterns)
+        status = catalog.tree_status()
+        assert status["yarn.lock"] == "skipped_generated"
+        assert status["Cargo.lock"] == "skipped_generated"
+        tree = packer.get_file_tree(lock_dir, packer.default_ignore_patterns, catalog)
+        assert "yarn.lock 🏭" in tree and "Cargo.lock 🏭" in tree
+
+        packer.generated_head = 2
+        content = packer.generate_markdown(lock_dir, packer.default_ignore_patterns)
+        assert '"left-pad@^1.3.0":\n  version "1.3.0"' in content
+        assert "[[package]]\n[[package]]\n\n... (生成文件，仅保留前 2 行) ..." in content
+
+
+def test_data_reducers():
+    """Test that notebooks keep cell sources and large data files are reduced to a schema."""
+    import json
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_dir = Path(tmpdir) / "project"
+        test_dir.mkdir()
+        plot = {"output_type": "display_data", "data": {"image/png": "iVBORw0KGgo" * 200000}}
+        steps = [f"step {i}\n" for i in range(50)]
+        log = {"output_type": "stream", "name": "stdout", "text": steps}
+        notebook = {
+            "nbformat": 4,
+            "metadata": {},
+            "cells": [
+                {"cell_type": "markdown", "source": ["# Training run"]},
+                {"cell_type": "code", "source": ["model.fit(data)"], "outputs": [log, plot]},
+            ],
+        }
+        (test_dir / "train.ipynb").write_text(json.dumps(notebook))
+        with open(test_dir / "rows.csv", "w") as f:
+            f.write("id,label,score\n")
+            for i in range(5000):
+                f.write(f"{i},item{i},{i / 7:.3f}\n")
+        (test_dir / "package.json").write_text('{"name": "demo"}\n')
+        # 超过编码检测样本的 UTF-8 中文 CSV，样本恰好截断在一个汉字中间
+        rows = "".join(f"用户{i},北京市,{i}\n" for i in range(6000)).encode("utf-8")
+        sample = context_packer.ENCODING_SAMPLE_SIZE
+        for pad in range(3):
+            data = b"name,city,n" + b" " * pad + b"\n" + rows
+            if 0x80 <= data[sample] < 0xC0:
+                break
+        assert len(data) > sample and 0x80 <= data[sample] < 0xC0
+        (test_dir / "users.csv").write_bytes(data)
+
+        packer = context_packer.ContextPacker()
+        packer.stats = context_packer.PackStats(enabled=True)
+        content = packer.generate_markdown(test_dir, packer.default_ignore_patterns)
+
+        # The notebook is over max_file_size but is included with its outputs trimmed
+        assert (test_dir / "train.ipynb").stat().st_size > packer.max_file_size
+        assert "# %% [markdown]\n# # Training run" in content
+        assert "model.fit(data)" in content and "# > step 9\n" in content
+        assert "# > step 10\n" not in content and "iVBORw0KGgo" not in content
+        assert "[image/png 输出" in content
+        # Data files become an inferred schema, sample rows and a row count
+        assert "5000 行 × 3 列" in content and "#   score: float" in content
+        assert "item4999" not in content
+        assert '{"name": "demo"}' in content  # small files stay verbatim
+        assert packer.stats.counters["reduced.notebook"] == 1
+        assert packer.stats.counters["reduced.csv"] == 2
+        assert "用户0,北京市" in content and "6000 行 × 3 列" in content
+
+
+def test_near_duplicate_clustering():
+    """Test that near-duplicate files render as diffs against one representative."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_dir = Path(tmpdir) / "project"
+        (test_dir / "config").mkdir(parents=True)
+        base = [f"setting_{i} = 'value number {i} for this service'" for i in range(120)]
+        for env, changed in (("dev", 3), ("prod", 40), ("stage", 77), ("copy", None)):
+            lines = list(base)
+            if changed is not None:
+                lines[changed] = f"setting_{changed} = '{env} override'"
+            (test_dir / "config" / f"{env}.py").write_text("\n".join(lines) + "\n")
+        (test_dir / "config" / "base.py").write_text("\n".join(base) + "\n")
+        (test_dir / "main.py").write_text(
+            "def main():\n    run_the_application(with_all=True, services=load())\n" * 5
+        )
+
+        packer = context_packer.ContextPacker()
+        packer.near_dup_threshold = 0.8
+        packer.stats = context_packer.PackStats(enabled=True)
+        content = packer.generate_markdown(test_dir, packer.default_ignore_patterns)
+
+        rep = os.path.join("config", "base.py")
+        assert content.count("value number 50 for this service") == 1
+        assert f"> 与 {rep} 近似重复" in content
+        assert "+setting_40 = 'prod override'" in content
+        assert f"### {os.path.join('config', 'copy.py')}\n\n> 与 {rep} 内容相同" in content
+        assert "def main():" in content  # unrelated files are rendered in full
+        counters = packer.stats.counters
+        assert counters["near_dup_clusters"] == 1 and counters["near_dup_files"] == 4
+        assert counters["near_dup_bytes_saved"] > 0
+
+        # The representative's text is released once its last member is rendered
+        catalog = packer.collect_files(test_dir, packer.default_ignore_patterns)
+        last = max(catalog.included.index(index) for index in catalog.near_dup)
+        sections = packer.iter_sections(catalog)
+        for _ in range(last):
+            next(sections)
+        assert catalog.rep_text_bytes > 0
+        next(sections)
+        assert catalog.rep_text_bytes == 0
+        assert set(catalog.rep_texts.values()) == {None}
+
+        # Under a memory budget too small for it the text is re-read for each member
+        packer.max_memory = 64
+        packer.stats = context_packer.PackStats(enabled=True)
+        capped = packer.generate_markdown(test_dir, packer.default_ignore_patterns)
+        assert capped.split("*生成时间")[0] == content.split("*生成时间")[0]
+        assert packer.stats.counters["near_dup_reread"] > 0
+        packer.max_memory = None
+
+        # A stricter threshold keeps the exact copy but drops less similar files
+        packer.near_dup_threshold = 0.99
+        packer.stats = context_packer.PackStats(enabled=True)
+        content = packer.generate_markdown(test_dir, packer.default_ignore_patterns)
+        assert 1 <= packer.stats.counters["near_dup_files"] < 4
+        assert "内容相同" in content
+
+        for bad in ("0", "-0.5", "1.5", "nan"):
+            with contextlib.redirect_stderr(io.StringIO()):
+                try:
+                    context_packer.main(["--near-dup", bad, str(test_dir)])
+                except SystemExit as e:
+                    assert e.code == 2
+                else:
+                    raise AssertionError(bad)
+
+
+def test_memory_capped_pack():
+    """Test that --max-memory streams output, spills the catalog and keeps memory bounded."""
+    import tracemalloc
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_dir = Path(tmpdir) / "project"
+        line = "value = compute(alpha, beta, gamma)  # padding to make the file larger\n"
+        for package in range(4):
+            sub = test_dir / f"pkg{package}"
+            sub.mkdir(parents=True)
+            for module in range(25):
+                (sub / f"mod{module}.py").write_text(line * 600)  # ~43KB each, ~4.3MB total
+
+        def pack(max_memory, output):
+            packer = context_packer.ContextPacker()
+            packer.max_files = 10000
+            packer.max_total_size = 1 << 30
+            packer.max_memory = max_memory
+            packer.collect_stats = True
+            tracemalloc.start()
+            try:
+                packer.pack_project(str(test_dir), str(output))
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            return packer, peak
+
+        def read(output):
+            text = output.read_text(encoding="utf-8")
+            return [line for line in text.split("\n") if not line.startswith("*生成时间")]
+
+        budget = 4 * 1024 * 1024
+        uncapped_output = Path(tmpdir) / "uncapped.md"
+        _, uncapped_peak = pack(None, uncapped_output)
+        assert uncapped_peak > budget  # the whole output is built in memory
+
+        capped_output = Path(tmpdir) / "capped.md"
+        packer, capped_peak = pack(budget, capped_output)
+        assert capped_peak < budget, capped_peak
+        assert read(capped_output) == read(uncapped_output)
+
+        # A budget smaller than the catalog spills it to disk without changing the output
+        spilled_output = Path(tmpdir) / "spilled.md"
+        packer, _ = pack(16 * 1024, spilled_output)
+        assert packer.stats.counters["catalog_spilled_bytes"] > 0
+        assert read(spilled_output) == read(uncapped_output)
+
+        # The budget also holds for the process RSS. The pack runs in a process forked from a
+        # fresh interpreter: a spawned child would inherit this process's peak as its own
+        code = (
+            "import os, sys, json, sqlite3, context_packer\n"
+            "pid = os.fork()\n"
+            "if pid:\n"
+            "    sys.exit(os.waitpid(pid, 0)[1] >> 8)\n"
+            "base = context_packer.peak_rss()\n"
+            "args = ['project', '-o', 'rss.md', '--max-files', '10000', '--max-size', '1024']\n"
+            "assert context_packer.main(args + ['--no-cache'] + sys.argv[1:]) == 0\n"
+            "print('RSS_GROWTH', context_packer.peak_rss() - base, flush=True)\n"
+            "os._exit(0)\n"
+        )
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=root)
+
+        def rss_growth(*args):
+            result = subprocess.run(
+                [sys.executable, "-c", code, *args], cwd=tmpdir, env=env, capture_output=True
+            )
+            assert result.returncode == 0, result.stderr.decode()
+            stdout = result.stdout.decode("utf-8")
+            return int(stdout.split("RSS_GROWTH ")[1]), "峰值内存" in stdout
+
+        if hasattr(os, "fork") and context_packer.peak_rss():
+            rss_budget = 8 * 1024 * 1024
+            uncapped_growth, reported = rss_growth()
+            assert uncapped_growth > rss_budget
+            assert not reported  # the peak is only reported with --max-memory or --stats-json
+            capped_growth, reported = rss_growth("--max-memory", "8")
+            assert capped_growth < rss_budget, capped_growth
+            assert reported
+
+
+def test_memory_capped_large_tree():
+    """Test that a catalog larger than the memory budget is spilled while the tree is walked."""
+    import tracemalloc
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_dir = Path(tmpdir) / "project"
+        for package in range(80):
+            sub = test_dir / f"pkg{package:02d}"
+            sub.mkdir(parents=True)
+            for module in range(100):
+                (sub / f"module_{module:03d}.py").write_text("x = 1\n")
+        links = not sys.platform.startswith("win")
+        if links:  # resolved against the spilled directory table
+            (test_dir / "zz_alias").symlink_to(test_dir / "pkg05")
+            (test_dir / "pkg79" / "up").symlink_to(test_dir)
+
+        budget = 512 * 1024
+        packer = context_packer.ContextPacker()
+        catalog = packer.scan_catalog(test_dir, packer.default_ignore_patterns)
+        assert catalog.memory_usage() > budget  # the in-memory catalog alone exceeds the budget
+        del catalog
+        uncapped_output = Path(tmpdir) / "uncapped.md"
+        packer.pack_project(str(test_dir), str(uncapped_output))
+
+        packer = context_packer.ContextPacker()
+        packer.max_memory = budget
+        packer.collect_stats = True
+        capped_output = Path(tmpdir) / "capped.md"
+        tracemalloc.start()
+        try:
+            packer.pack_project(str(test_dir), str(capped_output))
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert peak < budget, peak
+        assert packer.stats.counters["catalog_spilled_bytes"] > 0
+
+        def read(output):
+            text = output.read_text(encoding="utf-8")
+            return [line for line in text.split("\n") if not line.startswith("*生成时间")]
+
+        assert read(capped_output) == read(uncapped_output)
+        capped = capped_output.read_text(encoding="utf-8")
+        assert "module_099.py 🚫" in capped
+        if links:
+            assert "zz_alias 🔗📁 → pkg05" in capped and "循环引用" in capped
+
+
+def test_spilled_prefix_cache_reset():
+    """Test that relpath survives another thread resetting the spilled prefix cache."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_dir = Path(tmpdir) / "project"
+        (test_dir / "a" / "b").mkdir(parents=True)
+        (test_dir / "a" / "b" / "c.txt").write_text("c")
+
+        packer = context_packer.ContextPacker()
+        catalog = packer.scan_catalog(test_dir, packer.default_ignore_patterns)
+        catalog.spill()
+        catalog.finish()
+        index = next(i for i in range(len(catalog)) if catalog.entry_name(i) == "c.txt")
+
+        class ResettingDict(dict):
+            # 模拟另一个线程在查找前缀的过程中清空了缓存
+            def __contains__(self, key):
+                found = dict.__contains__(self, key)
+                if found:
+                    catalog._dir_prefixes = {-1: ""}
+                return found
+
+        grandparent = catalog.parent[catalog.parent[index]]
+        catalog._dir_prefixes = ResettingDict({-1: "", grandparent: "a" + os.sep})
+        assert catalog.relpath(index) == os.path.join("a", "b", "c.txt")
+
+
+def test_output_writer():
+    """Test compressed output, skip-if-unchanged and atomic replacement of the pack file."""
+    import gzip
+    import lzma
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_dir = Path(tmpdir) / "project"
+        test_dir.mkdir()
+        (test_dir / "main.py").write_text("print('hello')\n")
+        out_dir = Path(tmpdir) / "out"
+        out_dir.mkdir()
+
+        formats = (("pack.md", open), ("pack.md.gz", gzip.open), ("pack.md.xz", lzma.open))
+        for name, opener in formats:
+            output = out_dir / name
+            content = context_packer.ContextPacker().pack_project(str(test_dir), str(output))
+            with opener(output, "rt", encoding="utf-8") as f:
+                written = f.read()
+            assert written.startswith(content) and "ctxpack-fingerprint" in written
+
+            # Unchanged content leaves the existing file (and its mtime) untouched
+            os.utime(output, (1000000000, 1000000000))
+            packer = context_packer.ContextPacker()
+            packer.collect_stats = True
+            packer.pack_project(str(test_dir), str(output))
+            assert packer.stats.counters["output_unchanged"] == 1
+            assert output.stat().st_mtime == 1000000000
+
+        # Changed content replaces the file
+        output = out_dir / "pack.md"
+        (test_dir / "main.py").write_text("print('changed')\n")
+        context_packer.ContextPacker().pack_project(str(test_dir), str(output))
+        assert "print('changed')" in output.read_text(encoding="utf-8")
+
+        # A failure while rendering keeps the previous file and leaves no temp files behind
+        before = output.read_bytes()
+        (test_dir / "main.py").write_text("print('failed')\n")
+        packer = context_packer.ContextPacker()
+
+        def broken_footer(root_path):
+            raise RuntimeError("render failed")
+
+        packer.render_footer = broken_footer
+        try:
+            packer.pack_project(str(test_dir), str(output))
+            assert False, "expected the render failure to propagate"
+        except RuntimeError:
+            pass
+        assert output.read_bytes() == before
+        assert sorted(p.name for p in out_dir.iterdir()) == ["pack.md", "pack.md.gz", "pack.md.xz"]
+
+        # New files get the umask-derived mode and replaced files keep theirs, without the
+        # writer touching the process-wide umask (concurrent packs run in threads)
+        if os.name == "posix":
+            umask = os.umask(0o022)
+            os.umask(umask)
+            real_umask = os.umask
+
+            def no_umask(mask):
+                raise AssertionError("PackWriter must not change the umask")
+
+            os.umask = no_umask
+            try:
+                fresh = out_dir / "fresh.md"
+                context_packer.ContextPacker().pack_project(str(test_dir), str(fresh))
+                assert fresh.stat().st_mode & 0o777 == 0o666 & ~umask
+                output.chmod(0o640)
+                (test_dir / "main.py").write_text("print('mode')\n")
+                context_packer.ContextPacker().pack_project(str(test_dir), str(output))
+                assert output.stat().st_mode & 0o777 == 0o640
+            finally:
+                os.umask = real_umask
+
+
+def test_budget_quotas():
+    """Test that --quota reserves budget per glob and redistributes what is left unused."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_dir = Path(tmpdir) / "project"
+        (test_dir / "packages" / "web").mkdir(parents=True)
+        (test_dir / "server").mkdir()
+        for i in range(20):
+            (test_dir / "packages" / "web" / f"view_{i:02d}.js").write_text("x" * 1000)
+        for i in range(5):
+            (test_dir / "server" / f"api_{i}.py").write_text("y" * 1000)
+
+        packer = context_packer.ContextPacker()
+        packer.max_total_size = 10 * 1024
+        catalog = packer.collect_files(test_dir, packer.default_ignore_patterns)
+        paths = [catalog.relpath(index) for index in catalog.included]
+        assert len(paths) == 10 and not any(path.startswith("server") for path in paths)
+
+        # server/** 预留 30%；docs/** 没有文件，它的 20% 在第二轮分给其余文件
+        packer.quotas = [
+            context_packer.parse_quota("server/**:30%"),
+            context_packer.parse_quota("docs/**=20"),
+        ]
+        packer.stats = context_packer.PackStats(enabled=True)
+        catalog = packer.collect_files(test_dir, packer.default_ignore_patterns)
+        paths = [catalog.relpath(index) for index in catalog.included]
+        server = [path for path in paths if path.startswith("server")]
+        assert len(server) == 3 and len(paths) == 10
+        assert packer.stats.counters["quota_redistributed"] == 2
+        assert paths == sorted(paths)  # 补选的文件仍按排序顺序输出
+
+        quotas = context_packer.BudgetQuotas([("*.md", 10.0), ("src/**", 60.0)])
+        assert quotas.group_of("docs/guide.md") == 0
+        assert quotas.group_of("src/app/main.py") == 1
+        assert quotas.group_of("tests/test_main.py") == 2
+        for bad in ("src/**", "src/**:0", "*.md:abc"):
+            try:
+                context_packer.parse_quota(bad)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError(bad)
+        try:
+            context_packer.BudgetQuotas([("a/**", 70.0), ("b/**", 40.0)])
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("quotas over 100% accepted")
+
+
+def test_region_slicing():
+    """Test that path:START-END and path::Symbol selectors read only the selected lines."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_dir = Path(tmpdir) / "project"
+        test_dir.mkdir()
+        lines = ["import os", ""]
+        for i in range(5000):
+            lines += [f"def helper_{i}(value):", f"    return value + {i}", ""]
+        lines += ["class Engine:", "    @staticmethod", "    def start():", "        return 'go'"]
+        (test_dir / "big.py").write_text("\n".join(lines) + "\n")
+        (test_dir / "store.ts").write_text(
+            "export class Store {\n  add(item: string): void {\n    if (item) {\n"
+            "      this.items.push(item);\n    }\n  }\n\n  clear(): void {\n  }\n}\n"
+        )
+        (test_dir / "main.py").write_text("print('hello')\n")
+
+        packer = context_packer.ContextPacker()
+        packer.max_file_size = 256 * 1024  # 符号选择器要解析整个文件，受单文件大小限制
+        packer.cache_dir = str(Path(tmpdir) / "cache")
+        packer.stats = context_packer.PackStats(enabled=True)
+        for spec in ("big.py:3-4", "big.py::Engine.start", "store.ts::add", "big.py::nope"):
+            selector = context_packer.parse_selector(spec)
+            packer.selections.setdefault(selector.path, []).append(selector)
+        content = packer.generate_markdown(test_dir, packer.default_ignore_patterns)
+
+        assert "> 只包含选中的片段（3-4, Engine.start）：第 3-4、15004-15006 行，共 15006 行" in content
+        assert "def helper_0(value):\n    return value + 0\n\n... (省略 14999 行) ..." in content
+        assert "    @staticmethod\n    def start():\n        return 'go'\n```" in content
+        assert "helper_1(" not in content
+        assert "  add(item: string): void {" in content and "clear()" not in content
+        assert "print('hello')" in content
+        counters = packer.stats.counters
+        assert counters["sliced_files"] == 2 and counters["slice_index_built"] == 2
+        assert counters["bytes_read"] < 2 * context_packer.LINE_INDEX_STRIDE * 40
+
+        # 索引按签名缓存在缓存目录中，新的打包器无需重新读取整个文件
+        fresh = context_packer.ContextPacker()
+        fresh.cache_dir = packer.cache_dir
+        fresh.selections = packer.selections
+        fresh.stats = context_packer.PackStats(enabled=True)
+        assert fresh.generate_markdown(test_dir, fresh.default_ignore_patterns) == content
+        assert fresh.stats.counters["slice_index_cache_hit"] == 2
+        assert "slice_index_built" not in fresh.stats.counters
+
+        # --select takes one selector per flag and leaves the project path positional
+        output = Path(tmpdir) / "cli.md"
+        argv = ["--select", "big.py:3-4", "--select", "store.ts::add", str(test_dir)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            code = context_packer.main(argv + ["-o", str(output), "--no-cache"])
+        assert code == 0
+        cli_content = output.read_text()
+        assert "> 只包含选中的片段（3-4）：第 3-4 行，共 15006 行" in cli_content
+        assert "  add(item: string): void {" in cli_content and "clear()" not in cli_content
+
+        # Changing the selectors of an unchanged file must re-emit it in a delta
+        def pack(specs, delta_from=None):
+            packer = context_packer.ContextPacker()
+            packer.manifest = True
+            packer.delta_from = delta_from
+            for spec in specs:
+                selector = context_packer.parse_selector(spec)
+                packer.selections.setdefault(selector.path, []).append(selector)
+            output = str(Path(tmpdir) / "pack.md")
+            with contextlib.redirect_stdout(io.StringIO()):
+                return packer.pack_project(str(test_dir), output), output
+
+        _, first = pack(["store.ts::add"])
+        delta, _ = pack(["store.ts::clear"], context_packer.load_manifest(first))
+        assert "### store.ts" in delta and "clear(): void {" in delta and "add(" not in delta
+        assert "### main.py" not in delta
+        delta, _ = pack([], context_packer.load_manifest(first))
+        assert "### store.ts" in delta and "add(item" in delta and "clear()" in delta
+
+        # Line ranges on a file far above max_file_size: the index is built by streaming,
+        # symbols are not parsed and oversized selections are refused
+        import tracemalloc
+
+        with open(test_dir / "server.txt", "w") as f:
+            for i in range(400000):
+                f.write(f"2024-01-01 12:00:00 request {i:07d} served ok\n")
+        packer = context_packer.ContextPacker()
+        packer.stats = context_packer.PackStats(enabled=True)
+        for spec in ("server.txt:200001-200002", "server.txt::main"):
+            selector = context_packer.parse_selector(spec)
+            packer.selections.setdefault(selector.path, []).append(selector)
+        tracemalloc.start()
+        try:
+            content = packer.generate_markdown(test_dir, packer.default_ignore_patterns)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert "request 0200000 served" in content and "request 0200001 served" in content
+        assert "request 0200002 served" not in content
+        assert "共 400000 行" in content
+        assert peak < 4 * context_packer.SLICE_READ_CHUNK
+        assert packer.stats.counters["sliced_lines"] == 2
+
+        packer.selections = {"server.txt": [context_packer.parse_selector("server.txt:1-")]}
+        catalog = packer.collect_files(test_dir, packer.default_ignore_patterns)
+        assert not catalog.slices
+        assert catalog.tree_status()["server.txt"] == "skipped_large"
+
+        assert context_packer.parse_selector("a/b.py:120").end == 120
+        assert context_packer.parse_selector("a/b.py:120-").end == 0
+        for bad in ("a/b.py", "a/b.py:0-3", "a/b.py:9-3", "::Engine"):
+            try:
+                context_packer.parse_selector(bad)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError(bad)
+
+
 if __name__ == "__main__":
     # Run tests manually
     test_context_packer_initialization()
@@ -165,5 +1322,65 @@ if __name__ == "__main__":
     
     test_symlink_handling()
     print("✓ Symlink handling test passed")
+
+    test_pack_stats()
+    print("✓ Pack stats test passed")
+
+    test_lazy_startup()
+    print("✓ Lazy startup test passed")
+
+    test_file_catalog()
+    print("✓ File catalog test passed")
+
+    test_encoding_detection()
+    print("✓ Encoding detection test passed")
+
+    test_async_pack()
+    print("✓ Async pack test passed")
+
+    test_symlink_farm_lists_each_directory_once()
+    print("✓ Symlink farm test passed")
+
+    test_summary_tree()
+    print("✓ Summary tree test passed")
+
+    test_parallel_walk()
+    print("✓ Parallel walk test passed")
+
+    test_git_priority()
+    print("✓ Git priority test passed")
+
+    test_query_ranking()
+    print("✓ Query ranking test passed")
+
+    test_delta_pack()
+    print("✓ Delta pack test passed")
+
+    test_generated_detection()
+    print("✓ Generated file detection test passed")
+
+    test_data_reducers()
+    print("✓ Data reducer test passed")
+
+    test_near_duplicate_clustering()
+    print("✓ Near-duplicate clustering test passed")
+
+    test_memory_capped_pack()
+    print("✓ Memory-capped pack test passed")
+
+    test_memory_capped_large_tree()
+    print("✓ Memory-capped large tree test passed")
+
+    test_spilled_prefix_cache_reset()
+    print("✓ Spilled prefix cache reset test passed")
+
+    test_output_writer()
+    print("✓ Output writer test passed")
+
+    test_budget_quotas()
+    print("✓ Budget quota test passed")
+
+    test_region_slicing()
+    print("✓ Region slicing test passed")
     
-    print("\n✅ All tests passed!")
\ No newline at end of file
+    print("\n✅ All tests passed!")